@@ -7,9 +7,16 @@ AI 查询插件 - 向AI模型提问并返回回复
 """
 
 import asyncio
+import codecs
+import hashlib
 import html
 import json
+import math
+import random
 import re
+import time
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
 from pathlib import Path
 from typing import Optional
 from urllib.parse import parse_qs, unquote, urlparse
@@ -17,6 +24,7 @@ from urllib.parse import parse_qs, unquote, urlparse
 import aiohttp
 
 from pagermaid.listener import listener
+from pagermaid.hook import Hook
 from pagermaid.enums import Message
 from pagermaid.utils import logs
 
@@ -32,12 +40,53 @@ except ImportError:
 # 数据目录和配置文件路径
 DATA_DIR = Path("ai_query")
 DATA_FILE = DATA_DIR / "config.json"
-PENDING_SELECTION = {}  # 待选择的模型列表消息
+SEARCH_CACHE_FILE = DATA_DIR / "search_cache.json"
+ROUTER_MODEL_FILE = DATA_DIR / "router_model.json"
+ANSWER_CACHE_FILE = DATA_DIR / "answer_cache.json"
+CALL_STATS_FILE = DATA_DIR / "call_stats.json"
+PENDING_SELECTION = {}  # 待选择的模型列表消息 {(chat_id, 列表消息 id): {"models", "expires_at"}}
+SELECTION_TTL = 300  # 模型列表消息多久内回复序号有效（秒）
 DEFAULT_SEARCH_CONFIG = {
     "enabled": True,
     "max_results": 5,
 }
 SEARCH_TIMEOUT = 20
+SEARCH_CONCURRENCY = 3  # 同时进行的搜索请求数
+SEARCH_LATENCY_BUDGET = 8  # 多个搜索词的总耗时预算（秒），超出后使用已返回的结果
+DUCKDUCKGO_URL = "https://html.duckduckgo.com/html/"
+SEARCH_CHUNK_SIZE = 8192  # 流式读取搜索页面的分块大小（字节）
+SEARCH_MAX_BYTES = 512 * 1024  # 单次搜索最多读取的页面字节数
+SEARCH_REGION = "cn-zh"
+SEARCH_CACHE_TTL = 3600  # 搜索结果缓存有效期（秒）
+SEARCH_CACHE_MAX_ENTRIES = 300  # 搜索结果缓存条数上限（LRU 淘汰）
+DATA_FLUSH_DELAY = 5  # 缓存、模型等数据变更后延迟多久写盘（秒），合并连续写入
+ANSWER_CACHE_SEARCH_TTL = 900  # 基于搜索结果的回答缓存有效期（秒），时效性强，保持较短
+ANSWER_CACHE_DIRECT_TTL = 86400  # 直接回答的缓存有效期（秒）
+ANSWER_CACHE_MAX_ENTRIES = 200  # 回答缓存条数上限（LRU 淘汰）
+ROUTER_NGRAM_SIZES = (1, 2, 3)  # 本地路由分类器使用的字符 n-gram 长度
+ROUTER_MIN_SAMPLES = 40  # 至少积累多少条路由模型的决策后才启用本地判断
+ROUTER_CONFIDENCE = 0.9  # 本地判断的置信度阈值，低于此值交给路由模型
+ROUTER_LOGIT_SCALE = 3.0  # 置信度校准：按每个特征的平均对数几率差乘以此系数换算概率
+ROUTER_MIN_AGREEMENT = 0.9  # 与路由模型的实测一致率达到此值后才允许本地判断
+ROUTER_MIN_COMPARED = 20  # 计算一致率至少需要的对比次数
+ROUTER_AUDIT_RATE = 0.1  # 本地有把握时，仍按此比例交给路由模型抽查（用于统计一致率和继续学习）
+ROUTER_MAX_FEATURES = 20000  # 特征数上限，超出后淘汰只出现过一次的特征
+API_TIMEOUT = 60
+ENDPOINT_EWMA_ALPHA = 0.2  # 端点延迟 EWMA 的平滑系数
+ENDPOINT_LATENCY_WINDOW = 50  # 计算 p95 时保留的最近延迟样本数
+ENDPOINT_MIN_SAMPLES = 5  # 样本数不足时使用默认对冲延迟
+HEDGE_DEFAULT_DELAY = 10  # 默认对冲延迟（秒）：主端点超过此时间未返回就请求下一个端点
+HEDGE_MIN_DELAY = 1.5  # 对冲延迟下限（秒），避免过早对冲浪费调用
+ENDPOINT_FAILURE_LIMIT = 3  # 端点连续失败多少次后进入冷却
+ENDPOINT_COOLDOWN = 120  # 端点冷却时间（秒），冷却期间排到其他端点之后
+CALL_STATS_WINDOW = 2000  # 调用记录保留条数（滚动淘汰最旧的）
+STREAM_EDIT_INTERVAL = 1.2  # 流式回答时两次编辑消息的最小间隔（秒），避免触发 Telegram 限流
+STREAM_PREVIEW_LIMIT = 3900  # 流式预览的最大字符数（Telegram 单条消息上限 4096）
+STREAM_CURSOR = " ▌"
+HTTP_POOL_LIMIT = 32  # 连接池总连接数上限
+HTTP_POOL_LIMIT_PER_HOST = 8  # 单个主机的连接数上限
+HTTP_KEEPALIVE_TIMEOUT = 75  # 空闲连接保活时间（秒）
+HTTP_DNS_CACHE_TTL = 600  # DNS 缓存时间（秒）
 SEARCH_USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
     "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -146,30 +195,210 @@ if HAS_MCP:
     mcp_config_manager: Optional[ConfigManager] = None
 
 
+# ============================================================================
+# HTTP 连接池
+# ============================================================================
+
+# 插件生命周期内共享的 HTTP 会话（首次请求时创建，插件卸载时关闭）
+http_session: Optional[aiohttp.ClientSession] = None
+HTTP_STATS = {
+    "requests": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+WARMED_HOSTS = set()  # 已预热过连接的主机
+_warm_up_tasks = set()  # 预热任务（保留引用，防止被垃圾回收）
+
+
+def build_http_trace_config() -> aiohttp.TraceConfig:
+    """统计请求数、新建/复用连接数和 DNS 缓存命中"""
+
+    def counter(key: str):
+        async def on_event(session, context, params):
+            HTTP_STATS[key] += 1
+
+        return on_event
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(counter("requests"))
+    trace_config.on_connection_create_end.append(counter("connections_created"))
+    trace_config.on_connection_reuseconn.append(counter("connections_reused"))
+    trace_config.on_dns_cache_hit.append(counter("dns_cache_hits"))
+    trace_config.on_dns_cache_miss.append(counter("dns_cache_misses"))
+    return trace_config
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """获取共享 HTTP 会话（保活连接 + DNS 缓存，按主机限制并发连接）"""
+    global http_session
+
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            use_dns_cache=True,
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[build_http_trace_config()],
+        )
+    return http_session
+
+
+def warm_up_host(url: str):
+    """在后台预先建立到目标主机的连接（DNS + TCP + TLS），每个主机只预热一次"""
+    host = urlparse(url).netloc
+    if not host or host in WARMED_HOSTS:
+        return
+    WARMED_HOSTS.add(host)
+
+    async def warm_up():
+        try:
+            timeout = aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
+            async with get_http_session().head(url, timeout=timeout, allow_redirects=False):
+                pass
+        except Exception as e:
+            WARMED_HOSTS.discard(host)
+            logs.debug(f"预热连接失败 {host}: {e}")
+
+    task = asyncio.create_task(warm_up())
+    _warm_up_tasks.add(task)
+    task.add_done_callback(_warm_up_tasks.discard)
+
+
+async def close_http_session():
+    """关闭共享 HTTP 会话"""
+    global http_session
+
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+    WARMED_HOSTS.clear()
+
+
+def format_http_stats() -> str:
+    """格式化连接池统计"""
+    created = HTTP_STATS["connections_created"]
+    reused = HTTP_STATS["connections_reused"]
+    total = created + reused
+    reuse_rate = f"{reused / total:.0%}" if total else "暂无"
+    dns_total = HTTP_STATS["dns_cache_hits"] + HTTP_STATS["dns_cache_misses"]
+    dns_rate = f"{HTTP_STATS['dns_cache_hits'] / dns_total:.0%}" if dns_total else "暂无"
+    status = "已连接" if http_session is not None and not http_session.closed else "未创建"
+    return (
+        "🔗 HTTP 连接池\n\n"
+        f"状态：{status}\n"
+        f"请求数：{HTTP_STATS['requests']}\n"
+        f"新建连接：{created}\n"
+        f"复用连接：{reused}（复用率 {reuse_rate}）\n"
+        f"DNS 缓存命中率：{dns_rate}\n"
+        f"连接上限：总计 {HTTP_POOL_LIMIT} / 单主机 {HTTP_POOL_LIMIT_PER_HOST}"
+    )
+
+
+@Hook.on_shutdown()
+async def ais_shutdown():
+    """插件卸载时关闭连接池，并写入尚未落盘的缓存、路由模型和调用统计"""
+    await close_http_session()
+    for writer in DebouncedJsonWriter.instances:
+        writer.flush_pending()
+
+
+# ============================================================================
+# 模型选择登记
+# ============================================================================
+
+
+def register_selection(chat_id: int, message_id: int, models: list[str]):
+    """登记一条等待回复序号的模型列表消息，同时清理已过期的登记"""
+    now = time.monotonic()
+    for key in [key for key, data in PENDING_SELECTION.items() if data["expires_at"] <= now]:
+        del PENDING_SELECTION[key]
+    PENDING_SELECTION[(chat_id, message_id)] = {
+        "models": list(models),
+        "expires_at": now + SELECTION_TTL,
+    }
+
+
+def get_selection(chat_id: int, message_id: int) -> Optional[dict]:
+    """获取回复对应的模型选择登记，过期则移除并返回 None"""
+    key = (chat_id, message_id)
+    selection_data = PENDING_SELECTION.get(key)
+    if selection_data is None:
+        return None
+    if selection_data["expires_at"] <= time.monotonic():
+        del PENDING_SELECTION[key]
+        return None
+    return selection_data
+
+
+# ============================================================================
+# 配置缓存
+# ============================================================================
+
+# 进程内共享的配置对象，只在文件修改时间变化时重新解析
+_config_cache: Optional[dict] = None
+_config_mtime: Optional[int] = None
+_config_lock = asyncio.Lock()
+
+
+def get_config_mtime() -> Optional[int]:
+    """获取配置文件修改时间（纳秒），文件不存在时返回 None"""
+    try:
+        return DATA_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 def load_config() -> dict:
-    """加载AI配置"""
-    if DATA_FILE.exists():
+    """加载AI配置（进程内缓存，按文件修改时间校验，外部改动文件后自动重新加载）"""
+    global _config_cache, _config_mtime
+
+    mtime = get_config_mtime()
+    if _config_cache is not None and mtime == _config_mtime:
+        return _config_cache
+
+    data = {}
+    if mtime is not None:
         try:
             data = json.loads(DATA_FILE.read_text(encoding="utf-8"))
-            return normalize_config(data)
         except Exception as e:
             logs.error(f"加载配置失败: {e}")
-            return normalize_config({})
-    return normalize_config({})
+    _config_cache = normalize_config(data)
+    _config_mtime = mtime
+    return _config_cache
 
 
-def save_config(config: dict) -> bool:
-    """保存AI配置"""
-    try:
+def write_config_file(config: dict) -> Optional[int]:
+    """原子写入配置文件（在线程中执行），返回写入后的修改时间"""
+    DATA_DIR.mkdir(exist_ok=True, parents=True)
+    temp_file = DATA_FILE.with_suffix(".tmp")
+    temp_file.write_text(
+        json.dumps(config, ensure_ascii=False, indent=2), encoding="utf-8"
+    )
+    temp_file.replace(DATA_FILE)
+    return get_config_mtime()
+
+
+async def save_config(config: dict) -> bool:
+    """保存AI配置：先更新内存中的配置，再在线程中原子写盘"""
+    global _config_cache, _config_mtime
+
+    async with _config_lock:
         config = normalize_config(config)
-        DATA_DIR.mkdir(exist_ok=True, parents=True)
-        DATA_FILE.write_text(
-            json.dumps(config, ensure_ascii=False, indent=2), encoding="utf-8"
-        )
-        return True
-    except Exception as e:
-        logs.error(f"保存配置失败: {e}")
-        return False
+        _config_cache = config
+        try:
+            _config_mtime = await asyncio.to_thread(write_config_file, config)
+            return True
+        except Exception as e:
+            logs.error(f"保存配置失败: {e}")
+            # 内存与磁盘已不一致，下次读取时以磁盘为准
+            _config_cache = None
+            return False
 
 
 def get_current_model(config: dict) -> str:
@@ -195,12 +424,24 @@ def normalize_config(config: Optional[dict]) -> dict:
         "enabled": bool(raw_search.get("enabled", DEFAULT_SEARCH_CONFIG["enabled"])),
         "max_results": max(1, min(max_results, 8)),
     }
+    config["stream"] = bool(config.get("stream", False))
+    config["endpoints"] = [
+        {
+            "name": str(item["name"]),
+            "api_url": str(item["api_url"]),
+            "api_key": str(item["api_key"]),
+            "models": dict(item.get("models") or {}),
+        }
+        for item in config.get("endpoints") or []
+        if isinstance(item, dict) and item.get("name") and item.get("api_url") and item.get("api_key")
+    ]
+    config["speculative"] = bool(config.get("speculative", False))
     return config
 
 
 def get_search_config(config: dict) -> dict:
-    """获取搜索配置"""
-    return normalize_config(config)["search"]
+    """获取搜索配置（load_config 返回的配置已经补齐默认值）"""
+    return config["search"]
 
 
 def should_use_web_search(question: str, search_config: dict) -> bool:
@@ -334,13 +575,6 @@ def build_search_router_messages(question: str) -> list[dict]:
     ]
 
 
-def clean_search_text(raw_text: str) -> str:
-    """清理搜索结果中的 HTML 文本"""
-    text = re.sub(r"<.*?>", " ", raw_text or "")
-    text = html.unescape(text)
-    return re.sub(r"\s+", " ", text).strip()
-
-
 def unwrap_search_url(url: str) -> str:
     """解析搜索引擎跳转链接"""
     if not url:
@@ -358,46 +592,414 @@ def unwrap_search_url(url: str) -> str:
     return url
 
 
+class DuckDuckGoResultParser(HTMLParser):
+    """
+    增量解析 DuckDuckGo HTML 搜索结果，可以分块 feed
+    每条结果由标题链接（result__a）和其后的摘要（result__snippet）组成，
+    取满 max_results 条后 done 为 True，调用方即可停止读取
+    """
+
+    def __init__(self, max_results: int):
+        super().__init__()
+        self.max_results = max_results
+        self.results: list[dict] = []
+        self.seen_urls = set()
+        self.current: Optional[dict] = None  # 已读到标题、等待摘要的结果
+        self.capture: Optional[str] = None  # 正在收集文本的字段：title / snippet
+        self.capture_tag = ""
+        self.capture_depth = 0
+        self.buffer: list[str] = []
+
+    @property
+    def done(self) -> bool:
+        return len(self.results) >= self.max_results
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if self.done:
+            return
+        if self.capture is not None:
+            if tag == self.capture_tag:
+                self.capture_depth += 1
+            return
+
+        classes = (dict(attrs).get("class") or "").split()
+        if tag == "a" and "result__a" in classes:
+            # 上一条结果没有摘要，直接收下
+            self.finish_result()
+            self.current = {"url": dict(attrs).get("href") or "", "title": "", "snippet": ""}
+            self.start_capture("title", tag)
+        elif "result__snippet" in classes and self.current is not None:
+            self.start_capture("snippet", tag)
+
+    def handle_endtag(self, tag: str):
+        if self.capture is None or tag != self.capture_tag:
+            return
+        if self.capture_depth > 0:
+            self.capture_depth -= 1
+            return
+
+        self.current[self.capture] = re.sub(r"\s+", " ", "".join(self.buffer)).strip()
+        finished_snippet = self.capture == "snippet"
+        self.capture = None
+        if finished_snippet:
+            self.finish_result()
+
+    def handle_data(self, data: str):
+        if self.capture is not None:
+            self.buffer.append(data)
+
+    def start_capture(self, field: str, tag: str):
+        self.capture = field
+        self.capture_tag = tag
+        self.capture_depth = 0
+        self.buffer = []
+
+    def finish_result(self):
+        """校验并收下当前结果（去重、跳过没有链接或标题的结果）"""
+        item, self.current = self.current, None
+        if item is None or self.done:
+            return
+        url = unwrap_search_url(item["url"])
+        if not url or not item["title"] or url in self.seen_urls:
+            return
+        self.seen_urls.add(url)
+        self.results.append({"title": item["title"], "url": url, "snippet": item["snippet"]})
+
+    def close(self):
+        super().close()
+        self.finish_result()
+
+
 def parse_duckduckgo_results(page_text: str, max_results: int) -> list[dict]:
     """解析 DuckDuckGo HTML 搜索结果"""
-    result_pattern = re.compile(
-        r'<a[^>]*class="result__a"[^>]*href="(?P<url>[^"]+)"[^>]*>(?P<title>.*?)</a>',
-        re.S,
+    parser = DuckDuckGoResultParser(max_results)
+    parser.feed(page_text)
+    parser.close()
+    return parser.results
+
+
+# ============================================================================
+# 数据落盘
+# ============================================================================
+
+
+def write_json_atomic(path: Path, data: dict):
+    """先写临时文件再替换，避免写到一半时进程退出导致文件损坏"""
+    DATA_DIR.mkdir(exist_ok=True, parents=True)
+    temp_file = path.with_suffix(".tmp")
+    temp_file.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    temp_file.replace(path)
+
+
+class DebouncedJsonWriter:
+    """
+    延迟写盘：短时间内的多次变更合并为一次原子写入（在线程中执行）
+    dirty 标记写入期间是否又有新变更，有则继续写一轮；
+    插件卸载时由 ais_shutdown 同步写入尚未落盘的变更
+    """
+
+    instances: list["DebouncedJsonWriter"] = []
+
+    def __init__(self, path: Path, get_data, label: str):
+        self.path = path
+        self.get_data = get_data  # 返回要写入的数据，在事件循环中调用
+        self.label = label
+        self.task: Optional[asyncio.Task] = None
+        self.dirty = False  # 是否有尚未落盘的变更
+        DebouncedJsonWriter.instances.append(self)
+
+    def schedule(self):
+        """标记有变更并安排一次延迟写盘，已有写盘任务时由它接着写"""
+        self.dirty = True
+        if self.task is not None and not self.task.done():
+            return
+        self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        # 取数据前清除标记，写入期间的新变更会重新置位，循环再写一轮
+        while self.dirty:
+            await asyncio.sleep(DATA_FLUSH_DELAY)
+            self.dirty = False
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, self.get_data())
+            except Exception as e:
+                logs.warning(f"保存{self.label}失败: {e}")
+
+    def flush_pending(self):
+        """立即写入尚未落盘的变更（卸载时调用）"""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        if not self.dirty:
+            return
+        self.dirty = False
+        try:
+            write_json_atomic(self.path, self.get_data())
+        except Exception as e:
+            logs.warning(f"保存{self.label}失败: {e}")
+
+
+# ============================================================================
+# 搜索结果缓存
+# ============================================================================
+
+# {"<地区>|<标准化搜索词>": {"time": 写入时间, "limit": 请求条数, "results": [...]}}
+SEARCH_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+SEARCH_CACHE_STATS = {"lookups": 0, "hits": 0}
+_search_cache_loaded = False
+
+
+def search_cache_key(query: str, region: str) -> str:
+    """缓存键：地区 + 标准化搜索词（小写、合并空白）"""
+    normalized = re.sub(r"\s+", " ", query).strip().lower()
+    return f"{region}|{normalized}"
+
+
+def load_search_cache():
+    """首次使用时从磁盘加载搜索缓存，丢弃已过期的条目"""
+    global _search_cache_loaded
+
+    if _search_cache_loaded:
+        return
+    _search_cache_loaded = True
+
+    if not SEARCH_CACHE_FILE.exists():
+        return
+    try:
+        data = json.loads(SEARCH_CACHE_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        logs.warning(f"加载搜索缓存失败: {e}")
+        return
+
+    now = time.time()
+    for key, entry in data.get("entries", []):
+        if now - entry.get("time", 0) <= SEARCH_CACHE_TTL:
+            SEARCH_CACHE[key] = entry
+
+
+def get_cached_search(query: str, region: str, max_results: int) -> Optional[list[dict]]:
+    """读取缓存的搜索结果，未命中、已过期或条数不足时返回 None"""
+    load_search_cache()
+    SEARCH_CACHE_STATS["lookups"] += 1
+
+    key = search_cache_key(query, region)
+    entry = SEARCH_CACHE.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry["time"] > SEARCH_CACHE_TTL:
+        del SEARCH_CACHE[key]
+        return None
+    # 之前请求的条数少于本次需要的条数，且当时已取满，说明可能还有更多结果
+    if entry["limit"] < max_results and len(entry["results"]) >= entry["limit"]:
+        return None
+
+    SEARCH_CACHE.move_to_end(key)
+    SEARCH_CACHE_STATS["hits"] += 1
+    return entry["results"][:max_results]
+
+
+def store_search_cache(query: str, region: str, max_results: int, results: list[dict]):
+    """写入搜索结果缓存（空结果可能是限流导致的，不缓存）"""
+    if not results:
+        return
+
+    key = search_cache_key(query, region)
+    SEARCH_CACHE[key] = {"time": time.time(), "limit": max_results, "results": results}
+    SEARCH_CACHE.move_to_end(key)
+    while len(SEARCH_CACHE) > SEARCH_CACHE_MAX_ENTRIES:
+        SEARCH_CACHE.popitem(last=False)
+    search_cache_writer.schedule()
+
+
+search_cache_writer = DebouncedJsonWriter(
+    SEARCH_CACHE_FILE, lambda: {"entries": list(SEARCH_CACHE.items())}, "搜索缓存"
+)
+
+
+def clear_search_cache():
+    """清空搜索缓存"""
+    SEARCH_CACHE.clear()
+    SEARCH_CACHE_STATS["lookups"] = 0
+    SEARCH_CACHE_STATS["hits"] = 0
+    SEARCH_CACHE_FILE.unlink(missing_ok=True)
+
+
+def format_search_cache_stats() -> str:
+    """格式化搜索缓存统计"""
+    load_search_cache()
+    lookups = SEARCH_CACHE_STATS["lookups"]
+    hit_rate = f"{SEARCH_CACHE_STATS['hits'] / lookups:.0%}" if lookups else "暂无"
+    return (
+        f"缓存：{len(SEARCH_CACHE)} 条（有效期 {SEARCH_CACHE_TTL // 60} 分钟）\n"
+        f"缓存命中率：{hit_rate}（{SEARCH_CACHE_STATS['hits']}/{lookups}）"
     )
-    results = []
-    seen_urls = set()
 
-    for match in result_pattern.finditer(page_text):
-        url = unwrap_search_url(match.group("url"))
-        title = clean_search_text(match.group("title"))
-        if not url or not title or url in seen_urls:
-            continue
 
-        nearby_text = page_text[match.end(): match.end() + 2000]
-        snippet_match = re.search(
-            r'class="result__snippet"[^>]*>(.*?)</(?:a|div)>',
-            nearby_text,
-            re.S,
-        )
-        snippet = clean_search_text(snippet_match.group(1)) if snippet_match else ""
-
-        results.append(
-            {
-                "title": title,
-                "url": url,
-                "snippet": snippet,
-            }
-        )
-        seen_urls.add(url)
+# ============================================================================
+# 回答缓存
+# ============================================================================
 
-        if len(results) >= max_results:
-            break
+# {"<模型>|<标准化问题>|<搜索结果指纹>": {"time", "ttl", "kind", "answer"}}
+ANSWER_CACHE: "OrderedDict[str, dict]" = OrderedDict()
+# {"<模型>|<标准化问题>": 最近一次写入的完整缓存键}，用于路由前直接查找
+ANSWER_CACHE_LATEST: dict[str, str] = {}
+ANSWER_CACHE_STATS = {"lookups": 0, "hits": 0}
+_answer_cache_loaded = False
 
-    return results
+
+def answer_question_key(model: str, question: str) -> str:
+    """问题键：模型 + 标准化问题（小写、合并空白）"""
+    normalized = re.sub(r"\s+", " ", question).strip().lower()
+    return f"{model}|{normalized}"
+
+
+def search_results_fingerprint(results: list[dict]) -> str:
+    """搜索结果指纹：结果链接和标题的摘要，直接回答固定为 direct"""
+    if not results:
+        return "direct"
+    raw = "\n".join(f"{item.get('url', '')}\t{item.get('title', '')}" for item in results)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def load_answer_cache():
+    """首次使用时从磁盘加载回答缓存，丢弃已过期的条目"""
+    global _answer_cache_loaded
+
+    if _answer_cache_loaded:
+        return
+    _answer_cache_loaded = True
+
+    if not ANSWER_CACHE_FILE.exists():
+        return
+    try:
+        data = json.loads(ANSWER_CACHE_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        logs.warning(f"加载回答缓存失败: {e}")
+        return
+
+    now = time.time()
+    for key, entry in data.get("entries", []):
+        if now - entry.get("time", 0) <= entry.get("ttl", 0):
+            ANSWER_CACHE[key] = entry
+            ANSWER_CACHE_LATEST[key.rsplit("|", 1)[0]] = key
+
+
+def get_cached_answer(
+    model: str,
+    question: str,
+    results: Optional[list[dict]] = None,
+) -> Optional[dict]:
+    """
+    读取缓存的回答，未命中或已过期时返回 None
+    不传搜索结果时查找该问题最近一次的回答（路由前使用，计入一次查找），
+    传入时按搜索结果指纹精确匹配（同一问题的第二次查找，不重复计数）
+    """
+    load_answer_cache()
+    if results is None:
+        ANSWER_CACHE_STATS["lookups"] += 1
+
+    question_key = answer_question_key(model, question)
+    if results is None:
+        key = ANSWER_CACHE_LATEST.get(question_key)
+    else:
+        key = f"{question_key}|{search_results_fingerprint(results)}"
+    entry = ANSWER_CACHE.get(key) if key else None
+    if entry is None:
+        return None
+    if time.time() - entry["time"] > entry["ttl"]:
+        del ANSWER_CACHE[key]
+        return None
+
+    ANSWER_CACHE.move_to_end(key)
+    ANSWER_CACHE_STATS["hits"] += 1
+    return entry
+
+
+def store_answer_cache(model: str, question: str, results: list[dict], answer: str):
+    """写入回答缓存，搜索回答和直接回答使用不同的有效期"""
+    load_answer_cache()
+    question_key = answer_question_key(model, question)
+    key = f"{question_key}|{search_results_fingerprint(results)}"
+    ANSWER_CACHE[key] = {
+        "time": time.time(),
+        "ttl": ANSWER_CACHE_SEARCH_TTL if results else ANSWER_CACHE_DIRECT_TTL,
+        "kind": "search" if results else "direct",
+        "answer": answer,
+    }
+    ANSWER_CACHE.move_to_end(key)
+    ANSWER_CACHE_LATEST[question_key] = key
+    while len(ANSWER_CACHE) > ANSWER_CACHE_MAX_ENTRIES:
+        old_key, _ = ANSWER_CACHE.popitem(last=False)
+        old_question_key = old_key.rsplit("|", 1)[0]
+        if ANSWER_CACHE_LATEST.get(old_question_key) == old_key:
+            del ANSWER_CACHE_LATEST[old_question_key]
+    answer_cache_writer.schedule()
+
+
+answer_cache_writer = DebouncedJsonWriter(
+    ANSWER_CACHE_FILE, lambda: {"entries": list(ANSWER_CACHE.items())}, "回答缓存"
+)
+
+
+def clear_answer_cache():
+    """清空回答缓存"""
+    ANSWER_CACHE.clear()
+    ANSWER_CACHE_LATEST.clear()
+    ANSWER_CACHE_STATS["lookups"] = 0
+    ANSWER_CACHE_STATS["hits"] = 0
+    ANSWER_CACHE_FILE.unlink(missing_ok=True)
+
+
+def format_answer_cached(entry: dict, model: str) -> str:
+    """格式化缓存命中的回答"""
+    if entry["kind"] == "search":
+        header = f"🌐 搜索增强回复（{model}）："
+    else:
+        header = f"🤖 AI 回复（{model}）："
+    age = int((time.time() - entry["time"]) // 60)
+    return f"{header}\n\n{entry['answer']}\n\n💾 缓存回答（{age} 分钟前），,ais nocache <问题> 可重新获取"
+
+
+async def handle_cache_command(message: Message, text: str):
+    """处理回答缓存命令"""
+    parts = text.split()
+    action = parts[1].lower() if len(parts) > 1 else "status"
+
+    if action == "clear":
+        clear_answer_cache()
+        await message.edit("✅ 已清空回答缓存")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    load_answer_cache()
+    lookups = ANSWER_CACHE_STATS["lookups"]
+    hit_rate = f"{ANSWER_CACHE_STATS['hits'] / lookups:.0%}" if lookups else "暂无"
+    await message.edit(
+        "💾 回答缓存\n\n"
+        f"缓存：{len(ANSWER_CACHE)} 条（上限 {ANSWER_CACHE_MAX_ENTRIES}）\n"
+        f"有效期：搜索回答 {ANSWER_CACHE_SEARCH_TTL // 60} 分钟 / "
+        f"直接回答 {ANSWER_CACHE_DIRECT_TTL // 3600} 小时\n"
+        f"命中率：{hit_rate}（{ANSWER_CACHE_STATS['hits']}/{lookups}）\n\n"
+        "命令示例：\n"
+        "  ,ais cache\n"
+        "  ,ais cache clear\n"
+        "  ,ais nocache <问题>"
+    )
 
 
 async def duckduckgo_search(query: str, max_results: int) -> list[dict]:
-    """使用 DuckDuckGo HTML 进行搜索"""
+    """使用 DuckDuckGo HTML 进行搜索（优先读取缓存）"""
+    cached = get_cached_search(query, SEARCH_REGION, max_results)
+    if cached is not None:
+        return cached
+
+    results = await fetch_duckduckgo_results(query, max_results)
+    store_search_cache(query, SEARCH_REGION, max_results, results)
+    return results
+
+
+async def fetch_duckduckgo_results(query: str, max_results: int) -> list[dict]:
+    """请求 DuckDuckGo HTML 页面，分块读取并增量解析，取满结果后立即停止读取"""
     headers = {
         "User-Agent": SEARCH_USER_AGENT,
         "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
@@ -405,22 +1007,40 @@ async def duckduckgo_search(query: str, max_results: int) -> list[dict]:
     }
     params = {
         "q": query,
-        "kl": "cn-zh",
+        "kl": SEARCH_REGION,
     }
 
     try:
         timeout = aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(
-                "https://html.duckduckgo.com/html/",
-                headers=headers,
-                params=params,
-            ) as response:
-                if response.status != 200:
-                    logs.warning(f"DuckDuckGo 搜索失败: {response.status}")
-                    return []
-                page_text = await response.text()
-                return parse_duckduckgo_results(page_text, max_results)
+        async with get_http_session().get(
+            DUCKDUCKGO_URL,
+            headers=headers,
+            params=params,
+            timeout=timeout,
+        ) as response:
+            if response.status != 200:
+                logs.warning(f"DuckDuckGo 搜索失败: {response.status}")
+                return []
+
+            parser = DuckDuckGoResultParser(max_results)
+            decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="ignore")
+            received = 0
+            stopped_early = False
+            async for chunk in response.content.iter_chunked(SEARCH_CHUNK_SIZE):
+                received += len(chunk)
+                parser.feed(decoder.decode(chunk))
+                if parser.done or received >= SEARCH_MAX_BYTES:
+                    if not parser.done:
+                        logs.info(f"DuckDuckGo 页面超过 {SEARCH_MAX_BYTES // 1024} KB，停止读取")
+                    stopped_early = True
+                    break
+            if not stopped_early:
+                parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            if stopped_early:
+                # 剩余内容未读完，直接关闭连接而不是放回连接池
+                response.close()
+            return parser.results
     except asyncio.TimeoutError:
         logs.warning("DuckDuckGo 搜索超时")
         return []
@@ -429,27 +1049,91 @@ async def duckduckgo_search(query: str, max_results: int) -> list[dict]:
         return []
 
 
-async def search_web(question: str, max_results: int) -> tuple[list[dict], str]:
-    """执行联网搜索并返回结果"""
-    queries = build_search_queries(question)
+def merge_search_results(
+    results_by_query: list[Optional[list[dict]]],
+    queries: list[str],
+    max_results: int,
+) -> tuple[list[dict], str]:
+    """按搜索词优先级合并结果并按链接去重，返回 (结果, 首个有结果的搜索词)"""
     merged_results = []
     seen_urls = set()
     used_query = ""
 
-    for query in queries:
-        results = await duckduckgo_search(query, max_results)
+    for query, results in zip(queries, results_by_query):
         if results and not used_query:
             used_query = query
 
-        for item in results:
+        for item in results or []:
             url = item.get("url", "")
             if not url or url in seen_urls:
                 continue
             merged_results.append(item)
             seen_urls.add(url)
             if len(merged_results) >= max_results:
-                return merged_results, used_query or query
+                return merged_results, used_query
+
+    return merged_results, used_query
+
 
+async def search_queries_concurrently(
+    queries: list[str],
+    max_results: int,
+) -> tuple[list[dict], str]:
+    """
+    并发执行多个搜索词（最多 SEARCH_CONCURRENCY 个同时进行）
+    按优先级排在最前、且已全部完成的搜索词的去重链接数达到 max_results，
+    或超出 SEARCH_LATENCY_BUDGET 时，取消其余请求，已返回的结果仍按搜索词优先级合并
+    """
+    if not queries:
+        return [], ""
+
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    results_by_query: list[Optional[list[dict]]] = [None] * len(queries)
+
+    async def run(index: int, query: str):
+        async with semaphore:
+            results_by_query[index] = await duckduckgo_search(query, max_results)
+
+    tasks = [asyncio.create_task(run(index, query)) for index, query in enumerate(queries)]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SEARCH_LATENCY_BUDGET
+    pending = set(tasks)
+
+    def prefix_covered() -> bool:
+        """从最高优先级开始连续完成的搜索词是否已凑够结果（避免快速返回的低优先级结果抢先）"""
+        seen_urls = set()
+        for task, results in zip(tasks, results_by_query):
+            if not task.done():
+                return False
+            for item in results or []:
+                if item.get("url"):
+                    seen_urls.add(item["url"])
+            if len(seen_urls) >= max_results:
+                return True
+        return False
+
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logs.info(f"搜索超出耗时预算，放弃 {len(pending)} 个未完成的搜索词")
+                break
+            _, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            if prefix_covered():
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return merge_search_results(results_by_query, queries, max_results)
+
+
+async def search_web(question: str, max_results: int) -> tuple[list[dict], str]:
+    """执行联网搜索并返回结果"""
+    queries = build_search_queries(question)
+    merged_results, used_query = await search_queries_concurrently(queries, max_results)
     return merged_results, used_query or (queries[0] if queries else question)
 
 
@@ -470,24 +1154,9 @@ async def search_web_by_queries(
     if not normalized_queries:
         return await search_web(question, max_results)
 
-    merged_results = []
-    seen_urls = set()
-    used_query = ""
-
-    for query in normalized_queries[:4]:
-        results = await duckduckgo_search(query, max_results)
-        if results and not used_query:
-            used_query = query
-
-        for item in results:
-            url = item.get("url", "")
-            if not url or url in seen_urls:
-                continue
-            merged_results.append(item)
-            seen_urls.add(url)
-            if len(merged_results) >= max_results:
-                return merged_results, used_query or query
-
+    merged_results, used_query = await search_queries_concurrently(
+        normalized_queries[:4], max_results
+    )
     return merged_results, used_query or normalized_queries[0]
 
 
@@ -576,17 +1245,26 @@ async def handle_search_command(message: Message, text: str):
         await message.edit(
             "🌐 搜索增强状态\n\n"
             f"开关：{status}\n"
-            f"结果条数：{search_config['max_results']}\n\n"
+            f"结果条数：{search_config['max_results']}\n"
+            f"{format_search_cache_stats()}\n\n"
             "命令示例：\n"
             "  ,ais search on\n"
             "  ,ais search off\n"
-            "  ,ais search max 5"
+            "  ,ais search max 5\n"
+            "  ,ais search clear"
         )
         return
 
+    if action == "clear":
+        clear_search_cache()
+        await message.edit("✅ 已清空搜索结果缓存")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
     if action in ("on", "enable"):
         config["search"]["enabled"] = True
-        if save_config(config):
+        if await save_config(config):
             await message.edit("✅ 已开启搜索增强，事实类问题会先联网搜索再回答")
         else:
             await message.edit("❌ 保存搜索配置失败")
@@ -596,7 +1274,7 @@ async def handle_search_command(message: Message, text: str):
 
     if action in ("off", "disable"):
         config["search"]["enabled"] = False
-        if save_config(config):
+        if await save_config(config):
             await message.edit("✅ 已关闭搜索增强，后续将直接调用模型回答")
         else:
             await message.edit("❌ 保存搜索配置失败")
@@ -622,7 +1300,7 @@ async def handle_search_command(message: Message, text: str):
             return
 
         config["search"]["max_results"] = max_results
-        if save_config(config):
+        if await save_config(config):
             await message.edit(f"✅ 已将搜索结果条数设置为 {max_results}")
         else:
             await message.edit("❌ 保存搜索配置失败")
@@ -636,28 +1314,332 @@ async def handle_search_command(message: Message, text: str):
         "  • ,ais search          - 查看搜索状态\n"
         "  • ,ais search on       - 开启搜索增强\n"
         "  • ,ais search off      - 关闭搜索增强\n"
-        "  • ,ais search max <数> - 设置搜索结果条数"
+        "  • ,ais search max <数> - 设置搜索结果条数\n"
+        "  • ,ais search clear    - 清空搜索结果缓存"
     )
     await asyncio.sleep(4)
     await message.delete()
 
 
+async def handle_stream_command(message: Message, text: str):
+    """处理流式回答开关命令"""
+    parts = text.split()
+    action = parts[1].lower() if len(parts) > 1 else "status"
+    config = load_config()
+
+    if action in ("on", "enable", "off", "disable"):
+        config["stream"] = action in ("on", "enable")
+        if await save_config(config):
+            state = "开启" if config["stream"] else "关闭"
+            await message.edit(f"✅ 已{state}流式回答")
+        else:
+            await message.edit("❌ 保存配置失败")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    status = "开启" if config["stream"] else "关闭"
+    await message.edit(
+        "📡 流式回答状态\n\n"
+        f"开关：{status}\n"
+        f"编辑间隔：{STREAM_EDIT_INTERVAL} 秒\n\n"
+        "开启后回答会边生成边显示（需要 API 支持 stream）\n\n"
+        "命令示例：\n"
+        "  ,ais stream on\n"
+        "  ,ais stream off"
+    )
+
+
+async def handle_speculative_command(message: Message, text: str):
+    """处理推测式路由开关命令"""
+    parts = text.split()
+    action = parts[1].lower() if len(parts) > 1 else "status"
+    config = load_config()
+
+    if action in ("on", "enable", "off", "disable"):
+        config["speculative"] = action in ("on", "enable")
+        if await save_config(config):
+            state = "开启" if config["speculative"] else "关闭"
+            await message.edit(f"✅ 已{state}推测式路由")
+        else:
+            await message.edit("❌ 保存配置失败")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    status = "开启" if config["speculative"] else "关闭"
+    await message.edit(
+        "⚡ 推测式路由状态\n\n"
+        f"开关：{status}\n\n"
+        "开启后，在路由模型判断是否搜索的同时，提前开始直接回答和按规则规划的搜索，"
+        "路由结果出来后保留对应分支、取消另一个。不需要搜索的问题可省去一次模型往返，"
+        "但会多消耗一次回答调用的 token\n\n"
+        "命令示例：\n"
+        "  ,ais speculative on\n"
+        "  ,ais speculative off"
+    )
+
+
+async def speculative_route(
+    config: dict,
+    model: str,
+    question: str,
+    search_config: dict,
+    direct_preview: "EditCoalescer",
+) -> tuple[dict, list[dict], str, Optional[asyncio.Task]]:
+    """
+    推测式路由：路由模型判断期间，同时开始直接回答和按兜底规则规划的搜索
+    路由选择搜索且有结果时取消直接回答，否则取消搜索、保留直接回答
+    开启流式时直接回答的增量先攒在暂停的 direct_preview 中，调用方确定使用直接回答后再恢复编辑
+    返回: (搜索计划, 搜索结果, 搜索词, 直接回答任务或 None)
+    """
+    router_task = asyncio.create_task(
+        decide_search_plan(
+            config=config,
+            model=model,
+            question=question,
+            search_config=search_config,
+        )
+    )
+    direct_task = asyncio.create_task(
+        request_answer(
+            direct_preview.message,
+            config,
+            model,
+            build_direct_answer_messages(question),
+            direct_preview.header,
+            coalescer=direct_preview,
+        )
+    )
+    search_task = None
+    if should_use_web_search(question, search_config):
+        search_task = asyncio.create_task(
+            search_web(question, search_config["max_results"])
+        )
+
+    try:
+        search_plan = await router_task
+        if not search_plan["use_search"]:
+            if search_task is not None:
+                search_task.cancel()
+            return search_plan, [], "", direct_task
+
+        search_results, search_query = [], ""
+        if search_task is not None:
+            search_results, search_query = await search_task
+        if not search_results:
+            search_results, search_query = await search_web_by_queries(
+                question,
+                search_plan["search_queries"],
+                search_config["max_results"],
+            )
+        if not search_results:
+            return search_plan, [], "", direct_task
+
+        direct_task.cancel()
+        return search_plan, search_results, search_query, None
+    except BaseException:
+        for task in (router_task, direct_task, search_task):
+            if task is not None:
+                task.cancel()
+        raise
+
+
+# ============================================================================
+# 本地搜索路由分类器
+# ============================================================================
+
+
+class RouterClassifier:
+    """
+    字符 n-gram 朴素贝叶斯分类器，从路由模型过去的决策中学习"是否需要搜索"
+    有足够把握时在本地直接判断，省去一次路由模型调用；没把握时交给路由模型
+    """
+
+    LABELS = ("search", "direct")
+
+    def __init__(self):
+        self.counts = {label: {} for label in self.LABELS}  # {类别: {n-gram: 次数}}
+        self.totals = {label: 0 for label in self.LABELS}  # 各类别 n-gram 总数
+        self.docs = {label: 0 for label in self.LABELS}  # 各类别样本数
+        self.stats = {"local": 0, "escalated": 0, "compared": 0, "agreed": 0}
+        self.loaded = False
+
+    @staticmethod
+    def features(question: str) -> list[str]:
+        text = re.sub(r"\s+", "", question.lower())
+        return [
+            text[i: i + size]
+            for size in ROUTER_NGRAM_SIZES
+            for i in range(len(text) - size + 1)
+        ]
+
+    def load(self):
+        """首次使用时从磁盘加载模型"""
+        if self.loaded:
+            return
+        self.loaded = True
+        if not ROUTER_MODEL_FILE.exists():
+            return
+        try:
+            data = json.loads(ROUTER_MODEL_FILE.read_text(encoding="utf-8"))
+            self.counts.update(data.get("counts", {}))
+            self.totals.update(data.get("totals", {}))
+            self.docs.update(data.get("docs", {}))
+            self.stats.update(data.get("stats", {}))
+        except Exception as e:
+            logs.warning(f"加载本地路由模型失败: {e}")
+
+    def predict(self, question: str) -> Optional[tuple[bool, float]]:
+        """返回 (是否搜索, 置信度)；样本不足时返回 None"""
+        self.load()
+        if sum(self.docs.values()) < ROUTER_MIN_SAMPLES or not all(self.docs.values()):
+            return None
+
+        vocabulary = len(set(self.counts["search"]) | set(self.counts["direct"])) or 1
+        doc_total = sum(self.docs.values())
+        features = self.features(question)
+        if not features:
+            return None
+        scores = {}
+        for label in self.LABELS:
+            counts = self.counts[label]
+            denominator = self.totals[label] + vocabulary
+            score = math.log(self.docs[label] / doc_total)
+            for feature in features:
+                score += math.log((counts.get(feature, 0) + 1) / denominator)
+            scores[label] = score
+
+        # 朴素贝叶斯把高度相关的 n-gram 当作独立证据累加，原始对数几率差严重偏大，
+        # 这里按特征数取平均后再换算概率，使置信度阈值真正起到过滤作用
+        diff = (scores["search"] - scores["direct"]) / len(features) * ROUTER_LOGIT_SCALE
+        diff = max(min(diff, 50), -50)
+        search_probability = 1 / (1 + math.exp(-diff))
+        use_search = search_probability >= 0.5
+        return use_search, search_probability if use_search else 1 - search_probability
+
+    def is_trusted(self) -> bool:
+        """与路由模型的实测一致率是否足够高，可以替代路由模型"""
+        compared = self.stats["compared"]
+        return compared >= ROUTER_MIN_COMPARED and self.stats["agreed"] / compared >= ROUTER_MIN_AGREEMENT
+
+    def count_local(self):
+        """记录一次本地判断（省去的路由调用）"""
+        self.stats["local"] += 1
+        self.schedule_flush()
+
+    def learn(self, question: str, use_search: bool, local_guess: Optional[bool]):
+        """用路由模型的决策更新模型，并统计与本地判断的一致率"""
+        self.load()
+        if local_guess is not None:
+            self.stats["compared"] += 1
+            if local_guess == use_search:
+                self.stats["agreed"] += 1
+
+        label = "search" if use_search else "direct"
+        counts = self.counts[label]
+        features = self.features(question)
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+        self.totals[label] += len(features)
+        self.docs[label] += 1
+
+        if len(counts) > ROUTER_MAX_FEATURES:
+            for feature in [key for key, value in counts.items() if value <= 1]:
+                del counts[feature]
+            self.totals[label] = sum(counts.values())
+        self.schedule_flush()
+
+    def to_dict(self) -> dict:
+        """导出模型和统计（复制一份，避免写盘期间被继续学习修改）"""
+        return json.loads(json.dumps({
+            "counts": self.counts,
+            "totals": self.totals,
+            "docs": self.docs,
+            "stats": self.stats,
+        }))
+
+    def schedule_flush(self):
+        """延迟写盘，合并连续的学习更新"""
+        router_model_writer.schedule()
+
+    def reset(self):
+        """清空模型和统计"""
+        self.__init__()
+        self.loaded = True
+        ROUTER_MODEL_FILE.unlink(missing_ok=True)
+
+    def format_stats(self) -> str:
+        """格式化本地路由统计"""
+        self.load()
+        samples = sum(self.docs.values())
+        decided = self.stats["local"] + self.stats["escalated"]
+        compared = self.stats["compared"]
+        agreement = f"{self.stats['agreed'] / compared:.0%}" if compared else "暂无"
+        local_rate = f"{self.stats['local'] / decided:.0%}" if decided else "暂无"
+        if samples < ROUTER_MIN_SAMPLES or not all(self.docs.values()):
+            ready = f"学习中（{samples}/{ROUTER_MIN_SAMPLES}）"
+        elif not self.is_trusted():
+            ready = f"验证中（一致率需达到 {ROUTER_MIN_AGREEMENT:.0%}，至少对比 {ROUTER_MIN_COMPARED} 次）"
+        else:
+            ready = "已启用"
+        return (
+            "🧠 本地搜索路由\n\n"
+            f"状态：{ready}\n"
+            f"训练样本：{samples}（搜索 {self.docs['search']} / 直答 {self.docs['direct']}）\n"
+            f"本地判断：{self.stats['local']} 次（省去路由调用，占比 {local_rate}）\n"
+            f"交给路由模型：{self.stats['escalated']} 次\n"
+            f"与路由模型一致率：{agreement}（{self.stats['agreed']}/{compared}）\n"
+            f"置信度阈值：{ROUTER_CONFIDENCE:.0%}\n\n"
+            "命令示例：\n"
+            "  ,ais router\n"
+            "  ,ais router reset"
+        )
+
+
+router_classifier = RouterClassifier()
+router_model_writer = DebouncedJsonWriter(ROUTER_MODEL_FILE, router_classifier.to_dict, "本地路由模型")
+
+
+async def handle_router_command(message: Message, text: str):
+    """处理本地路由统计命令"""
+    parts = text.split()
+    action = parts[1].lower() if len(parts) > 1 else "status"
+
+    if action == "reset":
+        router_classifier.reset()
+        await message.edit("✅ 已重置本地搜索路由模型")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    await message.edit(router_classifier.format_stats())
+
+
 async def decide_search_plan(
-    api_url: str,
-    api_key: str,
+    config: dict,
     model: str,
     question: str,
     search_config: dict,
 ) -> dict:
-    """让模型决定是否搜索以及搜索什么"""
+    """让模型决定是否搜索以及搜索什么（本地分类器有把握时直接判断）"""
     if not search_config.get("enabled", True):
         return normalize_search_plan(question, search_config, {"use_search": False})
 
-    planner_result = await call_ai_api(
-        api_url=api_url,
-        api_key=api_key,
-        model=model,
-        messages=build_search_router_messages(question),
+    prediction = router_classifier.predict(question)
+    local_guess = prediction[0] if prediction else None
+    if (
+        prediction
+        and prediction[1] >= ROUTER_CONFIDENCE
+        and router_classifier.is_trusted()
+        and random.random() >= ROUTER_AUDIT_RATE
+    ):
+        router_classifier.count_local()
+        return normalize_search_plan(question, search_config, {"use_search": local_guess})
+    router_classifier.stats["escalated"] += 1
+
+    planner_result = await call_ai_hedged(
+        config, model, build_search_router_messages(question), purpose="router"
     )
 
     if not is_ai_success(planner_result):
@@ -669,13 +1651,19 @@ async def decide_search_plan(
         logs.warning(f"搜索路由 JSON 解析失败: {planner_result}")
         return normalize_search_plan(question, search_config)
 
+    if "use_search" in raw_plan:
+        router_classifier.learn(question, bool(raw_plan["use_search"]), local_guess)
     return normalize_search_plan(question, search_config, raw_plan)
 
 
 async def call_ai_api(
-    api_url: str, api_key: str, model: str, messages: list[dict]
+    api_url: str,
+    api_key: str,
+    model: str,
+    messages: list[dict],
+    usage: Optional[dict] = None,
 ) -> Optional[str]:
-    """调用AI API获取回复"""
+    """调用AI API获取回复（传入 usage 字典时填入响应中的 token 用量）"""
     try:
         headers = {
             "Authorization": f"Bearer {api_key}",
@@ -688,25 +1676,27 @@ async def call_ai_api(
             "messages": messages,
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                api_url, headers=headers, json=data, timeout=60
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    # 尝试从不同格式中提取回复
-                    if "choices" in result and len(result["choices"]) > 0:
-                        return result["choices"][0]["message"]["content"]
-                    elif "message" in result:
-                        return result["message"]["content"]
-                    elif "content" in result:
-                        return result["content"]
-                    else:
-                        return str(result)
+        timeout = aiohttp.ClientTimeout(total=API_TIMEOUT)
+        async with get_http_session().post(
+            api_url, headers=headers, json=data, timeout=timeout
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                if usage is not None and isinstance(result.get("usage"), dict):
+                    usage.update(result["usage"])
+                # 尝试从不同格式中提取回复
+                if "choices" in result and len(result["choices"]) > 0:
+                    return result["choices"][0]["message"]["content"]
+                elif "message" in result:
+                    return result["message"]["content"]
+                elif "content" in result:
+                    return result["content"]
                 else:
-                    error_text = await response.text()
-                    logs.error(f"API调用失败: {response.status} - {error_text}")
-                    return f"API调用失败: {response.status}"
+                    return str(result)
+            else:
+                error_text = await response.text()
+                logs.error(f"API调用失败: {response.status} - {error_text}")
+                return f"API调用失败: {response.status}"
     except asyncio.TimeoutError:
         return "请求超时"
     except Exception as e:
@@ -714,6 +1704,583 @@ async def call_ai_api(
         return f"调用异常: {str(e)}"
 
 
+def extract_stream_delta(payload: dict) -> str:
+    """从 SSE 数据块中提取增量文本"""
+    choices = payload.get("choices") or []
+    if choices:
+        delta = choices[0].get("delta") or choices[0].get("message") or {}
+        return delta.get("content") or ""
+    return payload.get("content") or ""
+
+
+async def call_ai_api_stream(
+    api_url: str,
+    api_key: str,
+    model: str,
+    messages: list[dict],
+    on_delta,
+    usage: Optional[dict] = None,
+) -> Optional[str]:
+    """以 stream 模式调用AI API，每收到一段增量文本就回调 on_delta(本段增量)"""
+    try:
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        data = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            # 不带此选项时 OpenAI 兼容服务不会在流末尾返回 token 用量
+            "stream_options": {"include_usage": True},
+        }
+
+        # 流式响应总时长不固定，只限制两次数据之间的间隔
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=API_TIMEOUT)
+        async with get_http_session().post(
+            api_url, headers=headers, json=data, timeout=timeout
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logs.error(f"API调用失败: {response.status} - {error_text}")
+                return f"API调用失败: {response.status}"
+
+            # 服务端不支持流式时会直接返回完整 JSON
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                result = await response.json(content_type=None)
+                if usage is not None and isinstance(result.get("usage"), dict):
+                    usage.update(result["usage"])
+                if "choices" in result and len(result["choices"]) > 0:
+                    return result["choices"][0]["message"]["content"]
+                return extract_stream_delta(result) or str(result)
+
+            parts = []
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8", errors="ignore").strip()
+                if not line.startswith("data:"):
+                    continue
+                chunk = line[5:].strip()
+                if chunk == "[DONE]":
+                    break
+                try:
+                    payload = json.loads(chunk)
+                    delta = extract_stream_delta(payload)
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+                # 部分服务会在最后一个数据块中附带 token 用量
+                if usage is not None and isinstance(payload.get("usage"), dict):
+                    usage.update(payload["usage"])
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+            return "".join(parts)
+    except asyncio.TimeoutError:
+        return "请求超时"
+    except Exception as e:
+        logs.error(f"调用AI API异常: {e}")
+        return f"调用异常: {str(e)}"
+
+
+class EditCoalescer:
+    """
+    合并流式回答过程中的消息编辑
+    两次编辑之间至少间隔 min_interval 秒，期间到达的增量先攒着，真正编辑时才拼接；内容未变化时不编辑
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        header: str,
+        min_interval: float = STREAM_EDIT_INTERVAL,
+        paused: bool = False,
+    ):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self.paused = paused  # 暂停时只攒增量不编辑，resume 后再显示
+        self.parts: list[str] = []
+        self.last_sent = None
+        self.last_edit_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, delta: str):
+        """记录一段增量，必要时安排一次延迟编辑"""
+        self.parts.append(delta)
+        if self.paused:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_later())
+
+    def resume(self):
+        """恢复编辑，立即显示暂停期间攒下的内容"""
+        self.paused = False
+        if self.parts and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        loop = asyncio.get_running_loop()
+        wait = self.last_edit_at + self.min_interval - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        preview = "".join(self.parts)
+        if len(preview) > STREAM_PREVIEW_LIMIT:
+            preview = "…" + preview[-STREAM_PREVIEW_LIMIT:]
+        content = f"{self.header}{preview}{STREAM_CURSOR}"
+        if content == self.last_sent:
+            return
+        try:
+            await self.message.edit(content)
+            self.last_sent = content
+        except Exception as e:
+            logs.debug(f"流式编辑消息失败: {e}")
+        self.last_edit_at = loop.time()
+
+    def reset(self):
+        """丢弃已收到的增量（换用下一个端点重新生成时调用）"""
+        self.parts.clear()
+
+    async def close(self):
+        """停止尚未执行的编辑（最终内容由调用方编辑）"""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+# ============================================================================
+# API 端点与对冲请求
+# ============================================================================
+
+
+class EndpointHealth:
+    """单个端点的延迟（EWMA + 最近样本的 p95）与健康状态"""
+
+    def __init__(self):
+        self.ewma: Optional[float] = None
+        self.latencies = deque(maxlen=ENDPOINT_LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record(self, latency: float, success: bool):
+        if success:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.latencies.append(latency)
+            if self.ewma is None:
+                self.ewma = latency
+            else:
+                self.ewma = ENDPOINT_EWMA_ALPHA * latency + (1 - ENDPOINT_EWMA_ALPHA) * self.ewma
+            return
+
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= ENDPOINT_FAILURE_LIMIT:
+            self.cooldown_until = time.monotonic() + ENDPOINT_COOLDOWN
+            self.consecutive_failures = 0
+
+    def record_cancelled(self, waited: float):
+        """
+        对冲落败被取消的调用：实际延迟至少为已等待的时间，作为下界样本计入 p95，
+        否则 p95 只由快速返回的调用构成，会不断降低，导致几乎每次都发出对冲请求
+        """
+        self.latencies.append(waited)
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < ENDPOINT_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self) -> float:
+        """等待多久后向下一个端点发出对冲请求"""
+        p95 = self.p95()
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, min(p95, API_TIMEOUT))
+
+    def is_cooling(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+
+ENDPOINT_HEALTH: dict[str, EndpointHealth] = {}
+
+
+def get_endpoint_health(name: str) -> EndpointHealth:
+    if name not in ENDPOINT_HEALTH:
+        ENDPOINT_HEALTH[name] = EndpointHealth()
+    return ENDPOINT_HEALTH[name]
+
+
+def get_endpoints(config: dict) -> list[dict]:
+    """按优先级返回所有端点：主端点（,ais set 配置的）在前，备用端点按添加顺序"""
+    endpoints = []
+    if config.get("api_url") and config.get("api_key"):
+        endpoints.append({
+            "name": "main",
+            "api_url": config["api_url"],
+            "api_key": config["api_key"],
+            "models": {},
+        })
+    endpoints.extend(config.get("endpoints", []))
+    return endpoints
+
+
+def order_endpoints(config: dict) -> list[dict]:
+    """冷却中的端点排到最后，全部冷却时仍按原顺序尝试"""
+    endpoints = get_endpoints(config)
+    healthy = [item for item in endpoints if not get_endpoint_health(item["name"]).is_cooling()]
+    cooling = [item for item in endpoints if get_endpoint_health(item["name"]).is_cooling()]
+    return healthy + cooling
+
+
+async def call_endpoint(
+    endpoint: dict,
+    model: str,
+    messages: list[dict],
+    on_delta=None,
+    purpose: str = "answer",
+) -> Optional[str]:
+    """调用单个端点（模型名按端点的映射转换），并记录延迟、token 用量和成败"""
+    remote_model = endpoint["models"].get(model, model)
+    usage = {}
+    started = time.monotonic()
+    try:
+        if on_delta is None:
+            result = await call_ai_api(
+                endpoint["api_url"], endpoint["api_key"], remote_model, messages, usage
+            )
+        else:
+            result = await call_ai_api_stream(
+                endpoint["api_url"], endpoint["api_key"], remote_model, messages, on_delta, usage
+            )
+    except asyncio.CancelledError:
+        # 对冲请求中落败被取消的调用
+        waited = time.monotonic() - started
+        get_endpoint_health(endpoint["name"]).record_cancelled(waited)
+        record_call(purpose, model, endpoint["name"], waited, usage, "cancelled")
+        raise
+
+    latency = time.monotonic() - started
+    get_endpoint_health(endpoint["name"]).record(latency, is_ai_success(result))
+    record_call(purpose, model, endpoint["name"], latency, usage, classify_call_outcome(result))
+    return result
+
+
+async def call_ai_hedged(
+    config: dict,
+    model: str,
+    messages: list[dict],
+    purpose: str = "answer",
+) -> Optional[str]:
+    """
+    按端点优先级发起请求：当前端点超过其 p95 延迟仍未返回时，向下一个端点发出对冲请求，
+    采用最先成功的回复并取消其余请求；端点失败时立即改用下一个端点
+    """
+    endpoints = order_endpoints(config)
+    if not endpoints:
+        return "API调用失败: 未配置API"
+
+    pending: dict[asyncio.Task, dict] = {}
+    next_index = 0
+    last_endpoint = endpoints[0]
+    result = None
+
+    def launch():
+        nonlocal next_index, last_endpoint
+        last_endpoint = endpoints[next_index]
+        next_index += 1
+        task = asyncio.create_task(
+            call_endpoint(last_endpoint, model, messages, purpose=purpose)
+        )
+        pending[task] = last_endpoint
+
+    launch()
+    try:
+        while pending:
+            # 没有备用端点时只需等待已发出的请求
+            timeout = None
+            if next_index < len(endpoints):
+                timeout = get_endpoint_health(last_endpoint["name"]).hedge_delay()
+
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                logs.info(
+                    f"端点 {last_endpoint['name']} 超过 {timeout:.1f} 秒未返回，"
+                    f"对冲请求 {endpoints[next_index]['name']}"
+                )
+                launch()
+                continue
+
+            failed = False
+            for task in done:
+                endpoint = pending.pop(task)
+                result = task.result()
+                if is_ai_success(result):
+                    return result
+                logs.warning(f"端点 {endpoint['name']} 调用失败: {result}")
+                failed = True
+            if failed and next_index < len(endpoints):
+                launch()
+        return result
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def format_endpoint_stats(config: dict) -> str:
+    """格式化端点列表和延迟统计"""
+    endpoints = get_endpoints(config)
+    if not endpoints:
+        return "⚠️ 请先配置API\n\n使用命令: ,ais set <api_url> <api_key>"
+
+    lines = ["🛰 API 端点（按优先级）\n"]
+    for index, endpoint in enumerate(endpoints, start=1):
+        health = get_endpoint_health(endpoint["name"])
+        ewma = f"{health.ewma:.1f}s" if health.ewma is not None else "暂无"
+        p95 = health.p95()
+        p95_text = f"{p95:.1f}s" if p95 is not None else "样本不足"
+        status = "❄️ 冷却中" if health.is_cooling() else "✅ 正常"
+        lines.append(f"{index}. {endpoint['name']}（{status}）")
+        lines.append(f"   {endpoint['api_url']}")
+        if endpoint["models"]:
+            mapping = ", ".join(f"{key}→{value}" for key, value in endpoint["models"].items())
+            lines.append(f"   模型映射：{mapping}")
+        lines.append(
+            f"   延迟 EWMA {ewma} / p95 {p95_text}，"
+            f"成功 {health.successes} 次，失败 {health.failures} 次"
+        )
+    lines.append(
+        "\n命令示例：\n"
+        "  ,ais endpoint add backup https://example.com/v1/chat/completions sk-xxx gpt-4o=gpt-4o-mini\n"
+        "  ,ais endpoint del backup"
+    )
+    return "\n".join(lines)
+
+
+async def handle_endpoint_command(message: Message, text: str):
+    """处理备用端点管理命令"""
+    parts = text.split()
+    action = parts[1].lower() if len(parts) > 1 else "list"
+    config = load_config()
+
+    if action == "add":
+        if len(parts) < 5:
+            await message.edit(
+                "❌ 格式错误\n\n"
+                "正确格式: ,ais endpoint add <名称> <api_url> <api_key> [模型=端点模型 ...]"
+            )
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
+        name, api_url, api_key = parts[2], parts[3], parts[4]
+        models = {}
+        for item in parts[5:]:
+            if "=" in item:
+                key, value = item.split("=", 1)
+                if key and value:
+                    models[key] = value
+
+        if name == "main" or any(item["name"] == name for item in config["endpoints"]):
+            await message.edit(f"⚠️ 端点 '{name}' 已存在")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
+        config["endpoints"].append(
+            {"name": name, "api_url": api_url, "api_key": api_key, "models": models}
+        )
+        if await save_config(config):
+            await message.edit(f"✅ 已添加备用端点: {name}")
+        else:
+            await message.edit("❌ 保存配置失败")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    if action in ("del", "delete", "rm"):
+        name = parts[2] if len(parts) > 2 else ""
+        endpoints = [item for item in config["endpoints"] if item["name"] != name]
+        if not name or len(endpoints) == len(config["endpoints"]):
+            await message.edit(f"⚠️ 备用端点 '{name}' 不存在")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
+        config["endpoints"] = endpoints
+        ENDPOINT_HEALTH.pop(name, None)
+        if await save_config(config):
+            await message.edit(f"✅ 已删除备用端点: {name}")
+        else:
+            await message.edit("❌ 保存配置失败")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    await message.edit(format_endpoint_stats(config))
+
+
+# ============================================================================
+# 调用统计
+# ============================================================================
+
+# 每条记录: [时间戳, 用途, 模型, 端点, 延迟秒, 提示 token, 生成 token, 结果]
+CALL_RECORDS: deque = deque(maxlen=CALL_STATS_WINDOW)
+_call_stats_loaded = False
+
+
+def classify_call_outcome(result: Optional[str]) -> str:
+    """把调用结果归类为 ok / timeout / error"""
+    if is_ai_success(result):
+        return "ok"
+    if result == "请求超时":
+        return "timeout"
+    return "error"
+
+
+def load_call_stats():
+    """首次使用时从磁盘加载调用记录"""
+    global _call_stats_loaded
+
+    if _call_stats_loaded:
+        return
+    _call_stats_loaded = True
+
+    if not CALL_STATS_FILE.exists():
+        return
+    try:
+        data = json.loads(CALL_STATS_FILE.read_text(encoding="utf-8"))
+        CALL_RECORDS.extend(data.get("records", []))
+    except Exception as e:
+        logs.warning(f"加载调用统计失败: {e}")
+
+
+def record_call(
+    purpose: str,
+    model: str,
+    endpoint: str,
+    latency: float,
+    usage: dict,
+    outcome: str,
+):
+    """记录一次模型调用（路由 / 回答 / MCP）"""
+    load_call_stats()
+    CALL_RECORDS.append([
+        int(time.time()),
+        purpose,
+        model,
+        endpoint,
+        round(latency, 3),
+        usage.get("prompt_tokens"),
+        usage.get("completion_tokens"),
+        outcome,
+    ])
+    call_stats_writer.schedule()
+
+
+call_stats_writer = DebouncedJsonWriter(
+    CALL_STATS_FILE, lambda: {"records": list(CALL_RECORDS)}, "调用统计"
+)
+
+
+def percentile(values: list[float], ratio: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+def summarize_calls(records: list) -> str:
+    """汇总一组调用记录：延迟分位数、生成速度、失败率和平均 token"""
+    finished = [item for item in records if item[7] != "cancelled"]
+    succeeded = [item for item in finished if item[7] == "ok"]
+    cancelled = len(records) - len(finished)
+    failure_rate = f"{1 - len(succeeded) / len(finished):.0%}" if finished else "暂无"
+
+    text = f"调用 {len(finished)} 次，失败率 {failure_rate}"
+    if cancelled:
+        text += f"，对冲取消 {cancelled} 次"
+    if not succeeded:
+        return text
+
+    latencies = [item[4] for item in succeeded]
+    text += (
+        f"\n   延迟 p50 {percentile(latencies, 0.5):.1f}s / "
+        f"p95 {percentile(latencies, 0.95):.1f}s"
+    )
+    with_tokens = [item for item in succeeded if item[6]]
+    if with_tokens:
+        speed = sum(item[6] for item in with_tokens) / max(sum(item[4] for item in with_tokens), 0.001)
+        prompt_tokens = sum(item[5] or 0 for item in with_tokens) / len(with_tokens)
+        completion_tokens = sum(item[6] for item in with_tokens) / len(with_tokens)
+        text += (
+            f"\n   {speed:.1f} tokens/s，"
+            f"平均 token 提示 {prompt_tokens:.0f} / 生成 {completion_tokens:.0f}"
+        )
+    return text
+
+
+def format_call_stats(model: str = "") -> str:
+    """格式化调用统计；指定模型时按用途和端点细分"""
+    load_call_stats()
+    records = list(CALL_RECORDS)
+    if model:
+        records = [item for item in records if item[2] == model]
+    if not records:
+        return f"📊 暂无{model + ' 的' if model else ''}调用记录"
+
+    purpose_names = {"router": "路由", "answer": "回答", "mcp": "MCP"}
+    groups: dict[str, list] = {}
+    if model:
+        for item in records:
+            groups.setdefault(f"{purpose_names.get(item[1], item[1])} @ {item[3]}", []).append(item)
+        title = f"📊 调用统计：{model}（最近 {len(records)} 条）"
+    else:
+        for item in records:
+            groups.setdefault(item[2], []).append(item)
+        title = f"📊 调用统计（最近 {len(records)} 条，按模型）"
+
+    lines = [title, ""]
+    for name, items in sorted(groups.items(), key=lambda pair: -len(pair[1])):
+        lines.append(f"• {name}：{summarize_calls(items)}")
+    lines.append("\n命令示例：\n  ,ais stats\n  ,ais stats <模型名>")
+    return "\n".join(lines)
+
+
+async def request_answer(
+    message: Message,
+    config: dict,
+    model: str,
+    messages: list[dict],
+    header: str,
+    coalescer: Optional[EditCoalescer] = None,
+) -> Optional[str]:
+    """请求最终回答；开启流式时边生成边编辑消息（header 为预览时的前缀，coalescer 可由调用方提供）"""
+    if not config.get("stream"):
+        return await call_ai_hedged(config, model, messages)
+
+    # 流式回答已经开始显示内容，不做对冲，只在端点失败时依次改用下一个
+    if coalescer is None:
+        coalescer = EditCoalescer(message, header)
+    result = None
+    try:
+        for endpoint in order_endpoints(config):
+            coalescer.reset()
+            result = await call_endpoint(
+                endpoint, model, messages, on_delta=coalescer.update, purpose="answer"
+            )
+            if is_ai_success(result):
+                break
+        return result
+    finally:
+        await coalescer.close()
+
+
 @listener(command="ais", description="向AI模型提问", parameters="[文本]")
 async def ais_query(message: Message):
     """处理AI查询命令"""
@@ -739,6 +2306,9 @@ async def ais_query(message: Message):
 
 ⚙️ API 配置：
   ,ais set <api_url> <api_key>  - 设置API基础配置
+  ,ais endpoint            - 查看端点优先级与延迟统计
+  ,ais endpoint add <名称> <api_url> <api_key> [模型=端点模型 ...]  - 添加备用端点
+  ,ais endpoint del <名称> - 删除备用端点
 
 🤖 模型管理：
   ,ais models              - 查看/切换模型
@@ -750,6 +2320,28 @@ async def ais_query(message: Message):
   ,ais search on           - 开启搜索增强
   ,ais search off          - 关闭搜索增强
   ,ais search max <数量>   - 设置搜索结果条数（1-8）
+  ,ais search clear        - 清空搜索结果缓存
+
+💾 回答缓存：
+  ,ais nocache <文本>      - 跳过缓存重新提问
+  ,ais cache               - 查看回答缓存命中率
+  ,ais cache clear         - 清空回答缓存
+
+📡 流式回答：
+  ,ais stream on/off       - 开启/关闭流式回答（边生成边显示）
+
+⚡ 推测式路由：
+  ,ais speculative on/off  - 路由判断期间提前开始回答和搜索，省去一次模型往返
+
+🧠 本地路由：
+  ,ais router              - 查看本地搜索路由分类器统计（一致率、省去的调用）
+  ,ais router reset        - 重置本地路由模型
+
+📊 调用统计：
+  ,ais stats [模型]        - 查看各模型延迟 p50/p95、生成速度和失败率
+
+🔗 网络：
+  ,ais pool                - 查看 HTTP 连接池复用统计
 
 {'🔌 MCP 管理：' if HAS_MCP else ''}
 {'  ,ais mcp list          - 列出所有MCP服务器' if HAS_MCP else ''}
@@ -824,11 +2416,7 @@ async def ais_query(message: Message):
         sent_msg = await message.edit(help_text)
 
         # 记录待选择的消息
-        chat_id = str(message.chat.id)
-        PENDING_SELECTION[chat_id] = {
-            "models": models,
-            "message_id": sent_msg.id,
-        }
+        register_selection(message.chat.id, sent_msg.id, models)
         return
 
     # 检查是否是model子命令
@@ -871,7 +2459,7 @@ async def ais_query(message: Message):
             if len(models) == 1:
                 config["current_model"] = model_name
 
-            if save_config(config):
+            if await save_config(config):
                 await message.edit(
                     f"✅ 成功添加模型: {model_name}\n\n"
                     f"📋 当前模型列表：\n" + "\n".join([f"  • {m}" for m in models])
@@ -915,7 +2503,7 @@ async def ais_query(message: Message):
             if config.get("current_model") == model_name:
                 config["current_model"] = models[0]
 
-            if save_config(config):
+            if await save_config(config):
                 await message.edit(
                     f"✅ 已删除模型: {model_name}\n\n"
                     f"📋 当前模型列表：\n" + "\n".join([f"  • {m}" for m in models])
@@ -945,6 +2533,42 @@ async def ais_query(message: Message):
         await handle_mcp_command(message, text.strip())
         return
 
+    # 检查是否是流式回答开关命令
+    if text.strip().lower().startswith("stream"):
+        await handle_stream_command(message, text.strip())
+        return
+
+    # 检查是否是推测式路由开关命令
+    if text.strip().lower().startswith("speculative"):
+        await handle_speculative_command(message, text.strip())
+        return
+
+    # 检查是否是调用统计命令
+    if text.strip().lower() == "stats" or text.strip().lower().startswith("stats "):
+        parts = text.strip().split(maxsplit=1)
+        await message.edit(format_call_stats(parts[1] if len(parts) > 1 else ""))
+        return
+
+    # 检查是否是备用端点命令
+    if text.strip().lower() == "endpoint" or text.strip().lower().startswith("endpoint "):
+        await handle_endpoint_command(message, text.strip())
+        return
+
+    # 检查是否是回答缓存命令
+    if text.strip().lower() == "cache" or text.strip().lower().startswith("cache "):
+        await handle_cache_command(message, text.strip())
+        return
+
+    # 检查是否是本地路由统计命令
+    if text.strip().lower().startswith("router"):
+        await handle_router_command(message, text.strip())
+        return
+
+    # 检查是否是连接池统计命令
+    if text.strip().lower() == "pool":
+        await message.edit(format_http_stats())
+        return
+
     # 检查是否是搜索增强配置命令
     if text.strip().lower().startswith("search"):
         await handle_search_command(message, text.strip())
@@ -973,6 +2597,7 @@ async def ais_query(message: Message):
         # 保存API配置，保留现有的模型配置
         config["api_url"] = api_url
         config["api_key"] = api_key
+        ENDPOINT_HEALTH.pop("main", None)
 
         # 如果没有模型列表，使用model字段作为当前模型
         if "model" in config and "models" not in config:
@@ -980,7 +2605,7 @@ async def ais_query(message: Message):
             config["current_model"] = config["model"]
             del config["model"]
 
-        if save_config(config):
+        if await save_config(config):
             current_model = get_current_model(config)
             await message.edit(
                 f"✅ API配置保存成功！\n\n"
@@ -996,6 +2621,17 @@ async def ais_query(message: Message):
         await message.delete()
         return
 
+    # nocache 前缀：跳过回答缓存，重新获取回答
+    use_cache = True
+    if text.strip().lower().split(maxsplit=1)[0] == "nocache":
+        use_cache = False
+        text = text.strip()[len("nocache"):].strip()
+        if not text:
+            await message.edit("请输入文本\n\n示例：,ais nocache 今天有什么新闻")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
     # 加载配置
     config = load_config()
 
@@ -1029,20 +2665,36 @@ async def ais_query(message: Message):
         "reason": "",
         "search_queries": [],
     }
+    direct_task = None  # 推测式路由提前开始的直接回答
+    direct_preview = None  # 直接回答的流式预览（确定使用直接回答前暂停）
+
+    # 相同问题在有效期内直接返回缓存的回答，省去路由、搜索和回答调用
+    cached_answer = get_cached_answer(current_model, text) if use_cache else None
+    if cached_answer is not None:
+        await message.edit(format_answer_cached(cached_answer, current_model))
+        return
 
     if search_config.get("enabled", True):
+        # 路由模型思考期间，预先建立到搜索引擎的连接
+        warm_up_host(DUCKDUCKGO_URL)
         await message.edit(
             f"🧭 正在分析问题并决定是否联网搜索...\n\n问题：{text}\n模型：{current_model}"
         )
-        search_plan = await decide_search_plan(
-            api_url=config["api_url"],
-            api_key=config["api_key"],
-            model=current_model,
-            question=text,
-            search_config=search_config,
-        )
+        if config["speculative"]:
+            direct_preview = EditCoalescer(message, f"🤖 AI 回复（{current_model}）：\n\n", paused=True)
+            search_plan, search_results, search_query, direct_task = await speculative_route(
+                config, current_model, text, search_config, direct_preview
+            )
+        else:
+            search_plan = await decide_search_plan(
+                config=config,
+                model=current_model,
+                question=text,
+                search_config=search_config,
+            )
 
-    if search_plan["use_search"]:
+    # 推测式路由已经完成了搜索（或保留了直接回答），不再重复搜索
+    if search_plan["use_search"] and direct_task is None and not search_results:
         await message.edit(
             f"🌐 正在联网搜索...\n\n问题：{text}\n"
             f"意图：{search_plan['intent'] or '自动识别'}\n"
@@ -1055,25 +2707,33 @@ async def ais_query(message: Message):
         )
 
     if search_results:
+        # 搜索结果与之前相同时复用当时的回答
+        cached_answer = get_cached_answer(current_model, text, search_results) if use_cache else None
+        if cached_answer is not None:
+            await message.edit(format_answer_cached(cached_answer, current_model))
+            return
+
         await message.edit(
             f"🌐 已获取 {len(search_results)} 条搜索结果，正在整理回答...\n\n"
             f"问题：{text}\n"
             f"意图：{search_plan['intent'] or '自动识别'}\n"
             f"搜索词：{search_query}\n模型：{current_model}"
         )
-        result = await call_ai_api(
-            api_url=config["api_url"],
-            api_key=config["api_key"],
-            model=current_model,
-            messages=build_search_answer_messages(
+        result = await request_answer(
+            message,
+            config,
+            current_model,
+            build_search_answer_messages(
                 text,
                 search_results,
                 search_query,
                 search_plan["intent"],
             ),
+            f"🌐 搜索增强回复（{current_model}）：\n\n",
         )
 
         if is_ai_success(result):
+            store_answer_cache(current_model, text, search_results, result)
             await message.edit(
                 f"🌐 搜索增强回复（{current_model}）：\n\n{result}"
             )
@@ -1091,25 +2751,42 @@ async def ais_query(message: Message):
                 await message.edit(
                     f"🔌 搜索结果不足，正在通过 MCP 补充处理...\n\n问题：{text}"
                 )
-                mcp_result = await client.smart_call(text)
+                mcp_started = time.monotonic()
+                try:
+                    mcp_result = await client.smart_call(text)
+                finally:
+                    record_call(
+                        "mcp", current_model, "mcp", time.monotonic() - mcp_started,
+                        {}, "ok" if mcp_result else "error",
+                    )
         except Exception as e:
             logs.warning(f"MCP 调用失败，降级到 API: {e}")
             mcp_result = None
 
     if mcp_result:
+        if direct_task is not None:
+            direct_task.cancel()
         await message.edit(f"🔌 MCP 回复：\n\n{mcp_result}")
         return
 
     await message.edit(f"🤖 正在向AI提问...\n\n问题：{text}\n\n模型：{current_model}")
 
-    result = await call_ai_api(
-        api_url=config["api_url"],
-        api_key=config["api_key"],
-        model=current_model,
-        messages=build_direct_answer_messages(text),
-    )
+    if direct_task is not None:
+        direct_preview.resume()
+        result = await direct_task
+    else:
+        result = await request_answer(
+            message,
+            config,
+            current_model,
+            build_direct_answer_messages(text),
+            f"🤖 AI 回复（{current_model}）：\n\n",
+        )
 
     if is_ai_success(result):
+        # 路由判断需要搜索但搜索失败时的降级回答不缓存，否则一整天都会跳过搜索
+        if not search_plan["use_search"]:
+            store_answer_cache(current_model, text, [], result)
         await message.edit(f"🤖 AI 回复（{current_model}）：\n\n{result}")
     else:
         await message.edit("❌ AI回复获取失败，请检查配置或网络连接")
@@ -1118,17 +2795,16 @@ async def ais_query(message: Message):
 @listener(incoming=True, outgoing=True)
 async def model_selection_handler(message: Message):
     """监听模型选择回复"""
-    # 只处理回复消息
-    if not message.reply_to_message:
+    # 只处理回复了待选择模型列表的消息，其余消息只需一次字典查找
+    reply_id = getattr(message, "reply_to_message_id", None)
+    if not reply_id or not PENDING_SELECTION:
         return
 
-    chat_id = str(message.chat.id)
-
-    # 检查是否有待处理的模型选择
-    if chat_id not in PENDING_SELECTION:
+    key = (message.chat.id, reply_id)
+    selection_data = get_selection(*key)
+    if selection_data is None or not message.reply_to_message:
         return
 
-    selection_data = PENDING_SELECTION[chat_id]
     models = selection_data["models"]
 
     # 获取用户输入的序号
@@ -1139,41 +2815,37 @@ async def model_selection_handler(message: Message):
         return
 
     choice = int(user_text)
+    # 清理待选择状态（先移除，避免连续回复被重复处理）
+    PENDING_SELECTION.pop(key, None)
 
     if choice < 1 or choice > len(models):
         await message.reply_to_message.edit(
             f"❌ 无效序号，请输入 1-{len(models)} 之间的数字"
         )
-        # 清理待选择状态
-        del PENDING_SELECTION[chat_id]
         await message.delete()
         return
 
     # 获取选择的模型
     selected_model = models[choice - 1]
-    current_model = get_current_model(load_config())
+    config = load_config()
+    current_model = get_current_model(config)
 
     # 如果选择的是当前模型
     if selected_model == current_model:
         await message.reply_to_message.edit(f"🤖 当前已是模型: **{selected_model}**")
-        # 清理待选择状态
-        del PENDING_SELECTION[chat_id]
         await message.delete()
         return
 
     # 更新配置
-    config = load_config()
     config["current_model"] = selected_model
 
-    if save_config(config):
+    if await save_config(config):
         await message.reply_to_message.edit(
             f"✅ 已切换到模型: **{selected_model}**\n\n(原模型: {current_model})"
         )
     else:
         await message.reply_to_message.edit("❌ 切换失败")
 
-    # 清理待选择状态
-    del PENDING_SELECTION[chat_id]
     await message.delete()
 
 
@@ -17,12 +17,21 @@
 """
 
 import asyncio
+import hashlib
+import heapq
 import json
+import math
+import os
 import random
 import re
+import struct
+import sys
+import time
+from array import array
+from contextvars import ContextVar
 from pathlib import Path
 from typing import Dict, Optional, Set, List
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 
 from pagermaid.listener import listener
 from pagermaid.hook import Hook
@@ -33,6 +42,8 @@ from pagermaid.utils import logs
 # 配置文件路径
 plugin_dir = Path(__file__).parent
 config_file = plugin_dir / "luckydraw_config.json"
+activity_file = plugin_dir / "luckydraw_activity.bin"
+state_file = plugin_dir / "luckydraw_state.json"
 
 # 脚本检测关键词（出现这些词则不触发）
 SCRIPT_DETECTION_KEYWORDS = [
@@ -90,6 +101,9 @@ DEFAULT_DELAY = 0.0  # 秒
 # 红包个数阈值：小于此值直接发送关键词，大于等于此值用转发逻辑
 REDPACKET_COUNT_THRESHOLD = 5
 
+# 按钮回调应答等待时间（秒）- 默认值，可通过 ldraw clicktimeout 修改
+DEFAULT_BUTTON_ANSWER_TIMEOUT = 3.0
+
 # 默认抽奖机器人ID白名单（首次使用时写入配置文件）
 DEFAULT_BOT_WHITELIST: Set[int] = {
     6461022460,  # 抽奖机器人
@@ -100,18 +114,243 @@ CONFIG_FLUSH_INTERVAL = 3.0  # 秒：多久强制刷盘一次
 CONFIG_FLUSH_MAX_PENDING = 50  # 积累多少条变更后立即刷盘
 # ==========================================
 
+# ========== 性能防护：正则解析预算 ==========
+PARSE_MAX_INPUT_LENGTH = 4096  # 单条消息参与解析的最大字符数（Telegram 单条消息上限）
+PARSE_TIME_BUDGET = 0.05  # 秒：单条消息累计正则耗时上限，超出后放弃剩余解析
+PARSE_SLOW_THRESHOLD = 0.005  # 秒：单次匹配超过此耗时记入慢输入榜
+PARSE_SLOW_LOG_SIZE = 10  # 慢输入榜保留条数
+PARSE_BENCH_SIZES = (256, 512, 1024, 2048, 4096)  # 压测输入长度梯度
+PARSE_BENCH_SAMPLES = 20  # 每个长度生成的随机样本数
+PARSE_BENCH_MAX_EXPONENT = 1.5  # 最坏耗时增长指数超过此值视为超线性
+# ==========================================
+
+# ========== 性能优化：机器人解析画像 ==========
+PROFILE_DECAY = 0.9  # 每次命中时旧分数的衰减系数
+PROFILE_MIN_SCORE = 0.05  # 分数低于此值的规则从画像中移除
+# ==========================================
+
+# ========== 性能优化：编辑消息增量处理 ==========
+MESSAGE_DIGEST_CACHE_SIZE = 2000  # 最多缓存多少条消息的内容摘要
+# ==========================================
+
+# ========== 红包剩余个数跟踪 ==========
+TRACKER_MAX_PACKETS = 500  # 最多同时跟踪多少个红包
+TRACKER_PACKET_TTL = 3600.0  # 秒：超过此时间未更新的红包不再跟踪
+TRACKER_RATE_ALPHA = 0.3  # 群组领取速度 EWMA 平滑系数
+# ==========================================
+
+# ========== 群组活跃度小时汇总 ==========
+ACTIVITY_METRICS = ("detected", "joined", "blocked", "forwarded", "clicked", "won")
+ACTIVITY_METRIC_NAMES = {
+    "detected": "检测",
+    "joined": "参与",
+    "blocked": "拦截",
+    "forwarded": "转发",
+    "clicked": "点击",
+    "won": "中奖",
+}
+ACTIVITY_DAYS = 30  # 保留天数
+ACTIVITY_SLOTS = ACTIVITY_DAYS * 24  # 环形数组槽位数（每小时一个）
+ACTIVITY_FILE_MAGIC = b"LDA1"
+# ==========================================
+
+# ========== 期望价值调度 ==========
+SEND_POLICIES = ("fifo", "ev")  # fifo: 按到达顺序发送（默认）；ev: 按期望价值排序并受发送预算约束
+SEND_BUDGET_WINDOW = 60.0  # 秒：发送预算统计窗口
+SEND_BUDGET_PER_CHAT = 5  # 每个群组窗口内最多发送次数
+SEND_BUDGET_GLOBAL = 20  # 所有群组窗口内最多发送次数
+SCHEDULER_BATCH_WINDOW = 0.3  # 秒：收集同一批候选的时间，之后按期望价值依次放行
+SCHEDULER_POLL_INTERVAL = 0.5  # 秒：预算耗尽时重新检查的间隔
+SCHEDULER_MAX_WAIT = 30.0  # 秒：候选最多等待多久，超时丢弃
+DEFAULT_DRAW_AMOUNT = 1.0  # 无法解析总额时的默认金额
+# ==========================================
+
+# ========== 影子模式（容量评估） ==========
+SHADOW_RECENT_SIZE = 10  # 每个群组保留最近多少条"本应发送"记录
+SHADOW_DIGEST_CACHE_SIZE = 1000  # 影子模式独立的消息摘要缓存条数（不占用实际流程的缓存）
+SHADOW_SENT_KEEP = 500  # 每个群组记住多少个"本应已发送"的口令，用于与实际流程一致地去重
+# ==========================================
+
+# ========== 热重启：内存状态快照 ==========
+PENDING_DRAW_TTL = 600.0  # 秒：等待转发的口令超过此时间仍无人回复视为过期
+STATE_DEDUPE_TTL = 3600.0  # 秒：快照中的去重记录和消息摘要在此时间内恢复有效
+STATE_DEDUPE_KEEP = 200  # 快照中每个群组保留的去重记录数
+STATE_DIGEST_KEEP = 500  # 快照中保留的消息摘要条数
+# ==========================================
+
+# ========== 决策追踪 ==========
+TRACE_SIZE = 200  # 每个群组保留的决策事件条数（环形缓冲区）
+TRACE_MAX_CHATS = 100  # 最多为多少个群组保留决策事件
+TRACE_DEFAULT_COUNT = 20  # ,ldraw trace 默认显示条数
+# ==========================================
+
+# ========== 负载保护：事件循环延迟降级 ==========
+LAG_PROBE_INTERVAL = 0.5  # 秒：事件循环延迟探测间隔
+LAG_DECAY = 0.7  # 延迟回落时旧值的衰减系数（上升立即生效）
+# 各低优先级环节的默认降级阈值（秒）：测得延迟超过阈值时跳过该环节
+# debug: 测试群组调试日志 | sticker: 中奖庆祝贴纸 | edit: 口令区域变化的编辑重新解析
+SHED_DEFAULT_THRESHOLDS: Dict[str, float] = {
+    "debug": 0.05,
+    "sticker": 0.2,
+    "edit": 0.5,
+}
+SHED_STAGE_NAMES = {
+    "debug": "测试群组调试日志",
+    "sticker": "中奖庆祝贴纸",
+    "edit": "编辑消息重新解析",
+}
+# ==========================================
+
+
+class ActivityRollups:
+    """
+    群组活跃度小时汇总
+    每个群组两段定长环形数组（array 紧凑存储无符号整数）：
+    - hours: 每个槽位当前对应的小时编号（Unix 时间 // 3600），用于识别过期槽位
+    - counts: 每个槽位的各项计数，按 ACTIVITY_METRICS 顺序连续存放
+    持久化为紧凑二进制文件，随配置一起批量刷盘
+    """
+
+    _HEADER = struct.Struct("<4sI")  # 魔数, 群组数
+    _CHAT = struct.Struct("<q")  # 群组ID
+
+    def __init__(self):
+        self.hours: Dict[int, array] = {}  # {chat_id: array('I', 槽位小时编号)}
+        self.counts: Dict[int, array] = {}  # {chat_id: array('I', 槽位计数)}
+        self.dirty: bool = False
+        self.load()
+
+    def _ensure_chat(self, chat_id: int) -> None:
+        if chat_id not in self.hours:
+            self.hours[chat_id] = array("I", bytes(4 * ACTIVITY_SLOTS))
+            self.counts[chat_id] = array("I", bytes(4 * ACTIVITY_SLOTS * len(ACTIVITY_METRICS)))
+
+    def record(self, chat_id: int, metric: str, amount: int = 1) -> None:
+        """给群组当前小时的某项计数加一"""
+        hour = int(time.time() // 3600)
+        slot = hour % ACTIVITY_SLOTS
+        width = len(ACTIVITY_METRICS)
+        self._ensure_chat(chat_id)
+        hours = self.hours[chat_id]
+        counts = self.counts[chat_id]
+        if hours[slot] != hour:
+            # 槽位属于 30 天前的同一时刻，清零后复用
+            hours[slot] = hour
+            for i in range(slot * width, slot * width + width):
+                counts[i] = 0
+        counts[slot * width + ACTIVITY_METRICS.index(metric)] += amount
+        self.dirty = True
+
+    def aggregate(self, chat_id: int, days: int) -> Dict[str, int]:
+        """汇总群组最近 days 天的各项计数"""
+        totals = dict.fromkeys(ACTIVITY_METRICS, 0)
+        hours = self.hours.get(chat_id)
+        if hours is None:
+            return totals
+        counts = self.counts[chat_id]
+        width = len(ACTIVITY_METRICS)
+        now_hour = int(time.time() // 3600)
+        oldest_hour = now_hour - max(1, min(days, ACTIVITY_DAYS)) * 24
+        sums = [0] * width
+        for slot, hour in enumerate(hours):
+            if oldest_hour < hour <= now_hour:
+                base = slot * width
+                for i in range(width):
+                    sums[i] += counts[base + i]
+        for metric, value in zip(ACTIVITY_METRICS, sums):
+            totals[metric] = value
+        return totals
+
+    def get_report(self, chat_id: int, days: int) -> str:
+        """获取群组最近 days 天的活跃度报告"""
+        start = time.perf_counter()
+        totals = self.aggregate(chat_id, days)
+        elapsed_us = (time.perf_counter() - start) * 1_000_000
+
+        output = f"**群组 `{chat_id}` 最近 {days} 天活跃度：**\n\n"
+        for metric in ACTIVITY_METRICS:
+            output += f"- {ACTIVITY_METRIC_NAMES[metric]}: `{totals[metric]}` 次\n"
+        if totals["detected"]:
+            output += f"\n参与率: `{totals['joined'] / totals['detected']:.0%}`"
+        if totals["joined"]:
+            output += f" | 中奖率: `{totals['won'] / totals['joined']:.0%}`"
+        output += f"\n\n_汇总耗时 {elapsed_us:.0f}µs_"
+        return output
+
+    def load(self) -> None:
+        """从二进制文件加载"""
+        if not activity_file.exists():
+            return
+        try:
+            data = activity_file.read_bytes()
+            magic, chat_count = self._HEADER.unpack_from(data, 0)
+            if magic != ACTIVITY_FILE_MAGIC:
+                logs.warning("[LuckyDraw] 活跃度文件格式不匹配，已忽略")
+                return
+            offset = self._HEADER.size
+            hours_size = 4 * ACTIVITY_SLOTS
+            counts_size = hours_size * len(ACTIVITY_METRICS)
+            for _ in range(chat_count):
+                (chat_id,) = self._CHAT.unpack_from(data, offset)
+                offset += self._CHAT.size
+                hours = array("I", data[offset:offset + hours_size])
+                offset += hours_size
+                counts = array("I", data[offset:offset + counts_size])
+                offset += counts_size
+                if sys.byteorder == "big":
+                    hours.byteswap()
+                    counts.byteswap()
+                self.hours[chat_id] = hours
+                self.counts[chat_id] = counts
+        except Exception as e:
+            logs.error(f"[LuckyDraw] 加载活跃度数据失败: {e}")
+            self.hours = {}
+            self.counts = {}
+
+    def save(self) -> None:
+        """写入二进制文件（小端序）"""
+        if not self.dirty:
+            return
+        try:
+            chunks = [self._HEADER.pack(ACTIVITY_FILE_MAGIC, len(self.hours))]
+            for chat_id, hours in self.hours.items():
+                counts = self.counts[chat_id]
+                if sys.byteorder == "big":
+                    hours, counts = array("I", hours), array("I", counts)
+                    hours.byteswap()
+                    counts.byteswap()
+                chunks.append(self._CHAT.pack(chat_id))
+                chunks.append(hours.tobytes())
+                chunks.append(counts.tobytes())
+            activity_file.write_bytes(b"".join(chunks))
+            self.dirty = False
+        except Exception as e:
+            logs.error(f"[LuckyDraw] 保存活跃度数据失败: {e}")
+
+
+# 全局活跃度汇总实例
+activity = ActivityRollups()
+
 
 class LuckyDrawConfig:
     """自动抽奖配置管理类"""
 
     def __init__(self):
         self.enabled_chats: Set[int] = set()  # 启用功能的群组ID集合
-        self.test_chats: Set[int] = set()  # 测试群组（输出详细日志）
+        self.test_chats: Set[int] = set()  # 测试群组（决策追踪同时输出到日志）
         self.sent_keywords: Dict[str, list] = {}  # 已发送的口令 {群组ID: [口令1, 口令2, ...]}
         self.sent_messages: Set[str] = set()  # 已处理的消息ID {群组ID_消息ID}
         self.chat_delays: Dict[str, dict] = {}  # 群组延时配置 {群组ID: {"min": min_delay, "max": max_delay}}
         self.bot_whitelist: Set[int] = set()  # 抽奖机器人白名单
         self.celebration_stickers: Set[str] = set()  # 中奖庆祝贴纸 file_unique_id 集合
+        self.button_answer_timeout: float = DEFAULT_BUTTON_ANSWER_TIMEOUT  # 按钮回调应答等待时间（秒）
+        self.send_policy: str = "fifo"  # 发送调度策略（fifo / ev）
+        self.shadow_chats: Set[int] = set()  # 影子模式群组（只跑检测流程，不发送）
+        self.shadow_all: bool = False  # 是否对所有未启用的群组运行影子模式
+        self.shed_thresholds: Dict[str, float] = dict(SHED_DEFAULT_THRESHOLDS)  # 负载降级阈值（秒）
+        self.parser_profiles: Dict[str, Dict[str, Dict[str, float]]] = {}  # 机器人解析画像 {机器人ID: {类别: {规则: 分数}}}
+        self.profile_first_hits: int = 0  # 画像首选规则直接命中次数（进程内）
+        self.profile_fallbacks: int = 0  # 画像未命中、回退完整规则链次数（进程内）
         self.stats: Dict[str, int] = {
             "total_detected": 0,  # 检测到的抽奖次数
             "total_joined": 0,    # 成功参与的次数
@@ -142,6 +381,12 @@ class LuckyDrawConfig:
                     self.chat_delays = data.get("chat_delays", {})
                     self.bot_whitelist = set(data.get("bot_whitelist", DEFAULT_BOT_WHITELIST))
                     self.celebration_stickers = set(data.get("celebration_stickers", []))
+                    self.parser_profiles = data.get("parser_profiles", {})
+                    self.button_answer_timeout = data.get("button_answer_timeout", DEFAULT_BUTTON_ANSWER_TIMEOUT)
+                    self.send_policy = data.get("send_policy", "fifo")
+                    self.shadow_chats = set(data.get("shadow_chats", []))
+                    self.shadow_all = bool(data.get("shadow_all", False))
+                    self.shed_thresholds.update(data.get("shed_thresholds", {}))
                     self.stats = data.get("stats", self.stats)
             except Exception as e:
                 logs.error(f"[LuckyDraw] 加载配置失败: {e}")
@@ -211,6 +456,7 @@ class LuckyDrawConfig:
         
         # 实际写入磁盘
         self._do_save()
+        activity.save()
     
     def _do_save(self) -> bool:
         """实际执行磁盘写入（同步）"""
@@ -225,6 +471,12 @@ class LuckyDrawConfig:
                         "chat_delays": self.chat_delays,
                         "bot_whitelist": list(self.bot_whitelist),
                         "celebration_stickers": list(self.celebration_stickers),
+                        "parser_profiles": self.parser_profiles,
+                        "button_answer_timeout": self.button_answer_timeout,
+                        "send_policy": self.send_policy,
+                        "shadow_chats": list(self.shadow_chats),
+                        "shadow_all": self.shadow_all,
+                        "shed_thresholds": self.shed_thresholds,
                         "stats": self.stats,
                     },
                     f,
@@ -261,6 +513,12 @@ class LuckyDrawConfig:
         """检查群组是否启用功能"""
         return chat_id in self.enabled_chats
 
+    def is_shadow_chat(self, chat_id: int) -> bool:
+        """检查群组是否运行影子模式（仅对未启用的群组生效）"""
+        if chat_id in self.enabled_chats:
+            return False
+        return chat_id in self.shadow_chats or (self.shadow_all and chat_id < 0)
+
     def is_test_chat(self, chat_id: int) -> bool:
         """检查是否为测试群组"""
         return chat_id in self.test_chats
@@ -324,6 +582,30 @@ class LuckyDrawConfig:
             output += f"- 群组 `{chat_id}`: {delay['min']}~{delay['max']} 秒\n"
         return output
 
+    def set_button_answer_timeout(self, timeout: float) -> str:
+        """设置按钮回调应答等待时间"""
+        self.button_answer_timeout = max(0.5, min(timeout, 30.0))
+        self.save()
+        return f"已设置按钮回调应答等待时间为 {self.button_answer_timeout} 秒"
+
+    def set_send_policy(self, policy: str) -> str:
+        """设置发送调度策略"""
+        if policy not in SEND_POLICIES:
+            return f"未知策略 `{policy}`，可选: {', '.join(SEND_POLICIES)}"
+        self.send_policy = policy
+        self.save()
+        return f"已设置发送调度策略为 `{policy}`"
+
+    def set_shed_threshold(self, stage: str, threshold: float) -> str:
+        """设置负载降级阈值（秒）"""
+        if stage not in SHED_DEFAULT_THRESHOLDS:
+            return f"未知环节 `{stage}`，可选: {', '.join(SHED_DEFAULT_THRESHOLDS)}"
+        if threshold <= 0:
+            return "阈值必须大于 0"
+        self.shed_thresholds[stage] = threshold
+        self.save()
+        return f"已设置 {SHED_STAGE_NAMES[stage]} 的降级阈值为 {threshold * 1000:.0f}ms"
+
     def has_sent_keyword(self, chat_id: int, keyword: str) -> bool:
         """检查口令是否已发送（同时检查内存和待刷新状态）"""
         key = str(chat_id)
@@ -459,6 +741,52 @@ class LuckyDrawConfig:
             return None
         return random.choice(list(self.celebration_stickers))
 
+    # ========== 机器人解析画像 ==========
+
+    def get_parser_order(self, sender_id: Optional[int], kind: str) -> List[str]:
+        """获取机器人在某类解析（text/block/format）下按分数排序的规则列表"""
+        profile = self.parser_profiles.get(str(sender_id), {}).get(kind)
+        if not profile:
+            return []
+        return sorted(profile, key=profile.get, reverse=True)
+
+    def record_parser_hit(self, sender_id: Optional[int], kind: str, rule: str) -> None:
+        """记录一次规则命中：旧分数衰减后给命中规则加一分"""
+        if sender_id is None:
+            return
+        order = self.get_parser_order(sender_id, kind)
+        if order:
+            if order[0] == rule:
+                self.profile_first_hits += 1
+            else:
+                self.profile_fallbacks += 1
+
+        profile = self.parser_profiles.setdefault(str(sender_id), {}).setdefault(kind, {})
+        for key in list(profile):
+            profile[key] *= PROFILE_DECAY
+            if profile[key] < PROFILE_MIN_SCORE and key != rule:
+                del profile[key]
+        profile[rule] = profile.get(rule, 0.0) + 1.0
+        # 每条机器人消息都会命中规则，这里只标记有变更，随下次正常保存或卸载时写盘
+        self._pending_save = True
+
+    def list_parser_profiles(self) -> str:
+        """列出所有机器人的解析画像"""
+        if not self.parser_profiles:
+            return "暂无机器人解析画像\n\n💡 白名单机器人发布抽奖后会自动学习"
+
+        output = "**机器人解析画像：**\n\n"
+        for sender_id, kinds in self.parser_profiles.items():
+            output += f"- 机器人 `{sender_id}`\n"
+            for kind, profile in kinds.items():
+                top = sorted(profile.items(), key=lambda item: item[1], reverse=True)[:3]
+                rules = "，".join(f"{rule}({score:.1f})" for rule, score in top)
+                output += f"  {kind}: {rules}\n"
+        total = self.profile_first_hits + self.profile_fallbacks
+        if total:
+            output += f"\n首选规则命中率: `{self.profile_first_hits / total:.0%}` ({self.profile_first_hits}/{total})"
+        return output
+
     def get_stats(self) -> str:
         """获取统计信息"""
         output = "**统计信息：**\n\n"
@@ -468,19 +796,25 @@ class LuckyDrawConfig:
         output += f"- 安全拦截: `{self.stats['total_blocked']}` 次\n"
         return output
 
-    def increment_detected(self) -> None:
+    def increment_detected(self, chat_id: Optional[int] = None) -> None:
         """增加检测计数"""
         self._pending_stats_changes["total_detected"] = self._pending_stats_changes.get("total_detected", 0) + 1
-        self._schedule_flush()
+        self.record_activity(chat_id, "detected")
 
-    def increment_joined(self) -> None:
+    def increment_joined(self, chat_id: Optional[int] = None) -> None:
         """增加参与计数"""
         self._pending_stats_changes["total_joined"] = self._pending_stats_changes.get("total_joined", 0) + 1
-        self._schedule_flush()
+        self.record_activity(chat_id, "joined")
 
-    def increment_blocked(self) -> None:
+    def increment_blocked(self, chat_id: Optional[int] = None) -> None:
         """增加拦截计数"""
         self._pending_stats_changes["total_blocked"] = self._pending_stats_changes.get("total_blocked", 0) + 1
+        self.record_activity(chat_id, "blocked")
+
+    def record_activity(self, chat_id: Optional[int], metric: str) -> None:
+        """记录群组小时活跃度并安排刷盘"""
+        if chat_id is not None:
+            activity.record(chat_id, metric)
         self._schedule_flush()
 
 
@@ -498,15 +832,272 @@ keyword_locks: Dict[tuple, asyncio.Lock] = {}
 
 # ========== 性能优化：进程内消息去重 ==========
 # 用于快速判断消息是否已处理（进程内缓存，不依赖磁盘）
-_processed_messages: Dict[int, Set[str]] = defaultdict(set)  # {chat_id: {message_id1, message_id2, ...}}
+# OrderedDict 当作有序集合使用，裁剪和快照时按插入顺序保留最近的记录
+_processed_messages: Dict[int, "OrderedDict[str, None]"] = defaultdict(OrderedDict)  # {chat_id: {message_id1: None, ...}}
+
+
+def remember_processed(chat_id: int, key: str) -> None:
+    """记录到进程内去重缓存，超过 500 条时只保留最近的 200 条，防止内存泄漏"""
+    keys = _processed_messages[chat_id]
+    keys[key] = None
+    keys.move_to_end(key)
+    if len(keys) > 500:
+        while len(keys) > 200:
+            keys.popitem(last=False)
+# ==========================================
+
+# ========== 自己的用户 ID ==========
+# 首次用到时通过 get_me 获取后缓存（不会变化），回复转发和中奖庆祝共用
+_self_id: Optional[int] = None
+
+
+async def get_self_id(bot: Client) -> int:
+    """获取自己的用户 ID，只在第一次调用时请求 get_me"""
+    global _self_id
+    if _self_id is None:
+        _self_id = (await bot.get_me()).id
+    return _self_id
+# ==========================================
+
+
+# ========== 性能优化：编辑消息增量处理 ==========
+# 红包机器人会频繁编辑消息更新 "剩余X/Y个"，按内容摘要区分三种情况：
+# - 全文摘要不变：重复编辑，直接跳过
+# - 去掉计数后的摘要不变：只有计数变化，仅更新缓存中的个数
+# - 其他：口令区域有变化，走完整流程
+# {(chat_id, message_id): {"digest": str, "stable_digest": str, "keyword": str, "keyword_type": str, "count": int}}
+_message_digests: "OrderedDict[tuple, dict]" = OrderedDict()
+
+# 计数类字段（剩余2/3个、已领 1/10 等），计算稳定摘要时剔除
+_RE_VOLATILE_COUNTS = re.compile(r"\d+\s*/\s*\d+")
+# ==========================================
+
+
+# ========== 性能防护：正则解析预算 ==========
+
+
+class ParseBudgetExceeded(Exception):
+    """单条消息的累计正则耗时超出预算"""
+
+
+# 当前消息已消耗的正则耗时（每个处理器调用 begin_message 后独立计数）
+_parse_spent: ContextVar[Optional[List[float]]] = ContextVar("luckydraw_parse_spent", default=None)
+# 当前消息是否已计入截断数（同一条消息会被多个提取函数分别截断，只计一次）
+_parse_truncated: ContextVar[Optional[List[bool]]] = ContextVar("luckydraw_parse_truncated", default=None)
+
+
+class ParseGuard:
+    """
+    正则解析防护
+    - 输入长度上限：超长消息截断后再解析
+    - 时间预算：单条消息累计正则耗时超出预算时放弃剩余解析
+    - 慢输入记录：保留耗时最长的若干条输入，便于定位问题格式
+    """
+
+    def __init__(self):
+        self.patterns: List[tuple[str, re.Pattern]] = []  # 受保护的正则 [(名称, 正则)]
+        self.truncated_count: int = 0  # 被截断的消息数
+        self.exceeded_count: int = 0  # 超出时间预算的消息数
+        self._slowest: List[tuple[float, int, str, str]] = []  # 小顶堆 (耗时, 序号, 名称, 输入预览)
+        self._seq: int = 0
+
+    def register(self, name: str, pattern: re.Pattern) -> re.Pattern:
+        """登记一个受保护的正则（用于压测），原样返回"""
+        self.patterns.append((name, pattern))
+        return pattern
+
+    def clip(self, text: str) -> str:
+        """截断超长输入"""
+        if text and len(text) > PARSE_MAX_INPUT_LENGTH:
+            truncated = _parse_truncated.get()
+            if truncated is None:
+                self.truncated_count += 1
+            elif not truncated[0]:
+                truncated[0] = True
+                self.truncated_count += 1
+            return text[:PARSE_MAX_INPUT_LENGTH]
+        return text
+
+    def begin_message(self) -> None:
+        """开始处理一条新消息，重置时间预算和截断标记"""
+        _parse_spent.set([0.0])
+        _parse_truncated.set([False])
+
+    def search(self, name: str, pattern: re.Pattern, text: str) -> Optional[re.Match]:
+        """在时间预算内执行一次正则搜索"""
+        spent = _parse_spent.get()
+        if spent is not None and spent[0] > PARSE_TIME_BUDGET:
+            raise ParseBudgetExceeded(name)
+
+        start = time.perf_counter()
+        match = pattern.search(text)
+        elapsed = time.perf_counter() - start
+
+        if spent is not None:
+            spent[0] += elapsed
+            if spent[0] > PARSE_TIME_BUDGET:
+                self.exceeded_count += 1
+        if elapsed >= PARSE_SLOW_THRESHOLD:
+            self._record_slow(name, elapsed, text)
+        return match
+
+    def _record_slow(self, name: str, elapsed: float, text: str) -> None:
+        """记录慢输入，只保留耗时最长的 PARSE_SLOW_LOG_SIZE 条"""
+        self._seq += 1
+        entry = (elapsed, self._seq, name, text[:80].replace("\n", " "))
+        if len(self._slowest) < PARSE_SLOW_LOG_SIZE:
+            heapq.heappush(self._slowest, entry)
+        elif elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+        logs.warning(f"[LuckyDraw] 正则匹配过慢 | 规则: {name} | 耗时: {elapsed * 1000:.1f}ms | 长度: {len(text)}")
+
+    def get_report(self) -> str:
+        """获取防护统计"""
+        output = "**正则解析防护：**\n\n"
+        output += f"- 输入长度上限: `{PARSE_MAX_INPUT_LENGTH}` 字符\n"
+        output += f"- 单条消息时间预算: `{PARSE_TIME_BUDGET * 1000:.0f}` ms\n"
+        output += f"- 截断消息数: `{self.truncated_count}`\n"
+        output += f"- 超出预算数: `{self.exceeded_count}`\n"
+        if not self._slowest:
+            output += "\n暂无慢输入记录"
+            return output
+        output += "\n**最慢输入：**\n"
+        for elapsed, _, name, preview in sorted(self._slowest, reverse=True):
+            output += f"- `{elapsed * 1000:.1f}ms` | {name} | `{preview}`\n"
+        return output
+
+    @staticmethod
+    def _fuzz_alphabet(pattern: re.Pattern) -> List[str]:
+        """从正则源码中提取字面量片段，作为构造对抗输入的字母表"""
+        fragments = re.findall(r"[一-鿿]+|[🔑📦│：:/「」【】]", pattern.pattern)
+        return list(dict.fromkeys(fragments)) + [" ", "\n", "1", "23", "a"]
+
+    @staticmethod
+    def _fuzz_samples(rng: random.Random, alphabet: List[str], size: int) -> List[str]:
+        """
+        生成指定长度的对抗输入：
+        - 单个字面量片段的重复（最容易触发逐起点回溯）
+        - 不含换行的随机拼接（单行越长，回溯窗口越大）
+        - 含换行的随机拼接
+        """
+        samples = [(fragment * (size // len(fragment) + 1))[:size] for fragment in alphabet if fragment.strip()]
+        single_line = [fragment for fragment in alphabet if fragment != "\n"]
+        for i in range(PARSE_BENCH_SAMPLES):
+            pool = single_line if i % 2 == 0 else alphabet
+            pieces = []
+            length = 0
+            while length < size:
+                piece = rng.choice(pool)
+                pieces.append(piece)
+                length += len(piece)
+            samples.append("".join(pieces)[:size])
+        return samples
+
+    def benchmark(self) -> List[dict]:
+        """
+        对所有受保护的正则做模糊压测（同步执行，耗时较长，应放到线程中运行）
+        按长度梯度生成随机对抗输入，取每个长度下的最坏耗时，
+        以首尾长度的 log-log 斜率估算增长指数，超过阈值即判定为超线性
+        """
+        rng = random.Random(0)
+        results = []
+        for name, pattern in self.patterns:
+            alphabet = self._fuzz_alphabet(pattern)
+            worst = []
+            for size in PARSE_BENCH_SIZES:
+                worst_time = 0.0
+                for sample in self._fuzz_samples(rng, alphabet, size):
+                    start = time.perf_counter()
+                    pattern.search(sample)
+                    worst_time = max(worst_time, time.perf_counter() - start)
+                worst.append(max(worst_time, 1e-7))
+            exponent = math.log(worst[-1] / worst[0]) / math.log(PARSE_BENCH_SIZES[-1] / PARSE_BENCH_SIZES[0])
+            results.append({
+                "name": name,
+                "worst_ms": worst[-1] * 1000,
+                "exponent": exponent,
+                "superlinear": exponent > PARSE_BENCH_MAX_EXPONENT,
+            })
+        return results
+
+
+# 全局解析防护实例
+parse_guard = ParseGuard()
+# ==========================================
+
+
+def content_digests(text: str) -> tuple[str, str]:
+    """计算消息的全文摘要与剔除计数字段后的稳定摘要"""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+    stable_text = _RE_VOLATILE_COUNTS.sub("#", text)
+    stable_digest = hashlib.blake2b(stable_text.encode("utf-8"), digest_size=8).hexdigest()
+    return digest, stable_digest
+
+
+def remember_message_digest(
+    chat_id: int,
+    message_id: int,
+    digest: str,
+    stable_digest: str,
+    store: "OrderedDict[tuple, dict]" = _message_digests,
+    max_size: int = MESSAGE_DIGEST_CACHE_SIZE,
+) -> dict:
+    """记录消息摘要（LRU 淘汰），返回缓存条目以便后续补充解析结果"""
+    cache_key = (chat_id, message_id)
+    entry = store.pop(cache_key, None) or {}
+    entry["digest"] = digest
+    entry["stable_digest"] = stable_digest
+    store[cache_key] = entry
+    while len(store) > max_size:
+        store.popitem(last=False)
+    return entry
+
+
+# ========== 性能优化：文本标准化转换表 ==========
+# 预先构建 str.translate 转换表，一次遍历完成全角/繁简/标点/空白的统一，代替多次正则替换
+# 常用繁体字 → 简体字（只收录无歧义的一对一映射）
+_TRADITIONAL_CHARS = "紅領開獎動數個餘參與發財運來時間語說會將們對這過還進後員機點擊競錢萬幣華國愛樂歡謝請讓給長東車門見風飛鳥馬魚龍雲電話號碼關線結組聯網頭體學習實現無從當應業經總義氣質題樣種認識讀寫買賣貨價幾張紙筆書報錯難麼為聽覺願夢歲壽禮節慶團圓興順級紀約喚幫傳獲贏輸搶樓羅蘭稱齊"
+_SIMPLIFIED_CHARS = "红领开奖动数个余参与发财运来时间语说会将们对这过还进后员机点击竞钱万币华国爱乐欢谢请让给长东车门见风飞鸟马鱼龙云电话号码关线结组联网头体学习实现无从当应业经总义气质题样种认识读写买卖货价几张纸笔书报错难么为听觉愿梦岁寿礼节庆团圆兴顺级纪约唤帮传获赢输抢楼罗兰称齐"
+# 中文标点 → 半角标点（全角 ASCII 区间内的标点由下方区间映射统一处理）
+_PUNCTUATION_VARIANTS = {
+    "。": ".", "、": ",", "“": '"', "”": '"', "‘": "'", "’": "'",
+    "「": '"', "」": '"', "『": '"', "』": '"', "【": "[", "】": "]",
+    "《": "<", "》": ">", "〈": "<", "〉": ">", "—": "-", "–": "-", "…": "...",
+}
+
+
+def _build_normalize_table() -> dict:
+    """构建标准化转换表：全角 ASCII → 半角、繁体 → 简体、标点变体 → 半角、删除空白和零宽字符"""
+    table = {code: code - 0xFEE0 for code in range(0xFF01, 0xFF5F)}  # ！-～ → !-~
+    table.update(str.maketrans(_TRADITIONAL_CHARS, _SIMPLIFIED_CHARS))
+    table.update(str.maketrans(_PUNCTUATION_VARIANTS))
+    # 所有空白字符（最大码位为 U+3000 全角空格）和常见零宽字符直接删除
+    table.update({code: None for code in range(0x3001) if chr(code).isspace()})
+    table.update({code: None for code in (0x200B, 0x200C, 0x200D, 0x2060, 0xFEFF)})
+    return table
+
+
+_NORMALIZE_TABLE = _build_normalize_table()
 # ==========================================
 
 
 def normalize_text(text: Optional[str]) -> str:
-    """标准化文本，便于比较关键词"""
+    """标准化文本，便于比较关键词（全角/繁简/标点/空白统一后转小写）"""
     if not text:
         return ""
-    return re.sub(r"\s+", "", text).strip().lower()
+    return text.translate(_NORMALIZE_TABLE).lower()
+
+
+# 红包个数解析规则（预编译，按优先级排序）
+# 注意：跨字符匹配一律使用有界量词，避免对抗输入触发回溯爆炸
+_RE_REMAINING_COUNT = parse_guard.register("剩余个数", re.compile(r"剩余\s*(\d+)\s*/\s*(\d+)\s*个"))
+_RE_AUTO_OPEN_COUNT = parse_guard.register("自动开奖人数", re.compile(r"自动开奖人数[：:]\s*(\d+)"))
+_RED_PACKET_COUNT_PATTERNS = [
+    (parse_guard.register("共X个", re.compile(r"共\s*(\d+)\s*个")), "共X个"),  # 共3个, 共 3 个, 共 10 个
+    (parse_guard.register("红包X个", re.compile(r"红包[^\n]{0,40}?(\d+)\s*个")), "红包X个"),  # 红包3个
+    (parse_guard.register("数量", re.compile(r"数量[：:]\s*(\d+)")), "数量"),  # 数量: 3
+    (parse_guard.register("共X份", re.compile(r"共\s*(\d+)\s*份")), "共X份"),  # 共3份
+]
 
 
 def extract_red_packet_count(text: str) -> Optional[int]:
@@ -519,48 +1110,459 @@ def extract_red_packet_count(text: str) -> Optional[int]:
     - 共10个
     - 剩余2/3个 (新格式)
     - 自动开奖人数：10（抽奖消息专用）
-    返回: 红包个数 或 None（无法解析）
+    返回: 红包个数 或 None（无法解析或超出解析预算）
     """
     if not text:
         return None
 
-    # 优先匹配 "剩余X/Y个" 格式（取剩余个数）
-    remaining_pattern = r"剩余\s*(\d+)\s*/\s*\d+\s*个"
-    match = re.search(remaining_pattern, text)
-    if match:
-        count = int(match.group(1))
-        if count > 0:
-            return count
-
-    # 匹配 "自动开奖人数：X" 格式（抽奖消息，判断是否用转发模式）
-    auto_open_pattern = r"自动开奖人数[：:]\s*(\d+)"
-    match = re.search(auto_open_pattern, text)
-    if match:
-        count = int(match.group(1))
-        if count > 0:
-            return count
-
-    # 匹配 "共X个" 或 "共 X 个" 格式
-    patterns = [
-        r"共\s*(\d+)\s*个",  # 共3个, 共 3 个, 共 10 个
-        r"红包.*?(\d+)\s*个",  # 红包3个
-        r"数量[：:]\s*(\d+)",  # 数量: 3
-        r"共\s*(\d+)\s*份",  # 共3份
-    ]
+    text = parse_guard.clip(text)
+    try:
+        # 优先匹配 "剩余X/Y个" 格式（取剩余个数）
+        match = parse_guard.search("剩余个数", _RE_REMAINING_COUNT, text)
+        if match:
+            count = int(match.group(1))
+            if count > 0:
+                return count
 
-    for pattern in patterns:
-        match = re.search(pattern, text)
+        # 匹配 "自动开奖人数：X" 格式（抽奖消息，判断是否用转发模式）
+        match = parse_guard.search("自动开奖人数", _RE_AUTO_OPEN_COUNT, text)
         if match:
-            try:
-                count = int(match.group(1))
-                if count > 0:
-                    return count
-            except (ValueError, IndexError):
-                continue
+            count = int(match.group(1))
+            if count > 0:
+                return count
+
+        # 匹配 "共X个" 或 "共 X 个" 格式
+        for pattern, name in _RED_PACKET_COUNT_PATTERNS:
+            match = parse_guard.search(name, pattern, text)
+            if match:
+                try:
+                    count = int(match.group(1))
+                    if count > 0:
+                        return count
+                except (ValueError, IndexError):
+                    continue
+    except ParseBudgetExceeded:
+        return None
 
     return None
 
 
+class RedPacketTracker:
+    """
+    红包剩余个数跟踪器
+    跟随机器人对红包消息的编辑更新 "剩余X/Y个"，个数归零时：
+    - 唤醒并取消该红包尚在延时中的发送
+    - 清除该红包在转发模式下的等待队列
+    - 记录所在群组的领取速度（个/秒）
+    """
+
+    def __init__(self):
+        # {(chat_id, message_id, block_index): {"remaining", "total", "first_remaining", "first_seen", "last_seen", "depleted"}}
+        self.packets: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.chat_rates: Dict[int, float] = {}  # 群组领取速度 EWMA {chat_id: 个/秒}
+        self.cancelled_sends: int = 0  # 因红包领完而取消的发送次数
+        self._events: Dict[tuple, Set[asyncio.Event]] = {}  # 领完通知（每个延时中的发送一个）
+
+    def update(self, chat_id: int, message_id: int, text: str, block_index: Optional[int] = None) -> Optional[int]:
+        """
+        根据最新文本更新红包剩余个数
+        返回: 剩余个数 或 None（文本中没有 "剩余X/Y个"）
+        """
+        try:
+            match = parse_guard.search("剩余个数", _RE_REMAINING_COUNT, text)
+        except ParseBudgetExceeded:
+            return None
+        if not match:
+            return None
+
+        remaining, total = int(match.group(1)), int(match.group(2))
+        key = (chat_id, message_id, block_index)
+        now = time.monotonic()
+        packet = self.packets.pop(key, None)
+        if packet is None:
+            packet = {
+                "remaining": remaining,
+                "total": total,
+                "first_remaining": remaining,
+                "first_seen": now,
+                "depleted": False,
+            }
+        packet["remaining"] = remaining
+        packet["total"] = total
+        packet["last_seen"] = now
+        self.packets[key] = packet
+
+        if remaining <= 0 and not packet["depleted"]:
+            packet["depleted"] = True
+            self._on_depleted(key, packet)
+
+        self._evict(now)
+        return remaining
+
+    def update_message(self, chat_id: int, message_id: int, text: str, multi: bool) -> Optional[int]:
+        """按消息格式更新剩余个数，多红包消息逐块更新；返回单红包的剩余个数"""
+        if not multi:
+            return self.update(chat_id, message_id, text)
+        for i, block in enumerate(split_multiple_red_packets(text)):
+            self.update(chat_id, message_id, block, i)
+        return None
+
+    def is_depleted(self, chat_id: int, message_id: int, block_index: Optional[int] = None) -> bool:
+        """红包是否已领完"""
+        packet = self.packets.get((chat_id, message_id, block_index))
+        return bool(packet and packet["depleted"])
+
+    async def wait(self, chat_id: int, message_id: int, block_index: Optional[int], delay: float) -> bool:
+        """
+        代替 asyncio.sleep 的发送前延时，红包在延时期间领完会提前返回
+        返回: True 表示红包已领完，应取消本次发送
+        """
+        key = (chat_id, message_id, block_index)
+        if self.is_depleted(*key):
+            self.cancelled_sends += 1
+            return True
+        if delay <= 0:
+            return False
+
+        event = asyncio.Event()
+        self._events.setdefault(key, set()).add(event)
+        try:
+            await asyncio.wait_for(event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            # 延时结束（无论是否领完）都移除自己的通知，避免没有跟踪到的红包留下条目
+            waiters = self._events.get(key)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._events[key]
+        self.cancelled_sends += 1
+        return True
+
+    def _on_depleted(self, key: tuple, packet: dict) -> None:
+        """红包领完：通知延时中的发送，清除等待队列，更新群组领取速度"""
+        chat_id, message_id, block_index = key
+        for event in self._events.pop(key, ()):
+            event.set()
+
+        cleared = []
+        for queue_key, pending in list(pending_draws.items()):
+            if (
+                pending.get("chat_id") == chat_id
+                and pending.get("source_message_id") == message_id
+                and pending.get("block_index") == block_index
+            ):
+                cleared.append(pending.get("keyword"))
+                del pending_draws[queue_key]
+        if cleared:
+            logs.info(f"[LuckyDraw] 红包已领完，移出等待队列 | 群组: {chat_id} | 口令: {cleared}")
+
+        elapsed = packet["last_seen"] - packet["first_seen"]
+        if elapsed > 0 and packet["first_remaining"] > 0:
+            rate = packet["first_remaining"] / elapsed
+            previous = self.chat_rates.get(chat_id)
+            self.chat_rates[chat_id] = rate if previous is None else (
+                TRACKER_RATE_ALPHA * rate + (1 - TRACKER_RATE_ALPHA) * previous
+            )
+
+    def _evict(self, now: float) -> None:
+        """淘汰过期或超量的红包"""
+        while self.packets:
+            key, packet = next(iter(self.packets.items()))
+            if len(self.packets) <= TRACKER_MAX_PACKETS and now - packet["last_seen"] <= TRACKER_PACKET_TTL:
+                break
+            self.packets.popitem(last=False)
+            self._events.pop(key, None)
+
+    def snapshot(self) -> dict:
+        """导出跟踪状态（单调时钟换算为墙上时间，便于跨进程恢复）"""
+        offset = time.time() - time.monotonic()
+        return {
+            "packets": [
+                [list(key), {
+                    **packet,
+                    "first_seen": packet["first_seen"] + offset,
+                    "last_seen": packet["last_seen"] + offset,
+                }]
+                for key, packet in self.packets.items()
+            ],
+            "chat_rates": self.chat_rates,
+            "cancelled_sends": self.cancelled_sends,
+        }
+
+    def restore(self, data: dict) -> int:
+        """从快照恢复跟踪状态，丢弃已过期的红包；返回恢复的红包数"""
+        offset = time.time() - time.monotonic()
+        now = time.monotonic()
+        for key, packet in data.get("packets", []):
+            packet["first_seen"] -= offset
+            packet["last_seen"] -= offset
+            if now - packet["last_seen"] > TRACKER_PACKET_TTL:
+                continue
+            self.packets[tuple(key)] = packet
+        self._evict(now)
+        for chat_id, rate in data.get("chat_rates", {}).items():
+            self.chat_rates.setdefault(int(chat_id), rate)
+        self.cancelled_sends += data.get("cancelled_sends", 0)
+        return len(self.packets)
+
+    def get_report(self) -> str:
+        """获取跟踪统计"""
+        live = sum(1 for packet in self.packets.values() if not packet["depleted"])
+        output = "\n**红包跟踪：**\n\n"
+        output += f"- 跟踪中的红包: `{live}` 个\n"
+        output += f"- 领完后取消的发送: `{self.cancelled_sends}` 次\n"
+        for chat_id, rate in sorted(self.chat_rates.items(), key=lambda item: item[1], reverse=True)[:5]:
+            output += f"- 群组 `{chat_id}` 领取速度: `{rate:.2f}` 个/秒\n"
+        return output
+
+
+# 全局红包跟踪实例
+packet_tracker = RedPacketTracker()
+
+
+# 红包总额（期望价值估算用）
+_RE_TOTAL_AMOUNT = parse_guard.register("总额", re.compile(r"总额[：:]?\s*[¥￥$]?\s*(\d+(?:\.\d+)?)"))
+
+
+def estimate_draw_value(chat_id: int, text: str, count: Optional[int]) -> float:
+    """
+    估算一次参与的期望价值：人均金额 × 该群历史中奖率
+    人均金额 = 总额 / 剩余个数（无法解析时按 DEFAULT_DRAW_AMOUNT 和 1 个计算）
+    中奖率取最近 30 天的 中奖/参与，做拉普拉斯平滑避免新群为 0
+    """
+    amount = DEFAULT_DRAW_AMOUNT
+    try:
+        match = parse_guard.search("总额", _RE_TOTAL_AMOUNT, text)
+        if match:
+            amount = float(match.group(1))
+    except ParseBudgetExceeded:
+        pass
+
+    totals = activity.aggregate(chat_id, ACTIVITY_DAYS)
+    win_rate = (totals["won"] + 1) / (totals["joined"] + 2)
+    return amount / max(count or 1, 1) * win_rate
+
+
+class SendScheduler:
+    """
+    按期望价值排序的发送调度器（ev 策略）
+    同一批到达的候选先收集 SCHEDULER_BATCH_WINDOW 秒，然后在群组/全局发送预算内
+    按期望价值从高到低依次放行；预算不足的候选继续等待，超过 SCHEDULER_MAX_WAIT 后丢弃
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []  # (-期望价值, 序号, chat_id, 标签, 截止时间, future)
+        self._seq: int = 0
+        self._chat_sends: Dict[int, deque] = defaultdict(deque)  # {chat_id: 发送时间}
+        self._global_sends: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self.granted: int = 0
+        self.dropped: int = 0
+
+    async def acquire(self, chat_id: int, value: float, label: str) -> bool:
+        """
+        申请一次发送名额
+        返回: True 表示可以发送，False 表示等待超时被丢弃
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        deadline = time.monotonic() + SCHEDULER_MAX_WAIT
+        heapq.heappush(self._heap, (-value, self._seq, chat_id, label, deadline, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        return await future
+
+    def _has_budget(self, chat_id: int, now: float) -> bool:
+        for sends in (self._chat_sends[chat_id], self._global_sends):
+            while sends and now - sends[0] > SEND_BUDGET_WINDOW:
+                sends.popleft()
+        return len(self._chat_sends[chat_id]) < SEND_BUDGET_PER_CHAT and len(self._global_sends) < SEND_BUDGET_GLOBAL
+
+    async def _dispatch(self) -> None:
+        """按期望价值从高到低放行候选"""
+        await asyncio.sleep(SCHEDULER_BATCH_WINDOW)
+        while self._heap:
+            now = time.monotonic()
+            waiting = []
+            while self._heap:
+                item = heapq.heappop(self._heap)
+                neg_value, _, chat_id, label, deadline, future = item
+                if future.done():
+                    continue
+                if now > deadline:
+                    self.dropped += 1
+                    future.set_result(False)
+                    logs.info(f"[LuckyDraw-EV] 等待超时，放弃发送 | 群组: {chat_id} | 期望价值: {-neg_value:.3f} | 口令: {label}")
+                elif self._has_budget(chat_id, now):
+                    self._chat_sends[chat_id].append(now)
+                    self._global_sends.append(now)
+                    self.granted += 1
+                    future.set_result(True)
+                    logs.info(f"[LuckyDraw-EV] 放行发送 | 群组: {chat_id} | 期望价值: {-neg_value:.3f} | 口令: {label}")
+                else:
+                    waiting.append(item)
+            for item in waiting:
+                heapq.heappush(self._heap, item)
+            if self._heap:
+                await asyncio.sleep(SCHEDULER_POLL_INTERVAL)
+
+    def snapshot(self) -> dict:
+        """导出发送预算窗口（排队中的候选随进程结束，不导出）"""
+        offset = time.time() - time.monotonic()
+        return {
+            "chat_sends": {
+                str(chat_id): [sent_at + offset for sent_at in sends]
+                for chat_id, sends in self._chat_sends.items() if sends
+            },
+            "global_sends": [sent_at + offset for sent_at in self._global_sends],
+        }
+
+    def restore(self, data: dict) -> None:
+        """从快照恢复发送预算窗口，窗口外的记录在下次检查预算时自然淘汰"""
+        offset = time.time() - time.monotonic()
+        for chat_id, sends in data.get("chat_sends", {}).items():
+            self._chat_sends[int(chat_id)].extend(sent_at - offset for sent_at in sends)
+        self._global_sends.extend(sent_at - offset for sent_at in data.get("global_sends", []))
+
+    def get_report(self) -> str:
+        """获取调度统计"""
+        output = "\n**期望价值调度：**\n\n"
+        output += f"- 当前策略: `{config.send_policy}`\n"
+        output += f"- 发送预算: 每群 `{SEND_BUDGET_PER_CHAT}` 次 / 全局 `{SEND_BUDGET_GLOBAL}` 次（每 {SEND_BUDGET_WINDOW:.0f} 秒）\n"
+        output += f"- 放行: `{self.granted}` 次 | 丢弃: `{self.dropped}` 次 | 排队中: `{len(self._heap)}`\n"
+        return output
+
+
+# 全局发送调度实例
+send_scheduler = SendScheduler()
+
+
+async def acquire_send_slot(chat_id: int, text: str, count: Optional[int], keyword: str) -> bool:
+    """ev 策略下申请发送名额；fifo 策略直接放行"""
+    if config.send_policy != "ev":
+        return True
+    return await send_scheduler.acquire(chat_id, estimate_draw_value(chat_id, text, count), keyword)
+
+
+class LoadShedder:
+    """
+    事件循环延迟驱动的负载降级
+    后台定时探测 asyncio.sleep 的实际唤醒延迟，延迟超过某环节的阈值时跳过该低优先级环节，
+    让口令发送和按钮点击保持低延迟
+    """
+
+    def __init__(self):
+        self.lag: float = 0.0  # 平滑后的事件循环延迟（秒）
+        self.max_lag: float = 0.0  # 观测到的最大延迟（秒）
+        self.shed_counts: Dict[str, int] = defaultdict(int)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """启动延迟探测（需要在事件循环中调用，重复调用无副作用）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._probe())
+
+    def stop(self) -> None:
+        """停止延迟探测"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + LAG_PROBE_INTERVAL
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, lag)
+            self.lag = lag if lag >= self.lag else LAG_DECAY * self.lag + (1 - LAG_DECAY) * lag
+
+    def allow(self, stage: str) -> bool:
+        """当前负载下是否执行该低优先级环节；被跳过时计数"""
+        self.start()
+        if self.lag < config.shed_thresholds.get(stage, SHED_DEFAULT_THRESHOLDS[stage]):
+            return True
+        self.shed_counts[stage] += 1
+        return False
+
+    def get_report(self) -> str:
+        """获取负载降级统计"""
+        output = "\n**负载降级：**\n\n"
+        output += f"- 事件循环延迟: `{self.lag * 1000:.1f}ms`（最大 `{self.max_lag * 1000:.1f}ms`）\n"
+        for stage, name in SHED_STAGE_NAMES.items():
+            threshold = config.shed_thresholds.get(stage, SHED_DEFAULT_THRESHOLDS[stage])
+            output += f"- {name}: 阈值 `{threshold * 1000:.0f}ms` | 已跳过 `{self.shed_counts[stage]}` 次\n"
+        return output
+
+
+# 全局负载降级实例
+load_shedder = LoadShedder()
+
+
+class DecisionTrace:
+    """
+    决策追踪：每个群组一个环形缓冲区，记录消息处理过程中的每一步决策
+    事件只保存 (时间, 消息ID, 事件, 详情) 元组，格式化推迟到 ,ldraw trace 查看时，
+    开销足够小，所有启用的群组都常开；测试群组额外把事件输出到日志（负载过高时跳过）
+    事件名可以是带 {} 占位符的模板，查看时才用 detail 中的原始值填充
+    非白名单发送者的普通消息不记录，避免挤掉环形缓冲区里真正的决策
+    """
+
+    def __init__(self):
+        self.chats: "OrderedDict[int, deque]" = OrderedDict()
+
+    def record(self, chat_id: int, message_id: Optional[int], event: str, detail=None) -> None:
+        """记录一条决策事件（detail 保持原始值，不在这里格式化）"""
+        events = self.chats.get(chat_id)
+        if events is None:
+            events = self.chats[chat_id] = deque(maxlen=TRACE_SIZE)
+            if len(self.chats) > TRACE_MAX_CHATS:
+                self.chats.popitem(last=False)
+        events.append((time.time(), message_id, event, detail))
+        if chat_id in config.test_chats and load_shedder.allow("debug"):
+            logs.info(f"[LuckyDraw] {self._format(message_id, event, detail)} | 群组: {chat_id}")
+
+    @staticmethod
+    def _format(message_id: Optional[int], event: str, detail) -> str:
+        if "{" in event:
+            # 事件模板：占位符在查看时才填充
+            event = event.format(*(detail if isinstance(detail, tuple) else (detail,)))
+            detail = None
+        line = f"#{message_id} {event}" if message_id is not None else event
+        if detail is None:
+            return line
+        if isinstance(detail, tuple):
+            detail = " | ".join(str(item) for item in detail)
+        return f"{line}: {detail}"
+
+    def dump(self, chat_id: int, count: int = TRACE_DEFAULT_COUNT) -> str:
+        """获取群组最近的决策事件"""
+        events = self.chats.get(chat_id)
+        if not events:
+            return f"群组 `{chat_id}` 暂无决策记录"
+        recent = list(events)[-count:]
+        output = f"**群组 `{chat_id}` 最近 {len(recent)} 条决策：**\n\n"
+        for recorded_at, message_id, event, detail in recent:
+            clock = time.strftime("%H:%M:%S", time.localtime(recorded_at))
+            output += f"`{clock}` {self._format(message_id, event, detail)}\n"
+        return output
+
+
+# 全局决策追踪实例
+decision_trace = DecisionTrace()
+
+
+# 多红包分隔符
+_RED_PACKET_SEPARATORS = [
+    re.compile(r"➖{5,}"),  # ➖➖➖➖➖➖➖➖➖➖
+    re.compile(r"─{5,}"),   # ────────────
+    re.compile(r"={5,}"),   # ===========
+    re.compile(r"-{5,}"),   # ----------
+]
+
+
 def split_multiple_red_packets(text: str) -> List[str]:
     """
     分割多条红包的消息，返回单个红包块的列表
@@ -573,19 +1575,14 @@ def split_multiple_red_packets(text: str) -> List[str]:
     if not text:
         return []
 
-    # 按分隔符分割
-    separators = [
-        r"➖{5,}",  # ➖➖➖➖➖➖➖➖➖➖
-        r"─{5,}",   # ────────────
-        r"={5,}",   # ===========
-        r"-{5,}",   # ----------
-    ]
+    text = parse_guard.clip(text)
 
+    # 按分隔符分割
     blocks = [text]
-    for sep in separators:
+    for sep in _RED_PACKET_SEPARATORS:
         new_blocks = []
         for block in blocks:
-            parts = re.split(sep, block)
+            parts = sep.split(block)
             new_blocks.extend([p.strip() for p in parts if p.strip()])
         blocks = new_blocks
 
@@ -600,99 +1597,120 @@ def split_multiple_red_packets(text: str) -> List[str]:
     return valid_blocks
 
 
-def extract_keyword_from_block(block: str) -> Optional[tuple[str, str]]:
+def order_by_profile(patterns: List[tuple], preferred: Optional[List[str]]) -> List[tuple]:
+    """按机器人画像把常用规则排到前面，其余规则保持原优先级"""
+    if not preferred:
+        return patterns
+    rank = {keyword_type: i for i, keyword_type in enumerate(preferred)}
+    return sorted(patterns, key=lambda item: rank.get(item[1], len(rank)))
+
+
+# 红包块口令规则
+_BLOCK_KEYWORD_PATTERNS = [
+    (parse_guard.register("红包口令-emoji", re.compile(r"🔑\s*口令[：:]\s*(.+?)(?:\n|│|$)")), "红包口令-emoji"),
+    (parse_guard.register("红包块口令", re.compile(r"口令[：:]\s*(.+?)(?:\n|│|$)")), "红包口令"),
+]
+
+
+def extract_keyword_from_block(block: str, preferred: Optional[List[str]] = None) -> Optional[tuple[str, str]]:
     """
     从单个红包块中提取口令
     支持格式：
     - 🔑 口令: 10
     - 口令: 10
     - 口令：10
+    preferred: 机器人画像中的常用规则，优先尝试
     返回: (口令, 类型) 或 None
     """
     if not block:
         return None
 
-    # 匹配口令格式
-    patterns = [
-        (r"🔑\s*口令[：:]\s*(.+?)(?:\n|│|$)", "红包口令-emoji"),
-        (r"口令[：:]\s*(.+?)(?:\n|│|$)", "红包口令"),
-    ]
+    block = parse_guard.clip(block)
 
-    for pattern, keyword_type in patterns:
-        match = re.search(pattern, block)
-        if match:
-            keyword = match.group(1).strip()
-            # 清理口令中的引号和多余空格
-            keyword = keyword.strip('"\'「」【】 \n')
-            # 过滤掉明显的分隔符或无用字符
-            if keyword and keyword not in ["➖", "─", "=", "-"] and len(keyword) <= 50:
-                return (keyword, keyword_type)
+    # 匹配口令格式
+    try:
+        for pattern, keyword_type in order_by_profile(_BLOCK_KEYWORD_PATTERNS, preferred):
+            match = parse_guard.search(keyword_type, pattern, block)
+            if match:
+                keyword = match.group(1).strip()
+                # 清理口令中的引号和多余空格
+                keyword = keyword.strip('"\'「」【】 \n')
+                # 过滤掉明显的分隔符或无用字符
+                if keyword and keyword not in ["➖", "─", "=", "-"] and len(keyword) <= 50:
+                    return (keyword, keyword_type)
+    except ParseBudgetExceeded:
+        return None
 
     return None
 
 
-def check_red_packet_finished(text: str, chat_id: int, is_test: bool) -> bool:
+# 红包已领完的模式
+_FINISHED_PATTERNS = [
+    re.compile(r"已领完", re.IGNORECASE),              # 🧧 拼手气红包[xxx]已领完！
+    re.compile(r"已领取完毕", re.IGNORECASE),
+    re.compile(r"红包已被领完", re.IGNORECASE),
+    re.compile(r"领取详情:", re.IGNORECASE),
+    re.compile(r"中奖信息", re.IGNORECASE),             # 抽奖开奖，显示中奖者信息
+    parse_guard.register("开奖提示", re.compile(r"参与人数够啦[^\n]{0,40}开奖", re.IGNORECASE)),  # 参与人数够啦！！开奖~
+]
+
+
+def is_red_packet_finished(text: str) -> bool:
+    """检查消息是否表示红包/抽奖已结束（不修改任何状态）"""
+    try:
+        return any(parse_guard.search("已结束", pattern, text) for pattern in _FINISHED_PATTERNS)
+    except ParseBudgetExceeded:
+        return False
+
+
+def check_red_packet_finished(text: str, chat_id: int) -> bool:
     """
     检查红包/抽奖是否已结束，如果是则清除该口令记录
     返回: 是否处理了这个消息
     """
-    # 红包已领完的模式
-    finished_patterns = [
-        r"已领完",              # 🧧 拼手气红包[xxx]已领完！
-        r"已领取完毕",
-        r"红包已被领完",
-        r"领取详情:",
-        r"中奖信息",             # 抽奖开奖，显示中奖者信息
-        r"参与人数够啦.*开奖",   # 参与人数够啦！！开奖~
-    ]
+    text = parse_guard.clip(text)
+    if not is_red_packet_finished(text):
+        return False
+
+    # 提取红包口令（如果有）
+    result = KeywordExtractor.extract(text)
+    extracted_keyword = result[0] if result else None
     
-    for pattern in finished_patterns:
-        if re.search(pattern, text, re.IGNORECASE):
-            # 提取红包口令（如果有）
-            result = KeywordExtractor.extract(text)
-            extracted_keyword = result[0] if result else None
-            
-            # 清除该群的所有 pending_draws（抽奖结束了）
-            cleared_pending = []
-            for pq_key in list(pending_draws.keys()):
-                if pq_key.startswith(f"{chat_id}_"):
-                    pending_info = pending_draws[pq_key]
-                    cleared_pending.append(pending_info.get("keyword", "unknown"))
-                    del pending_draws[pq_key]
-            if cleared_pending:
-                logs.info(f"[LuckyDraw] 抽奖已结束，清除待处理队列: {cleared_pending}")
-            
-            # 清除口令记录（以便下次相同口令能再次发送）
-            if extracted_keyword:
-                # 清除指定口令
-                key = str(chat_id)
-                if key in config.sent_keywords and extracted_keyword in config.sent_keywords[key]:
-                    config.sent_keywords[key].remove(extracted_keyword)
-                # 同步清除待刷新的变更，防止 flush 时被重新合并回来
-                if key in config._pending_keyword_changes and extracted_keyword in config._pending_keyword_changes[key]:
-                    config._pending_keyword_changes[key].remove(extracted_keyword)
-                config.save()
-                logs.info(f"[LuckyDraw] 抽奖已结束，清除口令记录: {extracted_keyword}")
-                if is_test:
-                    return True
-            else:
-                # 如果没有提取到口令，清除该群所有口令（保守处理）
-                key = str(chat_id)
-                removed = []
-                if key in config.sent_keywords and config.sent_keywords[key]:
-                    removed = config.sent_keywords.pop(key)
-                # 同步清除待刷新的变更，防止 flush 时被重新合并回来
-                if key in config._pending_keyword_changes:
-                    config._pending_keyword_changes.pop(key)
-                config.save()
-                if removed:
-                    logs.info(f"[LuckyDraw] 抽奖已结束，清除该群所有口令记录: {removed}")
-                if is_test:
-                    logs.info(f"[LuckyDraw] 检测到抽奖已结束，已清除该群所有口令记录")
-            
-            return True
+    # 清除该群的所有 pending_draws（抽奖结束了）
+    cleared_pending = []
+    for pq_key in list(pending_draws.keys()):
+        if pq_key.startswith(f"{chat_id}_"):
+            pending_info = pending_draws[pq_key]
+            cleared_pending.append(pending_info.get("keyword", "unknown"))
+            del pending_draws[pq_key]
+    if cleared_pending:
+        logs.info(f"[LuckyDraw] 抽奖已结束，清除待处理队列: {cleared_pending}")
+    
+    # 清除口令记录（以便下次相同口令能再次发送）
+    if extracted_keyword:
+        # 清除指定口令
+        key = str(chat_id)
+        if key in config.sent_keywords and extracted_keyword in config.sent_keywords[key]:
+            config.sent_keywords[key].remove(extracted_keyword)
+        # 同步清除待刷新的变更，防止 flush 时被重新合并回来
+        if key in config._pending_keyword_changes and extracted_keyword in config._pending_keyword_changes[key]:
+            config._pending_keyword_changes[key].remove(extracted_keyword)
+        config.save()
+        logs.info(f"[LuckyDraw] 抽奖已结束，清除口令记录: {extracted_keyword}")
+    else:
+        # 如果没有提取到口令，清除该群所有口令（保守处理）
+        key = str(chat_id)
+        removed = []
+        if key in config.sent_keywords and config.sent_keywords[key]:
+            removed = config.sent_keywords.pop(key)
+        # 同步清除待刷新的变更，防止 flush 时被重新合并回来
+        if key in config._pending_keyword_changes:
+            config._pending_keyword_changes.pop(key)
+        config.save()
+        if removed:
+            logs.info(f"[LuckyDraw] 抽奖已结束，清除该群所有口令记录: {removed}")
     
-    return False
+    return True
 
 
 def is_lottery_bot_message(text: str) -> bool:
@@ -722,47 +1740,121 @@ class KeywordExtractor:
     """口令提取器"""
 
     # 口令提取规则列表（按优先级排序）
+    _FLAGS = re.IGNORECASE | re.MULTILINE
     PATTERNS = [
         # 格式1: 【密令抽奖】...领取密令: xxx
-        (r"领取密令[：:]\s*(.+?)(?:\n|$)", "密令抽奖"),
+        (re.compile(r"领取密令[：:]\s*(.+?)(?:\n|$)", _FLAGS), "密令抽奖"),
         # 格式2: 参与关键词：「xxx」 或 参与关键词：xxx
-        (r"参与关键词[：:]\s*[「「\"]?(.+?)[」」\"]?(?:\n|$)", "参与关键词"),
+        (re.compile(r"参与关键词[：:]\s*[「「\"]?(.+?)[」」\"]?(?:\n|$)", _FLAGS), "参与关键词"),
         # 格式3: 发送 xxx 进行领取（口令在中间，优先级最高）
-        (r"发送\s+(.+?)\s+进行领取", "红包口令-进行领取"),
+        (re.compile(r"发送\s+([^\n]{1,50}?)\s+进行领取", _FLAGS), "红包口令-进行领取"),
         # 格式3.5: 发送 xxx 领取 / 发送下方口令领取：xxx（口令在领取之后）
-        (r"发送.+(?:领取)[：:]?\s*(.+?)(?:\n|$)", "红包口令"),
+        (re.compile(r"发送[^\n]{1,100}领取[：:]?\s*(.+?)(?:\n|$)", _FLAGS), "红包口令"),
         # 格式4: 输入口令: xxx / 口令: xxx
-        (r"(?:输入)?口令[：:]\s*(.+?)(?:\n|$)", "口令"),
+        (re.compile(r"(?:输入)?口令[：:]\s*(.+?)(?:\n|$)", _FLAGS), "口令"),
         # 格式5: 回复 xxx 领取 / 回复 xxx 参与
-        (r"回复\s+(.+?)\s+(?:领取|参与)", "回复口令"),
+        (re.compile(r"回复\s+([^\n]{1,50}?)\s+(?:领取|参与)", _FLAGS), "回复口令"),
         # 格式6: 【拼手气红包】xxx (红包ID)
-        (r"【拼手气红包】\s*([a-zA-Z0-9\-]+)(?:\s|$)", "拼手气红包"),
+        (re.compile(r"【拼手气红包】\s*([a-zA-Z0-9\-]+)(?:\s|$)", _FLAGS), "拼手气红包"),
     ]
+    PATTERN_TYPES = frozenset(keyword_type for _, keyword_type in PATTERNS)
+
+    # 实体快速通道：口令通常放在 code/pre/bold 实体中，紧跟在这些标记之后
+    ENTITY_TYPES = ("code", "pre", "bold")  # 按优先级排序
+    ENTITY_MARKERS = ("口令", "关键词", "密令")
+    ENTITY_MARKER_WINDOW = 16  # 实体起点前多少个字符内出现标记才算数
+    # 标记后必须紧跟冒号，冒号与实体之间只允许空白或引号（排除 "口令红包 总额: **100**"）
+    ENTITY_MARKER_PATTERN = re.compile(
+        r"(" + "|".join(ENTITY_MARKERS) + r")\s*[：:][\s\"'“”「」【】]*$"
+    )
 
     @classmethod
-    def extract(cls, text: str) -> Optional[tuple[str, str]]:
+    def extract_from_entities(cls, text: str, entities: Optional[list]) -> Optional[tuple[str, str]]:
+        """
+        根据消息实体（code/pre/bold）直接切出口令
+        Telegram 实体的 offset/length 以 UTF-16 码元计，需在 UTF-16 编码上切片
+        返回: (口令内容, 口令类型) 或 None
+        """
+        if not text or not entities:
+            return None
+
+        candidates = []
+        for entity in entities:
+            entity_type = getattr(getattr(entity, "type", None), "name", "").lower()
+            if entity_type in cls.ENTITY_TYPES:
+                candidates.append((cls.ENTITY_TYPES.index(entity_type), entity.offset, entity.length, entity_type))
+        if not candidates:
+            return None
+        candidates.sort()
+
+        encoded = text.encode("utf-16-le")
+        for _, offset, length, entity_type in candidates:
+            start = offset * 2
+            end = (offset + length) * 2
+            if end > len(encoded):
+                continue  # 实体落在截断区域之外
+
+            # 实体需紧接在同一行的 "口令："/"关键词："/"密令：" 之后
+            window_start = max(0, start - cls.ENTITY_MARKER_WINDOW * 2)
+            prefix = encoded[window_start:start].decode("utf-16-le", errors="ignore")
+            prefix = prefix.rsplit("\n", 1)[-1]
+            marker_match = cls.ENTITY_MARKER_PATTERN.search(prefix)
+            if marker_match is None:
+                continue
+            marker = marker_match.group(1)
+
+            keyword = encoded[start:end].decode("utf-16-le", errors="ignore").strip()
+            keyword = keyword.strip('"\'「」【】')
+            if not keyword or "\n" in keyword or len(keyword) > 50 or keyword.startswith('/'):
+                continue
+            return (keyword, f"{marker}-{entity_type}实体")
+
+        return None
+
+    @classmethod
+    def extract(
+        cls,
+        text: str,
+        entities: Optional[list] = None,
+        preferred: Optional[List[str]] = None,
+    ) -> Optional[tuple[str, str]]:
         """
         从消息文本中提取口令
+        优先走消息实体快速通道，实体无结果时再按正则规则逐条匹配
+        preferred: 机器人画像中的常用规则，优先尝试，未命中再回退完整规则链
         返回: (口令内容, 口令类型) 或 None
         """
         if not text:
             return None
 
-        for pattern, keyword_type in cls.PATTERNS:
-            match = re.search(pattern, text, re.IGNORECASE | re.MULTILINE)
-            if match:
-                keyword = match.group(1).strip()
-                # 清理口令中的引号和多余空格
-                keyword = keyword.strip('"\'「」【】')
-                if keyword and len(keyword) > 0:
-                    # 忽略以 / 开头的命令类关键词（如 /mysterybox）
-                    if keyword.startswith('/'):
-                        return None
-                    return (keyword, keyword_type)
+        text = parse_guard.clip(text)
+        result = cls.extract_from_entities(text, entities)
+        if result:
+            return result
+
+        try:
+            for pattern, keyword_type in order_by_profile(cls.PATTERNS, preferred):
+                match = parse_guard.search(keyword_type, pattern, text)
+                if match:
+                    keyword = match.group(1).strip()
+                    # 清理口令中的引号和多余空格
+                    keyword = keyword.strip('"\'「」【】')
+                    if keyword and len(keyword) > 0:
+                        # 忽略以 / 开头的命令类关键词（如 /mysterybox）
+                        if keyword.startswith('/'):
+                            return None
+                        return (keyword, keyword_type)
+        except ParseBudgetExceeded:
+            logs.warning(f"[LuckyDraw] 口令提取超出解析预算，已放弃 | 长度: {len(text)}")
+            return None
 
         return None
 
 
+for _pattern, _keyword_type in KeywordExtractor.PATTERNS:
+    parse_guard.register(_keyword_type, _pattern)
+
+
 class SecurityChecker:
     """安全检测器"""
 
@@ -781,12 +1873,96 @@ class SecurityChecker:
         return True, "安全"
 
 
+# ==================== 热重启快照 ====================
+
+
+def save_state_snapshot() -> None:
+    """
+    将易失的内存状态写入快照文件（插件关闭时调用）
+    包括等待转发队列、进程内去重窗口、消息摘要、红包跟踪和发送预算窗口
+    关键词锁只在发送过程中持有，进程结束后没有意义，不写入快照
+    正在延时中的口令发送和按钮点击不写入快照：重新执行需要原消息对象和客户端，
+    插件启动时都拿不到，这些操作随卸载丢弃（只记录数量）
+    """
+    in_flight_sends = sum(len(waiters) for waiters in packet_tracker._events.values())
+    in_flight_clicks = sum(1 for task in _button_click_tasks if not task.done())
+    if in_flight_sends or in_flight_clicks:
+        logs.info(
+            f"[LuckyDraw] 卸载时丢弃延时中的操作 | 口令发送: {in_flight_sends} | 按钮点击: {in_flight_clicks}"
+        )
+    try:
+        data = {
+            "saved_at": time.time(),
+            "pending_draws": pending_draws,
+            "processed_messages": {
+                str(chat_id): list(keys)[-STATE_DEDUPE_KEEP:]
+                for chat_id, keys in _processed_messages.items() if keys
+            },
+            "message_digests": [
+                [chat_id, message_id, entry]
+                for (chat_id, message_id), entry in list(_message_digests.items())[-STATE_DIGEST_KEEP:]
+            ],
+            "packet_tracker": packet_tracker.snapshot(),
+            "send_scheduler": send_scheduler.snapshot(),
+        }
+        tmp_file = state_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_file, state_file)
+    except Exception as e:
+        logs.error(f"[LuckyDraw] 保存状态快照失败: {e}")
+
+
+def restore_state_snapshot() -> None:
+    """从快照文件恢复内存状态，过期条目直接丢弃（插件启动时调用）"""
+    if not state_file.exists():
+        return
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        logs.error(f"[LuckyDraw] 加载状态快照失败: {e}")
+        return
+    finally:
+        # 快照只用一次，避免之后的重启恢复到更旧的状态
+        state_file.unlink(missing_ok=True)
+
+    now = time.time()
+    age = now - data.get("saved_at", 0)
+
+    restored_pending = 0
+    for queue_key, pending in data.get("pending_draws", {}).items():
+        if now - pending.get("created_at", 0) > PENDING_DRAW_TTL:
+            continue
+        if config.has_sent_keyword(pending.get("chat_id"), pending.get("keyword")):
+            continue
+        pending_draws.setdefault(queue_key, pending)
+        restored_pending += 1
+
+    if age <= STATE_DEDUPE_TTL:
+        for chat_id, keys in data.get("processed_messages", {}).items():
+            for key in keys:
+                remember_processed(int(chat_id), key)
+        for chat_id, message_id, entry in data.get("message_digests", []):
+            _message_digests.setdefault((chat_id, message_id), entry)
+
+    restored_packets = packet_tracker.restore(data.get("packet_tracker", {}))
+    send_scheduler.restore(data.get("send_scheduler", {}))
+
+    logs.info(
+        f"[LuckyDraw] 已恢复状态快照 | 距上次关闭: {age:.0f}s | "
+        f"等待队列: {restored_pending} | 跟踪红包: {restored_packets}"
+    )
+
+
 # ==================== 生命周期钩子 ====================
 
 
 @Hook.on_startup()
 async def luckydraw_startup():
     """插件启动时执行"""
+    restore_state_snapshot()
+    load_shedder.start()
     logs.info("[LuckyDraw] 自动抽奖插件已加载")
 
 
@@ -796,6 +1972,8 @@ async def luckydraw_shutdown():
     # 关闭前确保所有待刷新的数据写入磁盘
     if config._pending_save:
         await config._flush_to_disk()
+    save_state_snapshot()
+    load_shedder.stop()
     logs.info("[LuckyDraw] 自动抽奖插件已卸载")
 
 
@@ -805,7 +1983,7 @@ async def luckydraw_shutdown():
 @listener(
     command="ldraw",
     description="自动抽奖管理命令",
-    parameters="<on|off|set|list|stats|help>",
+    parameters="<on|off|set|list|stats|trace|shadow|parse|profile|help>",
     is_plugin=True,
 )
 async def ldraw_command(message: Message):
@@ -834,6 +2012,16 @@ async def ldraw_command(message: Message):
         await set_delay(message)
     elif cmd == "listdelay":
         await list_delays(message)
+    elif cmd == "clicktimeout":
+        await set_click_timeout(message)
+    elif cmd == "policy":
+        await set_send_policy(message)
+    elif cmd == "shed":
+        await set_shed_threshold(message)
+    elif cmd == "trace":
+        await show_trace(message)
+    elif cmd == "shadow":
+        await manage_shadow(message)
     elif cmd == "list":
         await list_chats(message)
     elif cmd == "stats":
@@ -848,6 +2036,10 @@ async def ldraw_command(message: Message):
         await manage_bot(message)
     elif cmd == "sticker":
         await manage_sticker(message)
+    elif cmd == "parse":
+        await show_parse_guard(message)
+    elif cmd == "profile":
+        await show_parser_profiles(message)
     else:
         await show_help(message)
 
@@ -878,9 +2070,18 @@ async def show_help(message: Message):
 `,ldraw delayset <群组ID> <最小延时> [最大延时]` - 设置指定群组延时
 `,ldraw delayoff <群组ID>` - 移除指定群组延时
 `,ldraw listdelay` - 查看所有群组延时配置
+`,ldraw clicktimeout <秒数>` - 设置按钮回调应答等待时间
+`,ldraw policy <fifo|ev>` - 设置发送调度策略（ev: 按期望价值排序并受发送预算约束）
+`,ldraw trace [条数] [群组ID]` - 查看群组最近的决策记录（每一步跳过/发送的原因）
+`,ldraw shed` - 查看/设置负载降级阈值（事件循环繁忙时跳过调试日志、庆祝贴纸、编辑重新解析）
+`,ldraw shadow` - 影子模式：对未启用群组只跑检测不发送，评估 CPU 与发送预算占用
 `,ldraw list` - 查看所有启用的群组
 `,ldraw stats` - 查看统计信息
+`,ldraw stats <群组ID> [天数]` - 查看群组最近 N 天（默认 7，最多 30）的活跃度汇总
 `,ldraw test <文本>` - 测试口令提取功能
+`,ldraw parse` - 查看正则解析防护统计（慢输入记录）
+`,ldraw profile` - 查看机器人解析画像（`,ldraw profile clear` 清除）
+`,ldraw parse bench` - 对解析正则做模糊压测，检查超线性回溯
 `,ldraw clear` - 清除已发送口令记录
 
 **庆祝贴纸：**
@@ -985,13 +2186,75 @@ async def list_chats(message: Message):
 
 
 async def show_stats(message: Message):
-    """查看统计信息"""
-    result = config.get_stats()
+    """查看统计信息，或查看指定群组的小时活跃度汇总"""
+    params = message.arguments.split()
+    if len(params) >= 2:
+        try:
+            chat_id = int(params[1])
+            days = int(params[2]) if len(params) >= 3 else 7
+        except ValueError:
+            await message.edit("**参数错误！**\n\n使用方法: `,ldraw stats <群组ID> [天数]`")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+        await message.edit(activity.get_report(chat_id, max(1, min(days, ACTIVITY_DAYS))))
+        await asyncio.sleep(10)
+        await message.delete()
+        return
+
+    result = (
+        config.get_stats()
+        + packet_tracker.get_report()
+        + send_scheduler.get_report()
+        + load_shedder.get_report()
+    )
     await message.edit(result)
     await asyncio.sleep(5)
     await message.delete()
 
 
+async def show_parser_profiles(message: Message):
+    """查看或清除机器人解析画像"""
+    params = message.arguments.split()
+    if len(params) >= 2 and params[1].lower() == "clear":
+        config.parser_profiles = {}
+        config.save()
+        await message.edit("**已清除所有机器人解析画像**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    await message.edit(config.list_parser_profiles())
+    await asyncio.sleep(8)
+    await message.delete()
+
+
+async def show_parse_guard(message: Message):
+    """查看正则解析防护统计，或运行正则模糊压测"""
+    params = message.arguments.split()
+    if len(params) < 2 or params[1].lower() != "bench":
+        await message.edit(parse_guard.get_report())
+        await asyncio.sleep(8)
+        await message.delete()
+        return
+
+    await message.edit("**正在对口令解析正则进行模糊压测...**")
+    results = await asyncio.to_thread(parse_guard.benchmark)
+
+    output = f"**正则模糊压测结果（最长输入 {PARSE_BENCH_SIZES[-1]} 字符）：**\n\n"
+    flagged = 0
+    for item in results:
+        mark = "⚠️" if item["superlinear"] else "✅"
+        if item["superlinear"]:
+            flagged += 1
+        output += f"{mark} {item['name']} | 最坏 `{item['worst_ms']:.2f}ms` | 增长指数 `{item['exponent']:.2f}`\n"
+    output += f"\n共 {len(results)} 条规则，{flagged} 条增长超线性（指数 > {PARSE_BENCH_MAX_EXPONENT}）"
+
+    await message.edit(output)
+    await asyncio.sleep(15)
+    await message.delete()
+
+
 async def test_extract(message: Message):
     """测试口令提取功能"""
     params = message.arguments.split(maxsplit=1)
@@ -1010,6 +2273,7 @@ async def test_extract(message: Message):
         return
 
     test_text = params[1]
+    parse_guard.begin_message()
 
     # 检查是否是 multi 模式
     if test_text.lower().startswith("multi "):
@@ -1230,100 +2494,267 @@ async def manage_sticker(message: Message):
             await message.delete()
             return
 
-        reply_msg = message.reply_to_message
-        sticker = getattr(reply_msg, 'sticker', None)
+        reply_msg = message.reply_to_message
+        sticker = getattr(reply_msg, 'sticker', None)
+
+        if not sticker:
+            await message.edit("**回复的消息不是贴纸！**")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
+        file_id = getattr(sticker, 'file_id', None)
+        if not file_id:
+            await message.edit("**无法获取贴纸ID！**")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+
+        result = config.add_sticker(file_id)
+        await message.edit(f"**{result}**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    await message.edit("**未知操作！**\n\n支持的操作: list, add, del, clear")
+    await asyncio.sleep(3)
+    await message.delete()
+
+
+async def set_delay(message: Message):
+    """设置群组的延时"""
+    params = message.arguments.split()
+    
+    if len(params) < 2:
+        await message.edit(
+            "**参数错误！**\n\n"
+            "使用方法:\n"
+            "`,ldraw delay <延时秒数>` - 设置当前群组延时（最小~最大范围自动+3秒）\n"
+            "`,ldraw delay <最小延时> <最大延时>` - 设置精确范围\n"
+            "`,ldraw delay <群组ID> <延时>` - 设置指定群组延时\n"
+            "`,ldraw delay off` - 移除当前群组的自定义延时\n\n"
+            "示例:\n"
+            "`,ldraw delay 0.5` - 设置延时 0.5~3.5 秒\n"
+            "`,ldraw delay 2 5` - 设置延时 2~5 秒\n"
+            "`,ldraw delay -1001234567890 3` - 设置指定群组延时 3~6 秒"
+        )
+        await asyncio.sleep(10)
+        await message.delete()
+        return
+    
+    # 判断是设置还是移除
+    if params[1].lower() == "off":
+        # 移除当前群组的延时配置
+        if not message.chat or message.chat.id > 0:
+            await message.edit("此命令只能在群组中使用")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+        chat_id = message.chat.id
+        result = config.remove_chat_delay(chat_id)
+        await message.edit(f"**{result}**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+    
+    # 解析参数
+    try:
+        # 判断第一个参数是否是群组ID（负数）
+        if params[1].startswith("-"):
+            if len(params) < 3:
+                await message.edit("**参数错误！**\n\n需要指定延时值")
+                await asyncio.sleep(3)
+                await message.delete()
+                return
+            chat_id = int(params[1])
+            min_delay = float(params[2])
+            max_delay = float(params[3]) if len(params) > 3 else None
+        else:
+            # 当前群组
+            if not message.chat or message.chat.id > 0:
+                await message.edit("此命令只能在群组中使用")
+                await asyncio.sleep(3)
+                await message.delete()
+                return
+            chat_id = message.chat.id
+            min_delay = float(params[1])
+            max_delay = float(params[2]) if len(params) > 2 else None
+        
+        result = config.set_chat_delay(chat_id, min_delay, max_delay)
+        await message.edit(f"**{result}**")
+        await asyncio.sleep(3)
+        await message.delete()
+    except ValueError:
+        await message.edit("**参数错误！**\n\n请输入有效的数字")
+        await asyncio.sleep(3)
+        await message.delete()
+
+
+async def manage_shadow(message: Message):
+    """管理影子模式（只跑检测流程、不发送，用于评估群组的 CPU 与发送预算占用）"""
+    params = message.arguments.split()
+    action = params[1].lower() if len(params) >= 2 else "report"
+
+    if action == "report":
+        if len(params) >= 3:
+            try:
+                result = shadow_monitor.get_report(int(params[2]))
+            except ValueError:
+                result = "**群组ID格式错误！**\n\n请输入有效的数字ID"
+        else:
+            result = shadow_monitor.get_report()
+        await message.edit(result)
+        await asyncio.sleep(10)
+        await message.delete()
+        return
+
+    if action == "all":
+        config.shadow_all = len(params) < 3 or params[2].lower() != "off"
+        config.save()
+        state = "开启" if config.shadow_all else "关闭"
+        await message.edit(f"**已{state}所有未启用群组的影子模式**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    if action == "clear":
+        shadow_monitor.chats.clear()
+        shadow_monitor.sent_keywords.clear()
+        await message.edit("**已清除影子模式统计**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    if action in ["add", "del", "remove", "delete"]:
+        try:
+            chat_id = int(params[2]) if len(params) >= 3 else message.chat.id
+        except ValueError:
+            await message.edit("**群组ID格式错误！**\n\n请输入有效的数字ID")
+            await asyncio.sleep(3)
+            await message.delete()
+            return
+        if action == "add":
+            config.shadow_chats.add(chat_id)
+            result = f"已对群组 `{chat_id}` 开启影子模式"
+        else:
+            config.shadow_chats.discard(chat_id)
+            result = f"已关闭群组 `{chat_id}` 的影子模式"
+        config.save()
+        await message.edit(f"**{result}**")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    await message.edit(
+        "**影子模式**\n\n"
+        "使用方法:\n"
+        "`,ldraw shadow` - 查看影子模式报告\n"
+        "`,ldraw shadow report <群组ID>` - 查看指定群组详情\n"
+        "`,ldraw shadow add [群组ID]` - 对指定群组开启影子模式\n"
+        "`,ldraw shadow del [群组ID]` - 关闭指定群组的影子模式\n"
+        "`,ldraw shadow all [off]` - 对所有未启用群组开启/关闭影子模式\n"
+        "`,ldraw shadow clear` - 清除影子模式统计\n\n"
+        "💡 影子模式只运行检测流程，不会发送任何消息"
+    )
+    await asyncio.sleep(8)
+    await message.delete()
+
+
+async def show_trace(message: Message):
+    """查看群组最近的决策追踪"""
+    params = message.arguments.split()
+    try:
+        count = int(params[1]) if len(params) >= 2 else TRACE_DEFAULT_COUNT
+        chat_id = int(params[2]) if len(params) >= 3 else message.chat.id
+    except ValueError:
+        await message.edit(
+            "**参数错误！**\n\n"
+            "使用方法:\n"
+            "`,ldraw trace [条数] [群组ID]` - 查看群组最近的决策记录"
+        )
+        await asyncio.sleep(3)
+        await message.delete()
+        return
+
+    count = max(1, min(count, TRACE_SIZE))
+    await message.edit(decision_trace.dump(chat_id, count))
+    await asyncio.sleep(15)
+    await message.delete()
+
+
+async def set_shed_threshold(message: Message):
+    """查看负载降级状态或设置降级阈值"""
+    params = message.arguments.split()
+    if len(params) < 3:
+        await message.edit(
+            load_shedder.get_report().strip() + "\n\n"
+            "使用方法:\n"
+            "`,ldraw shed <debug|sticker|edit> <毫秒>` - 事件循环延迟超过阈值时跳过该环节"
+        )
+        await asyncio.sleep(8)
+        await message.delete()
+        return
+
+    try:
+        threshold = float(params[2]) / 1000
+    except ValueError:
+        await message.edit("**阈值格式错误！**\n\n请输入毫秒数")
+        await asyncio.sleep(3)
+        await message.delete()
+        return
 
-        if not sticker:
-            await message.edit("**回复的消息不是贴纸！**")
-            await asyncio.sleep(3)
-            await message.delete()
-            return
+    result = config.set_shed_threshold(params[1].lower(), threshold)
+    await message.edit(f"**{result}**")
+    await asyncio.sleep(3)
+    await message.delete()
 
-        file_id = getattr(sticker, 'file_id', None)
-        if not file_id:
-            await message.edit("**无法获取贴纸ID！**")
-            await asyncio.sleep(3)
-            await message.delete()
-            return
 
-        result = config.add_sticker(file_id)
-        await message.edit(f"**{result}**")
-        await asyncio.sleep(3)
+async def set_send_policy(message: Message):
+    """设置发送调度策略"""
+    params = message.arguments.split()
+    if len(params) < 2:
+        await message.edit(
+            "**发送调度策略**\n\n"
+            f"当前: `{config.send_policy}`\n\n"
+            "`,ldraw policy fifo` - 按到达顺序发送（默认）\n"
+            "`,ldraw policy ev` - 按期望价值（总额/剩余个数 × 历史中奖率）排序，"
+            f"受每群 {SEND_BUDGET_PER_CHAT} 次 / 全局 {SEND_BUDGET_GLOBAL} 次（每 {SEND_BUDGET_WINDOW:.0f} 秒）发送预算约束"
+        )
+        await asyncio.sleep(8)
         await message.delete()
         return
 
-    await message.edit("**未知操作！**\n\n支持的操作: list, add, del, clear")
+    result = config.set_send_policy(params[1].lower())
+    await message.edit(f"**{result}**")
     await asyncio.sleep(3)
     await message.delete()
 
 
-async def set_delay(message: Message):
-    """设置群组的延时"""
+async def set_click_timeout(message: Message):
+    """设置按钮回调应答等待时间"""
     params = message.arguments.split()
-    
     if len(params) < 2:
         await message.edit(
             "**参数错误！**\n\n"
             "使用方法:\n"
-            "`,ldraw delay <延时秒数>` - 设置当前群组延时（最小~最大范围自动+3秒）\n"
-            "`,ldraw delay <最小延时> <最大延时>` - 设置精确范围\n"
-            "`,ldraw delay <群组ID> <延时>` - 设置指定群组延时\n"
-            "`,ldraw delay off` - 移除当前群组的自定义延时\n\n"
-            "示例:\n"
-            "`,ldraw delay 0.5` - 设置延时 0.5~3.5 秒\n"
-            "`,ldraw delay 2 5` - 设置延时 2~5 秒\n"
-            "`,ldraw delay -1001234567890 3` - 设置指定群组延时 3~6 秒"
+            "`,ldraw clicktimeout <秒数>` - 设置点击按钮后等待机器人应答的时间（0.5~30 秒）\n\n"
+            f"当前: {config.button_answer_timeout} 秒"
         )
-        await asyncio.sleep(10)
-        await message.delete()
-        return
-    
-    # 判断是设置还是移除
-    if params[1].lower() == "off":
-        # 移除当前群组的延时配置
-        if not message.chat or message.chat.id > 0:
-            await message.edit("此命令只能在群组中使用")
-            await asyncio.sleep(3)
-            await message.delete()
-            return
-        chat_id = message.chat.id
-        result = config.remove_chat_delay(chat_id)
-        await message.edit(f"**{result}**")
-        await asyncio.sleep(3)
+        await asyncio.sleep(5)
         await message.delete()
         return
-    
-    # 解析参数
+
     try:
-        # 判断第一个参数是否是群组ID（负数）
-        if params[1].startswith("-"):
-            if len(params) < 3:
-                await message.edit("**参数错误！**\n\n需要指定延时值")
-                await asyncio.sleep(3)
-                await message.delete()
-                return
-            chat_id = int(params[1])
-            min_delay = float(params[2])
-            max_delay = float(params[3]) if len(params) > 3 else None
-        else:
-            # 当前群组
-            if not message.chat or message.chat.id > 0:
-                await message.edit("此命令只能在群组中使用")
-                await asyncio.sleep(3)
-                await message.delete()
-                return
-            chat_id = message.chat.id
-            min_delay = float(params[1])
-            max_delay = float(params[2]) if len(params) > 2 else None
-        
-        result = config.set_chat_delay(chat_id, min_delay, max_delay)
-        await message.edit(f"**{result}**")
-        await asyncio.sleep(3)
-        await message.delete()
+        result = config.set_button_answer_timeout(float(params[1]))
     except ValueError:
         await message.edit("**参数错误！**\n\n请输入有效的数字")
         await asyncio.sleep(3)
         await message.delete()
+        return
+
+    await message.edit(f"**{result}**")
+    await asyncio.sleep(3)
+    await message.delete()
 
 
 async def list_delays(message: Message):
@@ -1437,6 +2868,190 @@ async def remove_delay_by_chat_id(message: Message) -> None:
     await message.delete()
 
 
+# ==================== 影子模式 ====================
+
+
+def plan_draws(text: str, entities: Optional[list], sender_id: Optional[int]) -> List[dict]:
+    """
+    只运行检测流程，返回本应执行的参与动作，不发送、不修改任何状态
+    与 luckydraw_handler 使用相同的解析函数和模式判断
+    返回: [{"keyword", "keyword_type", "mode", "count", "blocked"}]
+    mode: direct（直接发送）/ forward（等待转发）/ lottery（转发抽奖原文）
+    """
+    text_lower = text.lower()
+    if any(exclude_keyword in text_lower for exclude_keyword in SELF_EXCLUSION_KEYWORDS):
+        return []
+    if is_red_packet_finished(text):
+        return []
+
+    plans = []
+    red_packet_blocks = split_multiple_red_packets(text)
+    if red_packet_blocks and len(red_packet_blocks) > 1:
+        block_order = config.get_parser_order(sender_id, "block")
+        for block in red_packet_blocks:
+            block_result = extract_keyword_from_block(block, block_order)
+            if not block_result or is_red_packet_finished(block):
+                continue
+            keyword, keyword_type = block_result
+            count = extract_red_packet_count(block)
+            is_safe, reason = SecurityChecker.is_safe(block, keyword)
+            plans.append({
+                "keyword": keyword,
+                "keyword_type": keyword_type,
+                "mode": "forward" if count is not None and count >= REDPACKET_COUNT_THRESHOLD else "direct",
+                "count": count,
+                "blocked": None if is_safe else reason,
+            })
+        return plans
+
+    result = KeywordExtractor.extract(text, entities, config.get_parser_order(sender_id, "text"))
+    if not result:
+        return []
+    keyword, keyword_type = result
+    is_safe, reason = SecurityChecker.is_safe(text, keyword)
+    count = extract_red_packet_count(text)
+    if is_lottery_bot_message(text):
+        mode = "lottery"
+    elif count is not None and count >= REDPACKET_COUNT_THRESHOLD:
+        mode = "forward"
+    else:
+        mode = "direct"
+    plans.append({
+        "keyword": keyword,
+        "keyword_type": keyword_type,
+        "mode": mode,
+        "count": count,
+        "blocked": None if is_safe else reason,
+    })
+    return plans
+
+
+class ShadowMonitor:
+    """
+    影子模式统计（进程内）
+    记录每个群组的消息处理耗时、符合条件的抽奖数量，以及本应发送的口令
+    用于在启用新群组前评估其 CPU 与发送预算占用
+    """
+
+    def __init__(self):
+        self.chats: Dict[int, dict] = {}
+        # 独立的消息摘要缓存，避免 shadow all 时大量群组挤掉实际流程的去重条目
+        self.digests: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.sent_keywords: Dict[int, "OrderedDict[str, None]"] = {}  # 本应已发送的口令
+
+    def would_skip_sent(self, chat_id: int, keyword: str) -> bool:
+        """与实际流程相同的已发送检查：口令已发送过（或本应已发送过）则不再计入发送"""
+        if config.has_sent_keyword(chat_id, keyword):
+            return True
+        sent = self.sent_keywords.setdefault(chat_id, OrderedDict())
+        if keyword in sent:
+            return True
+        sent[keyword] = None
+        while len(sent) > SHADOW_SENT_KEEP:
+            sent.popitem(last=False)
+        return False
+
+    def record(self, chat_id: int, cost: float, plans: List[dict]) -> None:
+        """记录一条消息的影子处理结果"""
+        stats = self.chats.get(chat_id)
+        if stats is None:
+            stats = self.chats[chat_id] = {
+                "since": time.time(),
+                "messages": 0,
+                "total_cost": 0.0,
+                "max_cost": 0.0,
+                "draws": 0,
+                "sends": 0,
+                "blocked": 0,
+                "recent": deque(maxlen=SHADOW_RECENT_SIZE),
+            }
+        stats["messages"] += 1
+        stats["total_cost"] += cost
+        stats["max_cost"] = max(stats["max_cost"], cost)
+        for plan in plans:
+            stats["draws"] += 1
+            if plan["blocked"]:
+                stats["blocked"] += 1
+                continue
+            if self.would_skip_sent(chat_id, plan["keyword"]):
+                continue
+            stats["sends"] += 1
+            stats["recent"].append((time.time(), plan["keyword"], plan["mode"]))
+
+    def get_report(self, chat_id: Optional[int] = None) -> str:
+        """获取影子模式报告"""
+        if chat_id is not None:
+            stats = self.chats.get(chat_id)
+            if stats is None:
+                return f"群组 `{chat_id}` 暂无影子模式数据"
+            return self._format_chat(chat_id, stats, detail=True)
+
+        output = "**影子模式：**\n\n"
+        output += f"- 所有未启用群组: `{'开启' if config.shadow_all else '关闭'}`\n"
+        output += f"- 指定群组: `{len(config.shadow_chats)}` 个\n\n"
+        if not self.chats:
+            return output + "暂无影子模式数据"
+        ranked = sorted(self.chats.items(), key=lambda item: item[1]["sends"], reverse=True)
+        for chat_id, stats in ranked[:10]:
+            output += self._format_chat(chat_id, stats, detail=False)
+        return output
+
+    @staticmethod
+    def _format_chat(chat_id: int, stats: dict, detail: bool) -> str:
+        hours = max((time.time() - stats["since"]) / 3600, 1 / 60)
+        avg_us = stats["total_cost"] / stats["messages"] * 1_000_000 if stats["messages"] else 0.0
+        output = (
+            f"- 群组 `{chat_id}`: {stats['messages']} 条消息 | "
+            f"平均 `{avg_us:.0f}µs` / 最大 `{stats['max_cost'] * 1000:.2f}ms` | "
+            f"抽奖 `{stats['draws'] / hours:.1f}`/小时 | 发送 `{stats['sends'] / hours:.1f}`/小时\n"
+        )
+        if detail:
+            output += f"  累计 CPU: `{stats['total_cost'] * 1000:.1f}ms` | 安全拦截: `{stats['blocked']}`\n"
+            if stats["recent"]:
+                output += "\n**最近本应发送：**\n"
+                for sent_at, keyword, mode in stats["recent"]:
+                    output += f"- {time.strftime('%H:%M:%S', time.localtime(sent_at))} | {mode} | `{keyword}`\n"
+        return output
+
+
+# 全局影子模式实例
+shadow_monitor = ShadowMonitor()
+
+
+def shadow_process(message: Message, chat_id: int, started: float) -> None:
+    """对未启用的影子群组运行检测流程，只记录不发送"""
+    sender_id = None
+    if getattr(message, 'sender_chat', None):
+        sender_id = message.sender_chat.id
+    elif getattr(message, 'from_user', None):
+        sender_id = message.from_user.id
+    forward_source = getattr(message, "forward_from", None) or getattr(message, "forward_from_chat", None)
+    if forward_source:
+        sender_id = getattr(forward_source, "id", sender_id)
+
+    plans = []
+    if config.is_bot_allowed(sender_id):
+        text = message.text
+        entities = getattr(message, 'entities', None)
+        if not text:
+            text = getattr(message, 'caption', None)
+            entities = getattr(message, 'caption_entities', None)
+        if text:
+            text = parse_guard.clip(text)
+            parse_guard.begin_message()
+            digest, stable_digest = content_digests(text)
+            cached = shadow_monitor.digests.get((chat_id, message.id))
+            # 与实际流程一致：计数类编辑不会重新解析
+            remember_message_digest(
+                chat_id, message.id, digest, stable_digest,
+                shadow_monitor.digests, SHADOW_DIGEST_CACHE_SIZE,
+            )
+            if cached is None or cached["stable_digest"] != stable_digest:
+                plans = plan_draws(text, entities, sender_id)
+
+    shadow_monitor.record(chat_id, time.perf_counter() - started, plans)
+
+
 # ==================== 自动抽奖监听器 ====================
 
 
@@ -1451,26 +3066,19 @@ async def luckydraw_handler(message: Message, bot: Client):
     if not message.chat:
         return
 
+    started = time.perf_counter()
     chat_id = message.chat.id
-    is_test = config.is_test_chat(chat_id)
+    message_id = message.id
 
     # 检查是否在启用的群组中
     if not config.is_enabled(chat_id):
-        if is_test:
-            logs.info(f"[LuckyDraw] 群组 {chat_id} 未启用，跳过")
+        if config.is_shadow_chat(chat_id):
+            # 影子模式：只跑检测流程并记录，不发送
+            shadow_process(message, chat_id, started)
         return
 
-    # 打印所有消息属性用于调试
-    if is_test:
-        logs.info(f"[LuckyDraw] ===== 收到消息 =====")
-        logs.info(f"[LuckyDraw] message.text: {message.text}")
-        logs.info(f"[LuckyDraw] message.caption: {getattr(message, 'caption', 'N/A')}")
-        logs.info(f"[LuckyDraw] message.raw_text: {getattr(message, 'raw_text', 'N/A')}")
-        logs.info(f"[LuckyDraw] message.forward_from: {message.forward_from}")
-        logs.info(f"[LuckyDraw] message.forward_from_chat: {message.forward_from_chat}")
-        logs.info(f"[LuckyDraw] message.media: {getattr(message, 'media', 'N/A')}")
-        logs.info(f"[LuckyDraw] message.chat.id: {chat_id}")
-        logs.info(f"[LuckyDraw] message.sender_id: {getattr(message, 'sender_id', 'N/A')}")
+    is_test = config.is_test_chat(chat_id)
+    trace = decision_trace.record
 
     # ========== 机器人ID检测 ==========
     # 只处理白名单中机器人发布的抽奖消息
@@ -1498,127 +3106,146 @@ async def luckydraw_handler(message: Message, bot: Client):
         # 转发自频道/群组
         actual_sender_id = getattr(forward_from_chat, "id", sender_id)
     
-    if is_test:
-        logs.info(f"[LuckyDraw] sender_chat: {getattr(message, 'sender_chat', None)}")
-        logs.info(f"[LuckyDraw] from_user: {getattr(message, 'from_user', None)}")
-        logs.info(f"[LuckyDraw] sender_id: {sender_id}, actual_sender_id: {actual_sender_id}")
-    
     # 检查发送者是否在白名单中
     if not config.is_bot_allowed(actual_sender_id):
-        if is_test:
-            logs.info(f"[LuckyDraw] 发送者 {actual_sender_id} 不在白名单中，跳过")
         return
-    
-    if is_test:
-        logs.info(f"[LuckyDraw] 发送者 {actual_sender_id} 在白名单中，继续处理")
 
     # 尝试获取消息文本（支持转发消息和媒体消息）
     text = message.text
+    entities = getattr(message, 'entities', None)
     if not text:
         # 尝试获取 media 的 caption
         text = getattr(message, 'caption', None)
+        entities = getattr(message, 'caption_entities', None)
     if not text:
         text = getattr(message, 'raw_text', None)
-    
-    if is_test:
-        logs.info(f"[LuckyDraw] 最终获取的text: {text[:100] if text else 'None'}...")
+        entities = None
 
     # 检查是否有消息文本
     if not text:
-        if is_test:
-            logs.info(f"[LuckyDraw] 无法获取消息文本，跳过")
+        trace(chat_id, message_id, "跳过:无文本", actual_sender_id)
         return
-
+    trace(chat_id, message_id, "收到: 发送者 {} | {} 字", (actual_sender_id, len(text)))
+
+    # 超长消息截断，并为本条消息重置解析时间预算
+    text = parse_guard.clip(text)
+    parse_guard.begin_message()
+
+    # ========== 编辑消息增量处理 ==========
+    digest, stable_digest = content_digests(text)
+    cached = _message_digests.get((chat_id, message_id))
+    if cached is not None:
+        if cached["digest"] == digest:
+            # 内容完全相同的编辑，直接跳过
+            trace(chat_id, message_id, "跳过:内容未变化")
+            return
+        if cached["stable_digest"] == stable_digest:
+            # 只有计数变化，口令区域未变，仅更新个数（个数归零时跟踪器会取消相关发送）
+            entry = remember_message_digest(chat_id, message_id, digest, stable_digest)
+            remaining = packet_tracker.update_message(chat_id, message_id, text, entry.get("multi", False))
+            entry["count"] = remaining if remaining is not None else extract_red_packet_count(text)
+            trace(chat_id, message_id, "仅计数变化", entry["count"])
+            return
+        if not load_shedder.allow("edit"):
+            # 事件循环繁忙：暂不重新解析口令区域的变化，只更新个数；摘要保持旧值，下次编辑时再处理
+            packet_tracker.update_message(chat_id, message_id, text, cached.get("multi", False))
+            # 结束检测开销很小且不能丢失（机器人的最后一次编辑可能就是"已领完"），始终执行
+            if check_red_packet_finished(text, chat_id):
+                trace(chat_id, message_id, "已结束:清除口令记录")
+                return
+            trace(chat_id, message_id, "跳过:负载过高，暂不重新解析编辑")
+            return
+    digest_entry = remember_message_digest(chat_id, message_id, digest, stable_digest)
+    if cached is not None:
+        packet_tracker.update_message(chat_id, message_id, text, digest_entry.get("multi", False))
 
     # 检查消息是否包含自排除关键词，如果是则不参与抽奖
     text_lower = text.lower()
     for exclude_keyword in SELF_EXCLUSION_KEYWORDS:
         if exclude_keyword in text_lower:
-            if is_test:
-                logs.info(f"[LuckyDraw] 检测到自排除关键词 '{exclude_keyword}'，跳过")
+            trace(chat_id, message_id, "跳过:自排除关键词", exclude_keyword)
             return
 
     # 检查是否红包已领完，如果是则清除该口令记录
-    if check_red_packet_finished(text, chat_id, is_test):
+    if check_red_packet_finished(text, chat_id):
+        trace(chat_id, message_id, "已结束:清除口令记录")
         return
 
     # 检查消息是否已处理（去重）- 进程内快速检查
-    message_id = message.id
     # 先检查进程内缓存（快速路径）
-    if message_id in _processed_messages[chat_id]:
-        if is_test:
-            logs.info(f"[LuckyDraw] 消息已处理过(进程内)，跳过 | message_id: {message_id}")
+    if str(message_id) in _processed_messages[chat_id]:
+        trace(chat_id, message_id, "跳过:已处理(进程内)")
         return
     # 再检查磁盘（慢速路径）
     if config.is_message_processed(chat_id, message_id):
-        _processed_messages[chat_id].add(str(message_id))  # 记录到进程内缓存
-        if is_test:
-            logs.info(f"[LuckyDraw] 消息已处理过(磁盘)，跳过 | message_id: {message_id}")
+        remember_processed(chat_id, str(message_id))  # 记录到进程内缓存
+        trace(chat_id, message_id, "跳过:已处理(磁盘)")
         return
     # 标记已处理
     config.mark_message_processed(chat_id, message_id)
-    _processed_messages[chat_id].add(str(message_id))
-    # 限制进程内缓存大小，防止内存泄漏
-    if len(_processed_messages[chat_id]) > 500:
-        # 只保留最近的200条
-        _processed_messages[chat_id] = set(list(_processed_messages[chat_id])[-200:])
+    remember_processed(chat_id, str(message_id))
 
     # ========== 检查是否包含多条红包 ==========
     red_packet_blocks = split_multiple_red_packets(text)
 
-    if is_test:
-        if red_packet_blocks:
-            logs.info(f"[LuckyDraw] 检测到多条红包，共 {len(red_packet_blocks)} 个")
-        else:
-            logs.info(f"[LuckyDraw] 单条红包消息")
-
     if red_packet_blocks and len(red_packet_blocks) > 1:
+        trace(chat_id, message_id, "多红包", len(red_packet_blocks))
         # ========== 多条红包：逐个处理每个红包 ==========
         # 标记消息已处理（防止重复）
         # 实际上每个红包是独立的，这里不需要标记整条消息
 
         processed_keywords = set()  # 记录本消息中已处理的口令（避免重复）
+        digest_entry["multi"] = True
+        config.record_parser_hit(actual_sender_id, "format", "multi")
+        block_order = config.get_parser_order(actual_sender_id, "block")
+
+        ordered_blocks = list(enumerate(red_packet_blocks))
+        if config.send_policy == "ev":
+            # ev 策略：按期望价值从高到低处理各红包块
+            ordered_blocks.sort(
+                key=lambda item: estimate_draw_value(chat_id, item[1], extract_red_packet_count(item[1])),
+                reverse=True,
+            )
 
-        for i, block in enumerate(red_packet_blocks):
-            # 从单个红包块提取口令
-            block_result = extract_keyword_from_block(block)
+        for i, block in ordered_blocks:
+            # 从单个红包块提取口令（按机器人画像优先尝试常用规则）
+            block_result = extract_keyword_from_block(block, block_order)
             if not block_result:
-                if is_test:
-                    logs.info(f"[LuckyDraw] 红包块 {i+1}: 无法提取口令")
+                trace(chat_id, message_id, "红包块{}:无法提取口令", i + 1)
                 continue
 
             keyword, keyword_type = block_result
+            config.record_parser_hit(actual_sender_id, "block", keyword_type)
+            block_order = config.get_parser_order(actual_sender_id, "block")
 
             # 检查是否已处理过这个口令
             if keyword in processed_keywords or config.has_sent_keyword(chat_id, keyword):
-                if is_test:
-                    logs.info(f"[LuckyDraw] 红包块 {i+1}: 口令已发送过，跳过 | {keyword}")
+                trace(chat_id, message_id, "红包块{}:口令已发送过: {}", (i + 1, keyword))
                 continue
 
             processed_keywords.add(keyword)
 
             # 检查是否红包已领完
-            if check_red_packet_finished(block, chat_id, is_test):
-                if is_test:
-                    logs.info(f"[LuckyDraw] 红包块 {i+1}: 红包已领完，跳过 | {keyword}")
+            if check_red_packet_finished(block, chat_id):
+                trace(chat_id, message_id, "红包块{}:已领完: {}", (i + 1, keyword))
                 continue
 
-            # 提取单个红包的剩余个数
+            # 提取单个红包的剩余个数，并开始跟踪
+            packet_tracker.update(chat_id, message_id, block, i)
             red_packet_count = extract_red_packet_count(block)
 
             # 判断模式
             use_forward_mode = red_packet_count is not None and red_packet_count >= REDPACKET_COUNT_THRESHOLD
 
-            if is_test:
-                count_info = f"剩余{red_packet_count}个" if red_packet_count else "个数未知"
-                mode = "转发模式" if use_forward_mode else "直接发送"
-                logs.info(f"[LuckyDraw] 红包块 {i+1}: {count_info} | {mode} | 口令: {keyword}")
+            trace(
+                chat_id, message_id, "红包块{}:检测到口令: {} | {} | {} | {}",
+                (i + 1, keyword, keyword_type, red_packet_count, "转发模式" if use_forward_mode else "直接发送"),
+            )
 
             # 安全检测
             is_safe, reason = SecurityChecker.is_safe(block, keyword)
             if not is_safe:
-                if is_test:
-                    logs.info(f"[LuckyDraw] 红包块 {i+1}: 安全拦截 {reason}")
+                trace(chat_id, message_id, "红包块{}:安全拦截: {}", (i + 1, reason))
                 continue
 
             if not use_forward_mode:
@@ -1626,12 +3253,18 @@ async def luckydraw_handler(message: Message, bot: Client):
                 # 获取延时配置
                 min_delay, max_delay = config.get_chat_delay(chat_id)
                 delay = random.uniform(min_delay, max_delay)
-                await asyncio.sleep(delay)
+                if await packet_tracker.wait(chat_id, message_id, i, delay):
+                    trace(chat_id, message_id, "红包块{}:延时中领完，取消发送: {}", (i + 1, keyword))
+                    continue
+                if not await acquire_send_slot(chat_id, block, red_packet_count, keyword):
+                    trace(chat_id, message_id, "红包块{}:发送预算不足，丢弃: {}", (i + 1, keyword))
+                    continue
 
                 try:
                     await bot.send_message(chat_id, keyword)
                     config.mark_keyword_sent(chat_id, keyword)
-                    config.increment_joined()
+                    config.increment_joined(chat_id)
+                    trace(chat_id, message_id, "红包块{}:已发送: {} | 延迟 {:.2f}s", (i + 1, keyword, delay))
 
                     logs.info(
                         f"[LuckyDraw] 多红包-直接发送 | 群组: {chat_id} | "
@@ -1644,45 +3277,50 @@ async def luckydraw_handler(message: Message, bot: Client):
                 queue_key = f"{chat_id}_{message_id}_{i}"
                 pending_draws[queue_key] = {
                     "keyword": keyword,
+                    "keyword_normalized": normalize_text(keyword),
                     "keyword_type": keyword_type,
                     "chat_id": chat_id,
                     "source_message_id": message_id,
                     "block_index": i,
+                    "text": block,
+                    "count": red_packet_count,
+                    "created_at": time.time(),
                 }
-
-                if is_test:
-                    logs.info(f"[LuckyDraw] 红包块 {i+1}: 已加入转发队列 | 口令: {keyword}")
+                trace(chat_id, message_id, "红包块{}:加入转发队列: {}", (i + 1, keyword))
 
         # 多红包消息处理完成
         return
 
     # ========== 单条红包消息处理 ==========
-    # 提取口令
-    result = KeywordExtractor.extract(text)
+    # 提取口令（优先从消息实体中切出，其次按机器人画像优先尝试常用规则）
+    result = KeywordExtractor.extract(text, entities, config.get_parser_order(actual_sender_id, "text"))
     if not result:
-        if is_test:
-            logs.info(f"[LuckyDraw] 未匹配到口令格式")
+        trace(chat_id, message_id, "跳过:未匹配到口令格式")
         return
 
     keyword, keyword_type = result
+    digest_entry["keyword"] = keyword
+    digest_entry["keyword_type"] = keyword_type
+    config.record_parser_hit(actual_sender_id, "format", "single")
+    if keyword_type in KeywordExtractor.PATTERN_TYPES:
+        config.record_parser_hit(actual_sender_id, "text", keyword_type)
     
     # 检查口令是否已发送过
     if config.has_sent_keyword(chat_id, keyword):
-        if is_test:
-            logs.info(f"[LuckyDraw] 口令已发送过，跳过 | 口令: {keyword}")
+        trace(chat_id, message_id, "跳过:口令已发送过", keyword)
         return
 
-    if is_test:
-        logs.info(f"[LuckyDraw] 检测到口令 | 类型: {keyword_type} | 口令: {keyword}")
+    trace(chat_id, message_id, "检测到口令", (keyword, keyword_type))
 
     # 增加检测计数
-    config.increment_detected()
+    config.increment_detected(chat_id)
 
     # 安全检测
     is_safe, reason = SecurityChecker.is_safe(text, keyword)
     if not is_safe:
-        config.increment_blocked()
+        config.increment_blocked(chat_id)
         logs.warning(f"[LuckyDraw] 拦截可疑抽奖: {reason}, 口令: {keyword}")
+        trace(chat_id, message_id, "安全拦截", reason)
         if is_test:
             try:
                 await bot.send_message(chat_id, f"⚠️ 安全拦截: {reason}")
@@ -1694,13 +3332,12 @@ async def luckydraw_handler(message: Message, bot: Client):
     # 抽奖机器人使用关键词匹配，只要消息包含关键词即可参与
     # 直接转发原文参与抽奖（不需要等待用户回复）
     if is_lottery_bot_message(text):
-        if is_test:
-            logs.info(f"[LuckyDraw] 检测到抽奖机器人消息，直接转发原文参与 | 口令: {keyword}")
-        
+        trace(chat_id, message_id, "抽奖机器人消息:转发原文", keyword)
         try:
             await bot.forward_messages(chat_id, chat_id, message.id)
             config.mark_keyword_sent(chat_id, keyword)
-            config.increment_joined()
+            config.record_activity(chat_id, "forwarded")
+            config.increment_joined(chat_id)
             logs.info(f"[LuckyDraw] 成功参与抽奖（转发抽奖机器人原文） | 群组: {chat_id} | 口令: {keyword}")
             
             if is_test:
@@ -1714,39 +3351,37 @@ async def luckydraw_handler(message: Message, bot: Client):
 
     # ========== 红包个数判断 ==========
     # 提取红包个数，判断使用哪种参与方式
+    packet_tracker.update(chat_id, message_id, text)
     red_packet_count = extract_red_packet_count(text)
-
-    if is_test:
-        logs.info(f"[LuckyDraw] 解析红包个数: {red_packet_count}")
+    digest_entry["count"] = red_packet_count
 
     # 红包个数 < 阈值 或 无法解析个数：直接发送关键词
     # 红包个数 >= 阈值：等待群里有人回复后再转发
     use_forward_mode = red_packet_count is not None and red_packet_count >= REDPACKET_COUNT_THRESHOLD
-
-    if is_test:
-        if use_forward_mode:
-            logs.info(f"[LuckyDraw] 红包个数 {red_packet_count} >= {REDPACKET_COUNT_THRESHOLD}，使用转发模式")
-        else:
-            mode_desc = f"红包个数 {red_packet_count}" if red_packet_count else "无法解析红包个数"
-            logs.info(f"[LuckyDraw] {mode_desc} < {REDPACKET_COUNT_THRESHOLD}，直接发送关键词")
+    trace(chat_id, message_id, "转发模式: 个数 {}" if use_forward_mode else "直接发送: 个数 {}", red_packet_count)
 
     if not use_forward_mode:
         # ========== 直接发送关键词模式 ==========
         # 检查是否已有相同口令在队列中，避免重复发送
         if config.has_sent_keyword(chat_id, keyword):
-            if is_test:
-                logs.info(f"[LuckyDraw] 口令已发送过，跳过 | 口令: {keyword}")
+            trace(chat_id, message_id, "跳过:口令已发送过", keyword)
             return
 
         # 获取延时配置
         min_delay, max_delay = config.get_chat_delay(chat_id)
         delay = random.uniform(min_delay, max_delay)
-        await asyncio.sleep(delay)
+        if await packet_tracker.wait(chat_id, message_id, None, delay):
+            trace(chat_id, message_id, "延时中领完，取消发送", keyword)
+            return
+        if not await acquire_send_slot(chat_id, text, red_packet_count, keyword):
+            trace(chat_id, message_id, "发送预算不足，丢弃", keyword)
+            return
 
         try:
             await bot.send_message(chat_id, keyword)
             config.mark_keyword_sent(chat_id, keyword)
-            config.increment_joined()
+            config.increment_joined(chat_id)
+            trace(chat_id, message_id, "已发送: {} | 延迟 {:.2f}s", (keyword, delay))
 
             logs.info(
                 f"[LuckyDraw] 成功参与抽奖（直接发送关键词） | "
@@ -1770,23 +3405,21 @@ async def luckydraw_handler(message: Message, bot: Client):
     # 检查是否已有相同口令在队列中，避免重复加入
     for existing_key, existing_pending in pending_draws.items():
         if existing_pending.get("keyword") == keyword and existing_pending.get("chat_id") == chat_id:
-            if is_test:
-                logs.info(f"[LuckyDraw] 相同口令已在等待队列中，跳过 | 口令: {keyword}")
+            trace(chat_id, message_id, "跳过:相同口令已在等待队列", keyword)
             return
 
     queue_key = f"{chat_id}_{message_id}"
     pending_draws[queue_key] = {
         "keyword": keyword,
+        "keyword_normalized": normalize_text(keyword),
         "keyword_type": keyword_type,
         "chat_id": chat_id,
         "source_message_id": message_id,
+        "text": text,
+        "count": red_packet_count,
+        "created_at": time.time(),
     }
-
-    if is_test:
-        logs.info(
-            f"[LuckyDraw] 已加入等待队列，等待首个回复关键词的用户消息 | "
-            f"群组: {chat_id} | 类型: {keyword_type} | 口令: {keyword}"
-        )
+    trace(chat_id, message_id, "加入转发队列", keyword)
 
 
 # ==================== 监听其他用户回复 ====================
@@ -1813,8 +3446,7 @@ async def luckydraw_reply_handler(message: Message, bot: Client):
 
     # 忽略机器人自己发的消息
     sender = getattr(message, "sender_id", None)
-    bot_id = (await bot.get_me()).id
-    if sender == bot_id:
+    if sender == await get_self_id(bot):
         return
 
     # 提取当前消息文本
@@ -1833,9 +3465,13 @@ async def luckydraw_reply_handler(message: Message, bot: Client):
         keyword_type = pending.get("keyword_type")
         source_message_id = pending.get("source_message_id")
 
+        if time.time() - pending.get("created_at", time.time()) > PENDING_DRAW_TTL:
+            decision_trace.record(chat_id, source_message_id, "等待超时，移出转发队列", keyword)
+            del pending_draws[queue_key]
+            continue
+
         if config.has_sent_keyword(chat_id, keyword):
-            if is_test:
-                logs.info(f"[LuckyDraw] 口令已发送过，移出等待队列 | 口令: {keyword}")
+            decision_trace.record(chat_id, source_message_id, "口令已发送过，移出转发队列", keyword)
             del pending_draws[queue_key]
             continue
 
@@ -1844,7 +3480,7 @@ async def luckydraw_reply_handler(message: Message, bot: Client):
             continue
 
         # 匹配群里后续用户发言：只要消息中包含抽奖关键词，就跟随转发该消息
-        keyword_normalized = normalize_text(keyword)
+        keyword_normalized = pending.get("keyword_normalized") or normalize_text(keyword)
         is_keyword_matched = keyword_normalized in current_text_normalized
 
         if not is_keyword_matched:
@@ -1856,10 +3492,13 @@ async def luckydraw_reply_handler(message: Message, bot: Client):
             keyword_locks[lock_key] = asyncio.Lock()
         lock = keyword_locks[lock_key]
 
-        # 获取群组延时配置
+        # 获取群组延时配置（红包在延时期间领完则放弃转发）
         min_delay, max_delay = config.get_chat_delay(chat_id)
         delay = random.uniform(min_delay, max_delay)
-        await asyncio.sleep(delay)
+        if await packet_tracker.wait(chat_id, source_message_id, pending.get("block_index"), delay):
+            decision_trace.record(chat_id, source_message_id, "延时中领完，取消转发", keyword)
+            pending_draws.pop(queue_key, None)
+            continue
 
         # 使用锁保护整个检查-转发-标记过程，确保原子性
         async with lock:
@@ -1869,10 +3508,20 @@ async def luckydraw_reply_handler(message: Message, bot: Client):
                     del pending_draws[queue_key]
                 continue
 
+            # 确认未发送过再申请发送名额，避免重复口令白白占用预算
+            if not await acquire_send_slot(chat_id, pending.get("text", ""), pending.get("count"), keyword):
+                decision_trace.record(chat_id, source_message_id, "发送预算不足，丢弃", keyword)
+                pending_draws.pop(queue_key, None)
+                continue
+
             try:
                 await bot.forward_messages(chat_id, chat_id, message.id)
                 config.mark_keyword_sent(chat_id, keyword)
-                config.increment_joined()
+                config.record_activity(chat_id, "forwarded")
+                config.increment_joined(chat_id)
+                decision_trace.record(
+                    chat_id, source_message_id, "已转发: {} | 消息 {} | 延迟 {:.2f}s", (keyword, message.id, delay)
+                )
 
                 logs.info(
                     f"[LuckyDraw] 成功参与抽奖（转发首个包含关键词的用户消息） | "
@@ -1913,10 +3562,16 @@ BUTTON_CLICK_KEYWORDS = [
     "马上抢",
 ]
 
+# 按钮文本包含这些词时不点击（取消、退出等按钮会撤销刚参与的抽奖）
+BUTTON_SKIP_KEYWORDS = ["取消", "退出", "规则", "记录"]
+
 # 按钮点击随机延迟范围（秒）
 BUTTON_CLICK_MIN_DELAY = 1.0
 BUTTON_CLICK_MAX_DELAY = 3.0
 
+# 后台点击任务（保留引用，防止任务被垃圾回收）
+_button_click_tasks: Set[asyncio.Task] = set()
+
 
 @listener(is_plugin=True, incoming=True, outgoing=False, ignore_edited=False)
 async def luckydraw_button_handler(message: Message, bot: Client):
@@ -1963,24 +3618,19 @@ async def luckydraw_button_handler(message: Message, bot: Client):
         actual_sender_id = getattr(forward_from_chat, "id", sender_id)
 
     # 检查发送者是否在白名单中
+    message_id = message.id
     if not config.is_bot_allowed(actual_sender_id):
-        if is_test:
-            logs.debug(f"[LuckyDraw-Button] 发送者 {actual_sender_id} 不在白名单中，跳过")
         return
 
     # 检查消息是否已处理
-    message_id = message.id
     button_key = f"{chat_id}_{message_id}_button"
 
     if button_key in _processed_messages[chat_id]:
-        if is_test:
-            logs.debug(f"[LuckyDraw-Button] 消息已处理过，跳过 | message_id: {message_id}")
+        decision_trace.record(chat_id, message_id, "按钮:已处理")
         return
 
-    # 遍历所有按钮，查找匹配的抽奖按钮
-    target_row = None
-    target_col = None
-    target_button_text = None
+    # 每条消息只点击一个参与按钮：文本与关键词完全一致的优先，其次是第一个包含关键词的
+    target = None  # (优先级, 行, 列, 按钮文本)
 
     for row_idx, row in enumerate(inline_keyboard):
         for col_idx, button in enumerate(row):
@@ -1988,37 +3638,27 @@ async def luckydraw_button_handler(message: Message, bot: Client):
             if not button_text:
                 continue
 
-            # 检查按钮文本是否包含关键词
-            for keyword in BUTTON_CLICK_KEYWORDS:
-                if keyword in button_text:
-                    target_row = row_idx
-                    target_col = col_idx
-                    target_button_text = button_text
-                    break
-
-            if target_row is not None:
-                break
+            # 检查按钮文本是否包含关键词，并跳过取消、退出等按钮
+            if not any(keyword in button_text for keyword in BUTTON_CLICK_KEYWORDS):
+                continue
+            if any(word in button_text for word in BUTTON_SKIP_KEYWORDS):
+                continue
 
-        if target_row is not None:
-            break
+            rank = 0 if button_text.strip() in BUTTON_CLICK_KEYWORDS else 1
+            if target is None or rank < target[0]:
+                target = (rank, row_idx, col_idx, button_text)
 
     # 如果没有找到匹配的按钮，跳过
-    if target_row is None:
+    if target is None:
         return
+    _, target_row, target_col, target_button_text = target
 
     # 标记消息已处理
-    _processed_messages[chat_id].add(button_key)
+    remember_processed(chat_id, button_key)
 
     # 增加检测计数
-    config.increment_detected()
-
-    if is_test:
-        logs.info(
-            f"[LuckyDraw-Button] 检测到按钮抽奖 | "
-            f"群组: {chat_id} | "
-            f"按钮: {target_button_text} | "
-            f"位置: ({target_row}, {target_col})"
-        )
+    config.increment_detected(chat_id)
+    decision_trace.record(chat_id, message_id, "按钮:检测到抽奖", target_button_text)
 
     # 获取群组延时配置
     min_delay, max_delay = config.get_chat_delay(chat_id)
@@ -2027,29 +3667,38 @@ async def luckydraw_button_handler(message: Message, bot: Client):
         min_delay = BUTTON_CLICK_MIN_DELAY
         max_delay = BUTTON_CLICK_MAX_DELAY
 
+    # 在后台延时并点击，处理器立即返回，不同消息的点击可以并行进行
     delay = random.uniform(min_delay, max_delay)
+    task = asyncio.create_task(
+        click_lottery_button(message, bot, target_row, target_col, target_button_text, delay, is_test)
+    )
+    _button_click_tasks.add(task)
+    task.add_done_callback(_button_click_tasks.discard)
+
+
+async def click_lottery_button(
+    message: Message,
+    bot: Client,
+    target_row: int,
+    target_col: int,
+    target_button_text: str,
+    delay: float,
+    is_test: bool,
+) -> None:
+    """
+    延时后点击抽奖按钮，并在限定时间内等待机器人的回调应答
+    应答超时不视为失败：回调请求已经发出，只是机器人没有及时应答
+    """
+    chat_id = message.chat.id
     await asyncio.sleep(delay)
 
+    timeout = config.button_answer_timeout
     try:
-        # 点击按钮
-        await message.click(target_row, target_col)
-
-        # 标记成功
-        config.increment_joined()
-
-        logs.info(
-            f"[LuckyDraw-Button] 成功点击抽奖按钮 | "
-            f"群组: {chat_id} | "
-            f"按钮: {target_button_text} | "
-            f"延迟: {delay:.2f}s"
-        )
-
-        if is_test:
-            try:
-                await bot.send_message(chat_id, f"✅ 已点击按钮: {target_button_text}")
-            except Exception:
-                pass
-
+        # 点击按钮（回调按钮会等待机器人应答，最多 timeout 秒）
+        answer = await message.click(target_row, target_col, timeout=timeout)
+        outcome = getattr(answer, 'message', None) or "无应答内容"
+    except (asyncio.TimeoutError, TimeoutError):
+        outcome = f"应答超时（>{timeout}s）"
     except Exception as e:
         logs.error(
             f"[LuckyDraw-Button] 点击按钮失败 | "
@@ -2057,6 +3706,26 @@ async def luckydraw_button_handler(message: Message, bot: Client):
             f"按钮: {target_button_text} | "
             f"错误: {e}"
         )
+        return
+
+    # 标记成功
+    config.increment_joined(chat_id)
+    config.record_activity(chat_id, "clicked")
+    decision_trace.record(chat_id, message.id, "按钮:已点击", (target_button_text, outcome))
+
+    logs.info(
+        f"[LuckyDraw-Button] 成功点击抽奖按钮 | "
+        f"群组: {chat_id} | "
+        f"按钮: {target_button_text} | "
+        f"延迟: {delay:.2f}s | "
+        f"应答: {outcome}"
+    )
+
+    if is_test:
+        try:
+            await bot.send_message(chat_id, f"✅ 已点击按钮: {target_button_text}\n应答: {outcome}")
+        except Exception:
+            pass
 
 
 # ==================== 中奖庆祝贴纸 ====================
@@ -2109,10 +3778,6 @@ async def win_celebration_handler(message: Message, bot: Client):
     if not config.is_enabled(chat_id):
         return
 
-    # 检查是否有庆祝贴纸
-    if not config.celebration_stickers:
-        return
-
     # 获取消息文本
     text = message.text or message.caption or ""
     if not text:
@@ -2144,17 +3809,18 @@ async def win_celebration_handler(message: Message, bot: Client):
         return
 
     # ========== 关键：检查消息中是否包含自己的用户 ID ==========
+    # 中奖统计不依赖贴纸配置，自己的 ID 只请求一次，避免每条中奖通知都调用 get_me
     try:
-        me = await bot.get_me()
-        my_id = me.id
-        # 检查消息文本中是否包含自己的 ID（格式如：(1234567890)）
-        if f"({my_id})" not in text:
-            # 不是自己中奖，跳过
-            return
+        my_id = await get_self_id(bot)
     except Exception as e:
         logs.debug(f"[LuckyDraw-Celebration] 获取自己ID失败: {e}")
         return
 
+    # 检查消息文本中是否包含自己的 ID（格式如：(1234567890)）
+    if f"({my_id})" not in text:
+        # 不是自己中奖，跳过
+        return
+
     # 防止重复庆祝
     message_id = message.id
     celebration_key = f"{chat_id}_{message_id}_celebration"
@@ -2162,7 +3828,12 @@ async def win_celebration_handler(message: Message, bot: Client):
     if celebration_key in _processed_messages[chat_id]:
         return
 
-    _processed_messages[chat_id].add(celebration_key)
+    remember_processed(chat_id, celebration_key)
+    config.record_activity(chat_id, "won")
+
+    # 检查是否有庆祝贴纸（事件循环繁忙时跳过）
+    if not config.celebration_stickers or not load_shedder.allow("sticker"):
+        return
 
     # 获取随机贴纸
     sticker_id = config.get_random_sticker()